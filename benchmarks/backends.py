@@ -0,0 +1,65 @@
+"""
+Benchmark of the similarity backends of local annotation on the test MGF file.
+
+Every spectrum of `Test/Input files/All GNPS.mgf` is scored against all other spectra of the file with each
+backend of SimilarityBackends, through the same pair interface. The script prints the throughput of each backend
+(scored pairs per second) and how often its best hit (leaving the spectrum itself out) agrees with the best hit
+of the modified cosine, the default backend.
+
+Usage:
+    python benchmarks/backends.py [tolerance] [step]
+"""
+
+from pathlib import Path
+from matchms.importing import load_from_mgf
+from ms2decide.BatchScoring import _as_csr
+from ms2decide.SimilarityBackends import BACKENDS
+from ms2decide.Util import Parametres
+import numpy as np
+import time
+import sys
+
+PATH_MGF = Path(__file__).resolve().parent.parent / 'Test' / 'Input files' / 'All GNPS.mgf'
+
+
+def _best_hits(score, n_queries, n_ref):
+    """
+    Get the best hit of each query, the last one among equal scores, -1 if no score is above 0.
+    """
+    score = score.reshape(n_queries, n_ref)
+    best = n_ref - 1 - np.argmax(score[:, ::-1], axis=1)
+    return np.where(score[np.arange(n_queries), best] > 0, best, -1)
+
+
+def main(tolerance=None, step=1):
+    default_tolerance, mz_power, intensity_power, _ = Parametres()
+    if (tolerance is None):
+        tolerance = default_tolerance
+    spectra = [sp for sp in load_from_mgf(str(PATH_MGF)) if sp.get('precursor_mz') is not None]
+    queries = spectra[::step]
+    query, ref = _as_csr(queries), _as_csr(spectra)
+    row = np.repeat(np.arange(len(queries)), len(spectra))
+    col = np.tile(np.arange(len(spectra)), len(queries))
+    # the spectrum itself is left out of its own candidates
+    self_pair = col == row * step
+
+    hits = {}
+    print('==================')
+    print(str(len(queries)) + ' QUERIES AGAINST ' + str(len(spectra)) + ' SPECTRA, TOLERANCE ' + str(tolerance))
+    for name, score_function in BACKENDS.items():
+        # compile the numba kernels before timing
+        score_function(query, ref, row[:2], col[:2], tolerance, mz_power, intensity_power)
+        t = time.perf_counter()
+        score, _ = score_function(query, ref, row, col, tolerance, mz_power, intensity_power)
+        elapsed = time.perf_counter() - t
+        score[self_pair] = 0
+        hits[name] = _best_hits(score, len(queries), len(spectra))
+        agree = int((hits[name] == hits['modified_cosine']).sum())
+        print(name.upper() + ': ' + str(round(elapsed, 2)) + ' s, ' + str(int(len(row)/elapsed)) +
+              ' PAIRS/S, BEST HIT OF MODIFIED COSINE FOR ' + str(agree) + ' OF ' + str(len(queries)))
+    print('==================')
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(float(args[0]) if args else None, int(args[1]) if len(args) > 1 else 1)
@@ -0,0 +1,59 @@
+"""
+Benchmark of the best-match search of local annotation on the test MGF file.
+
+Every spectrum of `Test/Input files/All GNPS.mgf` is matched against all spectra of the file, once by scoring
+all candidates (_modified_cosine_batch) and once with the bound-ordered search used by _get_match
+(_best_candidate). Both must give the same best hit; the script prints the timings and the number of
+candidates actually scored.
+
+Usage:
+    python benchmarks/best_match.py [tolerance] [step]
+"""
+
+from pathlib import Path
+from matchms.importing import load_from_mgf
+from ms2decide.BatchScoring import _modified_cosine_batch, _best_candidate
+from ms2decide.Util import Parametres
+import numpy as np
+import time
+import sys
+
+PATH_MGF = Path(__file__).resolve().parent.parent / 'Test' / 'Input files' / 'All GNPS.mgf'
+
+
+def main(tolerance=None, step=1):
+    default_tolerance, mz_power, intensity_power, _ = Parametres()
+    if (tolerance is None):
+        tolerance = default_tolerance
+    spectra = list(load_from_mgf(str(PATH_MGF)))
+    queries = spectra[::step]
+    # compile the numba kernel before timing
+    _modified_cosine_batch(spectra[0], spectra[:2], tolerance, mz_power, intensity_power)
+
+    full_time, bound_time, scored = 0.0, 0.0, 0
+    for sp in queries:
+        t = time.perf_counter()
+        scores, matches = _modified_cosine_batch(sp, spectra, tolerance, mz_power, intensity_power)
+        best = len(scores) - 1 - int(np.argmax(scores[::-1]))
+        full_time += time.perf_counter() - t
+        expected = (best, float(scores[best]), int(matches[best])) if scores[best] > 0 else (-1, 0.0, 0)
+
+        t = time.perf_counter()
+        res = _best_candidate(sp, spectra, tolerance, mz_power, intensity_power)
+        bound_time += time.perf_counter() - t
+        scored += res[3]
+        if (res[:3] != expected):
+            raise Exception('Different best match for ' + str(sp.get('scans')))
+
+    print('==================')
+    print(str(len(queries)) + ' QUERIES AGAINST ' + str(len(spectra)) + ' SPECTRA, TOLERANCE ' + str(tolerance))
+    print('ALL CANDIDATES: ' + str(round(full_time, 2)) + ' s')
+    print('BOUND-ORDERED: ' + str(round(bound_time, 2)) + ' s, ' + str(scored) + ' OF ' +
+          str(len(queries)*len(spectra)) + ' CANDIDATES SCORED')
+    print('SPEEDUP: ' + str(round(full_time/bound_time, 2)))
+    print('==================')
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(float(args[0]) if args else None, int(args[1]) if len(args) > 1 else 1)
@@ -0,0 +1,82 @@
+"""
+Microbenchmark of the peak matching functions on the test MGF file.
+
+Compares the former nested-loop `_find_matches` (kept below as `_find_matches_loop`) with the
+`numpy.searchsorted` version of Util and with the batched BatchScoring._find_matches_batch, on all pairs of
+spectra of `Test/Input files/All GNPS.mgf`, and checks that the three give the same matches.
+
+Usage:
+    python benchmarks/find_matches.py [tolerance] [step]
+"""
+
+from pathlib import Path
+from matchms.importing import load_from_mgf
+from ms2decide.BatchScoring import _find_matches_batch
+from ms2decide.Util import _find_matches, Parametres
+import numpy as np
+import time
+import sys
+
+PATH_MGF = Path(__file__).resolve().parent.parent / 'Test' / 'Input files' / 'All GNPS.mgf'
+
+
+def _find_matches_loop(spec1_mz, spec2_mz, tolerance, shift):
+    lowest_idx = 0
+    matches = []
+    for peak1_idx in range(spec1_mz.shape[0]):
+        mz = spec1_mz[peak1_idx]
+        low_bound = mz - tolerance
+        high_bound = mz + tolerance
+        for peak2_idx in range(lowest_idx, spec2_mz.shape[0]):
+            mz2 = spec2_mz[peak2_idx] + shift
+            if mz2 > high_bound:
+                break
+            if mz2 < low_bound:
+                lowest_idx = peak2_idx
+            else:
+                matches.append((peak1_idx, peak2_idx))
+    return matches
+
+
+def main(tolerance=None, step=1):
+    if (tolerance is None):
+        tolerance = Parametres()[0]
+    spectra = list(load_from_mgf(str(PATH_MGF)))[::step]
+    pairs = [(a, b) for a in range(len(spectra)) for b in range(len(spectra))]
+    shifts = [spectra[b].get('precursor_mz') - spectra[a].get('precursor_mz') for a, b in pairs]
+
+    t = time.perf_counter()
+    loop = [_find_matches_loop(spectra[a].peaks.mz, spectra[b].peaks.mz, tolerance, s)
+            for (a, b), s in zip(pairs, shifts)]
+    loop_time = time.perf_counter() - t
+
+    t = time.perf_counter()
+    vectorized = [_find_matches(spectra[a].peaks.mz, spectra[b].peaks.mz, tolerance, s)
+                  for (a, b), s in zip(pairs, shifts)]
+    vectorized_time = time.perf_counter() - t
+
+    mz = np.concatenate([sp.peaks.mz for sp in spectra])
+    offsets = np.zeros(len(spectra)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(sp.peaks.mz) for sp in spectra])
+    t = time.perf_counter()
+    pair, peak1, peak2 = _find_matches_batch((mz, offsets), (mz, offsets), [a for a, _ in pairs],
+                                             [b for _, b in pairs], tolerance, np.array(shifts))
+    batch_time = time.perf_counter() - t
+
+    bounds = np.searchsorted(pair, np.arange(len(pairs)+1))
+    batch = [list(zip(peak1[bounds[k]:bounds[k+1]].tolist(), peak2[bounds[k]:bounds[k+1]].tolist()))
+             for k in range(len(pairs))]
+    if (loop != vectorized) or (loop != batch):
+        raise Exception('Different matches')
+
+    print('==================')
+    print(str(len(pairs)) + ' SPECTRUM PAIRS, ' + str(len(pair)) + ' MATCHES, TOLERANCE ' + str(tolerance))
+    print('LOOP: ' + str(round(loop_time, 3)) + ' s')
+    print('SEARCHSORTED: ' + str(round(vectorized_time, 3)) + ' s (x' + str(round(loop_time/vectorized_time, 1)) + ')')
+    print('BATCHED: ' + str(round(batch_time, 3)) + ' s (x' + str(round(loop_time/batch_time, 1)) + ')')
+    print('==================')
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(float(args[0]) if args else None, int(args[1]) if len(args) > 1 else 1)
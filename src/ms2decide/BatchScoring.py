@@ -0,0 +1,877 @@
+"""
+This module scores query spectra against many candidate spectra in a single vectorized pass.
+
+The candidates are given as flattened CSR peak arrays (see SpectralLibrary): all m/z and intensity values
+concatenated, plus an offsets array. The scoring reproduces matchms `ModifiedCosineGreedy.pair` step by step:
+
+    1. collect all peak pairs within tolerance, without shift and with the precursor mass shift,
+       in the order of matchms `find_matches` (candidate peak, then query peak), searching the sorted
+       query peaks with `numpy.searchsorted`; like matchms, the pairs whose precursor m/z differ by at most the
+       tolerance get no shifted peak pairs (matchms scores them with CosineGreedy);
+    2. sort the pairs by decreasing intensity product, like the reversed stable sort of matchms;
+    3. assign peaks greedily, each peak of each spectrum being used at most once;
+    4. sum the assigned products in sorted order and normalise by the two spectrum norms.
+
+Step 3 is run as rounds over all candidates at once: a pair whose two peaks are not claimed by any earlier
+remaining pair is accepted by the sequential greedy algorithm, so every round accepts those pairs and drops
+the pairs that conflict with them. Sums are accumulated sequentially per candidate, in the same order as matchms.
+The spectrum norms and the final normalisation are computed by a numba kernel written with the same expression
+and `fastmath` setting as matchms `score_best_matches`, because numba vectorises that reduction in a CPU-specific
+order that plain NumPy cannot reproduce bit for bit.
+
+Functions:
+    1. _as_csr:
+       Flattens a list of spectra (or returns the arrays of a SpectralLibrary) into CSR peak arrays.
+       _invalid_spectra flags the spectra that cannot be scored.
+
+    2. _find_matches_batch:
+       Finds the peaks within tolerance (plus a shift) of many spectrum pairs at once.
+
+    3. _modified_cosine_pairs:
+       Scores any list of (query, candidate) pairs and returns the scores and numbers of matched peaks.
+       Without the shifted pairs it gives the cosine of CosineGreedy (see SimilarityBackends).
+       _modified_cosine_sweep scores them at several tolerances, collecting the peak pairs once.
+
+    4. _modified_cosine_batch:
+       Scores one query against all of its candidates.
+
+    5. _best_candidate, _top_candidates:
+       Find the best (or k best) candidates of one query, scoring candidates in decreasing order of an upper bound
+       of their score.
+
+    6. _score_pairs:
+       Scores any list of (query, library entry) pairs in passes of bounded memory.
+
+    7. _score_matrix:
+       Scores all features of a run against a library at once, into sparse score and match matrices.
+
+    8. _rescore_pairs:
+       Scores pairs again with new m/z and intensity powers from the peak pairs assigned by _score_pairs,
+       without collecting or assigning peaks.
+"""
+
+from .SpectralLibrary import SpectralLibrary
+from scipy import sparse
+import numpy as np
+import heapq
+import numba
+
+# margin added to the searchsorted bounds; the exact tolerance test is applied afterwards
+_MARGIN = 1e-6
+# relative slack on the upper bounds, covers their rounding errors so that pruning never changes the result
+_SLACK = 1e-9
+# number of candidates scored in the first round of _top_candidates, doubled at each round
+_FIRST_ROUND = 4
+# maximum number of library peaks (probes) scored in one pass by _score_matrix, bounds the memory used
+_MAX_PROBES = 1 << 22
+
+
+def _as_csr(spectra):
+    """
+    Get the CSR peak arrays of a collection of spectra.
+
+    Args:
+        spectra (list or SpectralLibrary): The spectra.
+
+    Returns:
+        tuple: m/z, intensities, offsets and precursor m/z arrays.
+    """
+    if (isinstance(spectra, SpectralLibrary)):
+        return (np.asarray(spectra.mz), np.asarray(spectra.intensities),
+                np.asarray(spectra.offsets), np.asarray(spectra.precursor_mz))
+    offsets = np.zeros(len(spectra)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(sp.peaks.mz) for sp in spectra])
+    if (len(spectra) == 0):
+        mz, intensities = np.zeros(0), np.zeros(0)
+    else:
+        mz = np.concatenate([sp.peaks.mz for sp in spectra])
+        intensities = np.concatenate([sp.peaks.intensities for sp in spectra])
+    precursor = np.array([np.nan if sp.get('precursor_mz') is None else sp.get('precursor_mz')
+                          for sp in spectra], dtype=np.float64)
+    return mz, intensities, offsets, precursor
+
+
+def _invalid_spectra(csr):
+    """
+    Find the spectra that cannot be scored: missing precursor m/z, or non-finite or negative peak values.
+
+    Args:
+        csr (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the spectra.
+
+    Returns:
+        numpy.ndarray: Boolean mask of the invalid spectra.
+    """
+    mz, intensities, offsets, precursor = csr
+    bad_peak = ~np.isfinite(mz) | ~np.isfinite(intensities) | (intensities < 0)
+    owner = np.repeat(np.arange(len(offsets)-1), np.diff(offsets))
+    return (np.isnan(precursor) | (np.bincount(owner, weights=bad_peak, minlength=len(offsets)-1) > 0))
+
+
+def _expand_ranges(start, stop):
+    """
+    Expand index ranges [start[i], stop[i]) into flat arrays.
+
+    Args:
+        start (numpy.ndarray): Range starts.
+        stop (numpy.ndarray): Range ends (excluded).
+
+    Returns:
+        tuple: The range number and the position of every expanded element.
+    """
+    counts = stop - start
+    owner = np.repeat(np.arange(len(start)), counts)
+    first = np.cumsum(counts) - counts
+    position = np.arange(counts.sum()) - first[owner] + start[owner]
+    return owner, position
+
+
+def _sequential_sum(values, groups, n_groups):
+    """
+    Sum values per group, adding them one after the other in array order.
+
+    The summation order is the one of a plain Python/numba loop, so that results are bit-identical to matchms.
+
+    Args:
+        values (numpy.ndarray): Values, grouped contiguously.
+        groups (numpy.ndarray): Non-decreasing group of each value.
+        n_groups (int): Number of groups.
+
+    Returns:
+        numpy.ndarray: The sum of each group (0 for empty groups).
+    """
+    counts = np.bincount(groups, minlength=n_groups)
+    start = np.cumsum(counts) - counts
+    total = np.zeros(n_groups)
+    # groups by decreasing size: the groups still summing at step k are a prefix of this order
+    order = np.argsort(-counts, kind='stable')
+    active = np.searchsorted(-counts[order], -np.arange(counts.max() if n_groups else 0), side='left')
+    for k in range(len(active)):
+        sel = order[:active[k]]
+        total[sel] += values[start[sel] + k]
+    return (total)
+
+
+@numba.njit
+def _pair_products(ref_mz, ref_intensities, ref_peak, query_mz, query_intensities, query_peak, mz_power,
+                   intensity_power):
+    """
+    Compute the weighted intensity products of peak pairs, with the expression of matchms `collect_peak_pairs`.
+
+    NumPy computes `x ** 0.5` as a square root, while numba calls `pow`, which can differ in the last bit.
+
+    Args:
+        ref_mz (numpy.ndarray): m/z values of the reference peaks.
+        ref_intensities (numpy.ndarray): Intensities of the reference peaks.
+        ref_peak (numpy.ndarray): Reference peak of each pair.
+        query_mz (numpy.ndarray): m/z values of the query peaks.
+        query_intensities (numpy.ndarray): Intensities of the query peaks.
+        query_peak (numpy.ndarray): Query peak of each pair.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+
+    Returns:
+        numpy.ndarray: The products.
+    """
+    product = np.empty(ref_peak.shape[0])
+    for i in range(ref_peak.shape[0]):
+        r, q = ref_peak[i], query_peak[i]
+        product[i] = (((ref_mz[r] ** mz_power) * (ref_intensities[r] ** intensity_power))
+                      * ((query_mz[q] ** mz_power) * (query_intensities[q] ** intensity_power)))
+    return (product)
+
+
+@numba.njit(fastmath=True)
+def _normalise(total, ref_power, ref_offsets, pair_ref, query_power, query_offsets, pair_query):
+    """
+    Normalise the summed products by the norms of the reference and query spectra, as matchms does.
+
+    The whole expression of matchms `score_best_matches` is kept in one kernel: with `fastmath`, numba
+    rewrites it as a whole, so computing the norms separately does not give the same bits.
+
+    Args:
+        total (numpy.ndarray): Summed products of the assigned peak pairs of each spectrum pair.
+        ref_power (numpy.ndarray): Weighted intensities of the reference peaks.
+        ref_offsets (numpy.ndarray): Offsets of the reference peaks.
+        pair_ref (numpy.ndarray): Reference of each spectrum pair.
+        query_power (numpy.ndarray): Weighted intensities of the query peaks.
+        query_offsets (numpy.ndarray): Offsets of the query peaks.
+        pair_query (numpy.ndarray): Query of each spectrum pair.
+
+    Returns:
+        numpy.ndarray: The scores.
+    """
+    score = np.zeros(total.shape[0])
+    for i in range(total.shape[0]):
+        if (total[i] != 0):
+            spec1_power = ref_power[ref_offsets[pair_ref[i]]:ref_offsets[pair_ref[i]+1]]
+            spec2_power = query_power[query_offsets[pair_query[i]]:query_offsets[pair_query[i]+1]]
+            score[i] = total[i]/(np.sum(spec1_power ** 2) ** 0.5 * np.sum(spec2_power ** 2) ** 0.5)
+    return (score)
+
+
+def _segmented_searchsorted(values, offsets, segment, low, high):
+    """
+    Find, inside segment[i] of a CSR array, the range of values between low[i] and high[i].
+
+    Each segment values[offsets[k]:offsets[k+1]] must be sorted. All segments are searched at once
+    by shifting segment k by k times the span of the values; the resulting bounds may be off by a
+    few ulps, so callers widen low/high and check matches exactly afterwards.
+
+    Args:
+        values (numpy.ndarray): Concatenated sorted segments.
+        offsets (numpy.ndarray): Offsets of the segments.
+        segment (numpy.ndarray): Segment searched by each probe.
+        low (numpy.ndarray): Lower bound of each probe (searched with side='left').
+        high (numpy.ndarray): Upper bound of each probe (searched with side='right').
+
+    Returns:
+        tuple: Start and stop positions in values of every probe.
+    """
+    if (len(offsets) == 2):
+        return (np.searchsorted(values, low, side='left'), np.searchsorted(values, high, side='right'))
+    if (len(values) == 0):
+        zero = np.zeros(len(segment), dtype=np.int64)
+        return zero, zero
+    vmin, vmax = values.min(), values.max()
+    span = vmax - vmin + 4
+    key = np.repeat(np.arange(len(offsets)-1), np.diff(offsets)) * span + (values - vmin + 1)
+    low = segment * span + (np.clip(low, vmin - 1, vmax + 1) - vmin + 1)
+    high = segment * span + (np.clip(high, vmin - 1, vmax + 1) - vmin + 1)
+    return (np.searchsorted(key, low, side='left'), np.searchsorted(key, high, side='right'))
+
+
+def _collect_pairs(query_mz, query_offsets, probe_query, probe_mz, probe_shift, tolerance):
+    """
+    Find all peak pairs within tolerance, for many reference peaks (probes) at once.
+
+    A probe is one reference peak of one spectrum pair; it matches the peaks of its query whose m/z plus the
+    shift of the pair is within tolerance, with the exact test of matchms `find_matches`.
+
+    Args:
+        query_mz (numpy.ndarray): Concatenated sorted m/z values of the queries.
+        query_offsets (numpy.ndarray): Offsets of the query peaks.
+        probe_query (numpy.ndarray): Query of each probe.
+        probe_mz (numpy.ndarray): m/z value of each probe.
+        probe_shift (numpy.ndarray): Shift added to the query m/z for each probe.
+        tolerance (float): The allowed deviation in m/z values for peaks to be considered a match.
+
+    Returns:
+        tuple: Probe index and query peak index of every pair, ordered by probe then query peak.
+    """
+    low = probe_mz - tolerance
+    high = probe_mz + tolerance
+    start, stop = _segmented_searchsorted(query_mz, query_offsets, probe_query,
+                                          low - probe_shift - _MARGIN, high - probe_shift + _MARGIN)
+    probe, qpeak = _expand_ranges(start, stop)
+    shifted = query_mz[qpeak] + probe_shift[probe]
+    keep = (shifted >= low[probe]) & (shifted <= high[probe])
+    return probe[keep], qpeak[keep]
+
+
+def _find_matches_batch(spec1, spec2, pair1, pair2, tolerance, shift=0.0):
+    """
+    Find the matching peaks of many spectrum pairs at once, like Util._find_matches applied to each pair.
+
+    Args:
+        spec1 (tuple): m/z values and offsets of the first spectra, in CSR form.
+        spec2 (tuple): m/z values and offsets of the second spectra, in CSR form, sorted within each spectrum.
+        pair1 (numpy.ndarray): First spectrum of each pair.
+        pair2 (numpy.ndarray): Second spectrum of each pair.
+        tolerance (float): The allowed deviation in m/z values for peaks to be considered a match.
+        shift (float or numpy.ndarray, optional): Value added to the m/z values of the second spectrum, for all
+            pairs or for each pair. Defaults to 0.0.
+
+    Returns:
+        tuple: Pair, peak index in the first spectrum and peak index in the second spectrum of every match,
+        ordered by pair, then first peak, then second peak.
+    """
+    mz1, offsets1 = spec1
+    mz2, offsets2 = spec2
+    pair1 = np.asarray(pair1, dtype=np.int64)
+    pair2 = np.asarray(pair2, dtype=np.int64)
+    shift = np.broadcast_to(np.asarray(shift, dtype=np.float64), pair1.shape)
+    probe_pair, peak1 = _expand_ranges(offsets1[pair1], offsets1[pair1+1])
+    probe, peak2 = _collect_pairs(mz2, offsets2, pair2[probe_pair], mz1[peak1], shift[probe_pair], tolerance)
+    pair = probe_pair[probe]
+    return pair, peak1[probe] - offsets1[pair1[pair]], peak2 - offsets2[pair2[pair]]
+
+
+def _greedy_assignment(key1, key2):
+    """
+    Assign peak pairs greedily, in array order, each peak being used at most once.
+
+    Args:
+        key1 (numpy.ndarray): Identifier of the first peak of each pair.
+        key2 (numpy.ndarray): Identifier of the second peak of each pair.
+
+    Returns:
+        numpy.ndarray: Boolean mask of the accepted pairs.
+    """
+    accepted = np.zeros(len(key1), dtype=bool)
+    alive = np.arange(len(key1))
+    while (len(alive) != 0):
+        k1, k2 = key1[alive], key2[alive]
+        first1 = np.zeros(len(alive), dtype=bool)
+        first1[np.unique(k1, return_index=True)[1]] = True
+        first2 = np.zeros(len(alive), dtype=bool)
+        first2[np.unique(k2, return_index=True)[1]] = True
+        take = first1 & first2
+        accepted[alive[take]] = True
+        drop = take | np.isin(k1, k1[take]) | np.isin(k2, k2[take])
+        alive = alive[~drop]
+    return (accepted)
+
+
+@numba.njit
+def _greedy_sweep(probe, query_peak, owner, level, n_probes, n_query_peaks, n_levels):
+    """
+    Assign peak pairs greedily, in array order, at several nested levels in one pass.
+
+    A pair takes part in the levels from its own level upwards; at each level a probe and a query peak of a
+    spectrum pair are used at most once, as in _greedy_assignment.
+
+    Args:
+        probe (numpy.ndarray): Probe of each peak pair.
+        query_peak (numpy.ndarray): Query peak of each peak pair.
+        owner (numpy.ndarray): Spectrum pair of each peak pair.
+        level (numpy.ndarray): First level of each peak pair.
+        n_probes (int): Number of probes.
+        n_query_peaks (int): Number of query peaks.
+        n_levels (int): Number of levels.
+
+    Returns:
+        numpy.ndarray: Boolean mask of the accepted pairs at each level, one row per level.
+    """
+    accepted = np.zeros((n_levels, probe.shape[0]), dtype=np.bool_)
+    used_probe = np.zeros((n_levels, n_probes), dtype=np.bool_)
+    used_query = np.full((n_levels, n_query_peaks), -1, dtype=np.int64)
+    for j in range(probe.shape[0]):
+        for t in range(level[j], n_levels):
+            if (not used_probe[t, probe[j]]) and (used_query[t, query_peak[j]] != owner[j]):
+                used_probe[t, probe[j]] = True
+                used_query[t, query_peak[j]] = owner[j]
+                accepted[t, j] = True
+    return (accepted)
+
+
+def _peak_pairs(query, ref, pair_query, pair_ref, tolerance, shifted=True, return_shift=False):
+    """
+    Collect the peak pairs within tolerance of (query, reference) spectrum pairs, without and with the precursor shift.
+
+    The shifted peak pairs are only collected for the spectrum pairs whose precursor m/z differ by more than the
+    tolerance, the other spectrum pairs being scored with CosineGreedy by matchms ModifiedCosineGreedy.
+
+    Args:
+        query (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the queries.
+        ref (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the references.
+        pair_query (numpy.ndarray): Query of each spectrum pair.
+        pair_ref (numpy.ndarray): Reference of each spectrum pair.
+        tolerance (float): The allowable mass difference for matching peaks.
+        shifted (bool, optional): Whether to also collect the pairs with the precursor shift. Defaults to True.
+        return_shift (bool, optional): Whether to also return the shift added to the query m/z of each peak pair.
+            Defaults to False.
+
+    Returns:
+        tuple: Spectrum pair and reference peak of each probe, then probe and query peak of each peak pair.
+    """
+    query_mz, _, query_offsets, query_precursor = query
+    ref_mz, _, ref_offsets, ref_precursor = ref
+    if (shifted) and (np.isnan(query_precursor[pair_query]).any() or np.isnan(ref_precursor[pair_ref]).any()):
+        raise ValueError('Precursor_mz missing. Apply `add_precursor_mz` filter first.')
+
+    # one probe per reference peak of every spectrum pair, ordered by pair then reference peak
+    probe_pair, probe_peak = _expand_ranges(ref_offsets[pair_ref], ref_offsets[pair_ref+1])
+    probe_query = pair_query[probe_pair]
+    probe_mz = ref_mz[probe_peak]
+    probe0, qpeak0 = _collect_pairs(query_mz, query_offsets, probe_query, probe_mz,
+                                    np.zeros(len(probe_pair)), tolerance)
+    if (not shifted):
+        res = probe_pair, probe_peak, probe0, qpeak0
+        return (res + (np.zeros(len(probe0)),) if return_shift else res)
+    mass_shift = (ref_precursor[pair_ref] - query_precursor[pair_query])[probe_pair]
+    # like matchms ModifiedCosineGreedy, no shifted peak pairs when the precursors are within tolerance
+    far = np.flatnonzero(np.abs(mass_shift) > tolerance)
+    probe1, qpeak1 = _collect_pairs(query_mz, query_offsets, probe_query[far], probe_mz[far], mass_shift[far],
+                                    tolerance)
+    probe1 = far[probe1]
+    res = probe_pair, probe_peak, np.concatenate((probe0, probe1)), np.concatenate((qpeak0, qpeak1))
+    return (res + (np.concatenate((np.zeros(len(probe0)), mass_shift[probe1])),) if return_shift else res)
+
+
+def _modified_cosine_pairs(query, ref, pair_query, pair_ref, tolerance, mz_power, intensity_power, shifted=True,
+                           return_peaks=False):
+    """
+    Score many (query, reference) spectrum pairs with the modified cosine of matchms ModifiedCosineGreedy.
+
+    Without the shifted peak pairs, the score is the cosine of matchms CosineGreedy.
+
+    Args:
+        query (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the queries.
+        ref (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the references.
+        pair_query (numpy.ndarray): Query of each spectrum pair.
+        pair_ref (numpy.ndarray): Reference of each spectrum pair.
+        tolerance (float): The allowable mass difference for matching peaks.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+        shifted (bool, optional): Whether to match peaks with the precursor shift too. Defaults to True.
+        return_peaks (bool, optional): Whether to also return the assigned peak pairs. Defaults to False.
+
+    Returns:
+        tuple: Scores and numbers of matched peaks of the spectrum pairs, and with return_peaks the spectrum pair,
+        reference peak and query peak of each assigned peak pair, in summation order.
+    """
+    query_mz, query_intensities, query_offsets, _ = query
+    ref_mz, ref_intensities, ref_offsets, _ = ref
+    n_pairs = len(pair_query)
+    probe_pair, probe_peak, probe, qpeak = _peak_pairs(query, ref, pair_query, pair_ref, tolerance, shifted)
+    owner = probe_pair[probe]
+
+    ref_power = ref_mz ** mz_power * ref_intensities ** intensity_power
+    query_power = query_mz ** mz_power * query_intensities ** intensity_power
+    product = _pair_products(ref_mz, ref_intensities, probe_peak[probe], query_mz, query_intensities, qpeak,
+                             float(mz_power), float(intensity_power))
+
+    order = np.lexsort((-np.arange(len(probe)), -product, owner))
+    probe, qpeak, owner, product = probe[order], qpeak[order], owner[order], product[order]
+    accepted = _greedy_assignment(probe, owner * len(query_mz) + qpeak)
+
+    total = _sequential_sum(product[accepted], owner[accepted], n_pairs)
+    matches = np.bincount(owner[accepted], minlength=n_pairs)
+    score = _normalise(total, ref_power, ref_offsets, pair_ref, query_power, query_offsets, pair_query)
+    if (return_peaks):
+        return score, matches, (owner[accepted], probe_peak[probe[accepted]], qpeak[accepted])
+    return score, matches
+
+
+def _rescore_peaks(query, ref, pair_query, pair_ref, peaks, mz_power, intensity_power):
+    """
+    Score (query, reference) spectrum pairs from their assigned peak pairs, with new m/z and intensity powers.
+
+    The peak assignment is not made again: the products of the stored peak pairs are summed in their stored
+    order. This is the score of a full run whenever the new powers keep the order of the peak products, e.g.
+    with mz_power 0 and any positive intensity_power.
+
+    Args:
+        query (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the queries.
+        ref (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the references.
+        pair_query (numpy.ndarray): Query of each spectrum pair.
+        pair_ref (numpy.ndarray): Reference of each spectrum pair.
+        peaks (tuple): Spectrum pair, reference peak and query peak of each assigned peak pair, as returned by
+            _modified_cosine_pairs.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+
+    Returns:
+        tuple: Scores and numbers of matched peaks of the spectrum pairs.
+    """
+    query_mz, query_intensities, query_offsets, _ = query
+    ref_mz, ref_intensities, ref_offsets, _ = ref
+    owner, rpeak, qpeak = peaks
+    ref_power = ref_mz ** mz_power * ref_intensities ** intensity_power
+    query_power = query_mz ** mz_power * query_intensities ** intensity_power
+    product = _pair_products(ref_mz, ref_intensities, rpeak, query_mz, query_intensities, qpeak,
+                             float(mz_power), float(intensity_power))
+    total = _sequential_sum(product, owner, len(pair_query))
+    matches = np.bincount(owner, minlength=len(pair_query))
+    score = _normalise(total, ref_power, ref_offsets, pair_ref, query_power, query_offsets, pair_query)
+    return score, matches
+
+
+def _modified_cosine_sweep(query, ref, pair_query, pair_ref, tolerances, mz_power, intensity_power):
+    """
+    Score many (query, reference) spectrum pairs with the modified cosine at several tolerances at once.
+
+    The peak pairs are collected and sorted once at the widest tolerance. The pairs within a narrower tolerance
+    (with the exact test of _collect_pairs) keep the same relative order, so the greedy assignment of that subset
+    gives the same result as scoring at the narrower tolerance; the assignments of all tolerances are made in
+    one pass by _greedy_sweep. A spectrum pair only takes part at the
+    tolerances whose precursor window holds it (same test as PrecursorIndex.select_many), and scores 0 at the
+    others.
+
+    Args:
+        query (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the queries.
+        ref (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the references.
+        pair_query (numpy.ndarray): Query of each spectrum pair.
+        pair_ref (numpy.ndarray): Reference of each spectrum pair.
+        tolerances (tuple): The tolerances for matching peaks.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+
+    Returns:
+        tuple: Scores and numbers of matched peaks of the spectrum pairs, with one column per tolerance.
+    """
+    query_mz, query_intensities, query_offsets, query_precursor = query
+    ref_mz, ref_intensities, ref_offsets, ref_precursor = ref
+    n_pairs = len(pair_query)
+    window = np.abs(ref_precursor[pair_ref] - query_precursor[pair_query])
+    probe_pair, probe_peak, probe, qpeak, shift = _peak_pairs(query, ref, pair_query, pair_ref, max(tolerances),
+                                                             return_shift=True)
+    owner = probe_pair[probe]
+
+    ref_power = ref_mz ** mz_power * ref_intensities ** intensity_power
+    query_power = query_mz ** mz_power * query_intensities ** intensity_power
+    product = _pair_products(ref_mz, ref_intensities, probe_peak[probe], query_mz, query_intensities, qpeak,
+                             float(mz_power), float(intensity_power))
+
+    order = np.lexsort((-np.arange(len(probe)), -product, owner))
+    probe, qpeak, owner, product, shift = probe[order], qpeak[order], owner[order], product[order], shift[order]
+    probe_mz = ref_mz[probe_peak[probe]]
+    shifted = query_mz[qpeak] + shift
+    window = window[owner]
+
+    # the tests are monotonic in the tolerance: a pair kept at one tolerance is kept at all wider ones
+    ascending = np.argsort(tolerances, kind='stable')
+    level = np.full(len(probe), len(tolerances), dtype=np.int64)
+    for t in ascending[::-1]:
+        tolerance = tolerances[t]
+        kept = (shifted >= probe_mz - tolerance) & (shifted <= probe_mz + tolerance) & (window <= tolerance)
+        level[kept] -= 1
+    accepted = _greedy_sweep(probe, qpeak, owner, level, len(probe_pair), len(query_mz), len(tolerances))
+
+    score = np.zeros((n_pairs, len(tolerances)))
+    matches = np.zeros((n_pairs, len(tolerances)), dtype=np.int64)
+    for k, t in enumerate(ascending):
+        kept = np.flatnonzero(accepted[k])
+        total = _sequential_sum(product[kept], owner[kept], n_pairs)
+        matches[:, t] = np.bincount(owner[kept], minlength=n_pairs)
+        score[:, t] = _normalise(total, ref_power, ref_offsets, pair_ref, query_power, query_offsets, pair_query)
+    return score, matches
+
+
+def _modified_cosine_batch(sp, candidates, tolerance, mz_power, intensity_power):
+    """
+    Score a query spectrum against all candidates with the modified cosine of matchms ModifiedCosineGreedy.
+
+    Args:
+        sp (Spectrum): The query spectrum.
+        candidates (list or SpectralLibrary): The candidate spectra.
+        tolerance (float): The allowable mass difference for matching peaks.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+
+    Returns:
+        tuple: Scores and numbers of matched peaks of the candidates.
+    """
+    ref = _as_csr(candidates)
+    query = _as_csr([sp])
+    if (sp.get('precursor_mz') is None):
+        raise ValueError('Precursor_mz missing. Apply `add_precursor_mz` filter first.')
+    n_ref = len(ref[2])-1
+    return (_modified_cosine_pairs(query, ref, np.zeros(n_ref, dtype=np.int64), np.arange(n_ref),
+                                   tolerance, mz_power, intensity_power))
+
+
+def _upper_bounds(query, ref, pair_query, pair_ref, tolerance, mz_power, intensity_power):
+    """
+    Compute an upper bound of the modified cosine of (query, reference) spectrum pairs.
+
+    Only peaks with at least one partner in the peak pairs of _peak_pairs can be assigned,
+    and each peak at most once, so by the Cauchy-Schwarz inequality the summed products are at most the product
+    of the norms of the matchable peaks of both spectra. The bound is this product over the full norms.
+
+    Args:
+        query (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the queries.
+        ref (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the references.
+        pair_query (numpy.ndarray): Query of each spectrum pair.
+        pair_ref (numpy.ndarray): Reference of each spectrum pair.
+        tolerance (float): The allowable mass difference for matching peaks.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+
+    Returns:
+        numpy.ndarray: The upper bounds, 0 for pairs without any peak pair (whose score is 0).
+    """
+    query_mz, query_intensities, query_offsets, _ = query
+    ref_mz, ref_intensities, ref_offsets, _ = ref
+    n_pairs = len(pair_query)
+    probe_pair, probe_peak, probe, qpeak = _peak_pairs(query, ref, pair_query, pair_ref, tolerance)
+    ref_square = (ref_mz ** mz_power * ref_intensities ** intensity_power) ** 2
+    query_square = (query_mz ** mz_power * query_intensities ** intensity_power) ** 2
+
+    ref_matchable = np.unique(probe)
+    owner = probe_pair[ref_matchable]
+    ref_part = np.bincount(owner, weights=ref_square[probe_peak[ref_matchable]], minlength=n_pairs)
+    query_matchable = np.unique(probe_pair[probe] * len(query_mz) + qpeak)
+    owner, peak = np.divmod(query_matchable, len(query_mz))
+    query_part = np.bincount(owner, weights=query_square[peak], minlength=n_pairs)
+
+    ref_norm = np.bincount(np.repeat(np.arange(len(ref_offsets)-1), np.diff(ref_offsets)),
+                           weights=ref_square, minlength=len(ref_offsets)-1)[pair_ref]
+    query_norm = np.bincount(np.repeat(np.arange(len(query_offsets)-1), np.diff(query_offsets)),
+                             weights=query_square, minlength=len(query_offsets)-1)[pair_query]
+    bound = np.zeros(n_pairs)
+    valid = (ref_part > 0) & (query_part > 0)
+    bound[valid] = np.sqrt(ref_part[valid] * query_part[valid] / (ref_norm[valid] * query_norm[valid]))
+    return (bound)
+
+
+def _top_candidates(sp, candidates, tolerance, mz_power, intensity_power, k):
+    """
+    Find the k best candidates of a query spectrum, with the same result as scoring all candidates.
+
+    Candidates are scored in rounds of doubling size, in decreasing order of their upper bound (see _upper_bounds),
+    and kept in a heap of at most k entries; once the heap is full, the search stops when no remaining bound can
+    reach its lowest score. Among equal scores the last candidate ranks first, so candidates whose bound equals
+    the lowest kept score are still scored.
+
+    Args:
+        sp (Spectrum): The query spectrum.
+        candidates (list or SpectralLibrary): The candidate spectra.
+        tolerance (float): The allowable mass difference for matching peaks.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+        k (int): The number of candidates to keep.
+
+    Returns:
+        tuple: List of (index, score, number of matched peaks) of the best candidates with a score above 0,
+        best first, and the number of candidates scored.
+    """
+    ref = _as_csr(candidates)
+    query = _as_csr([sp])
+    if (sp.get('precursor_mz') is None):
+        raise ValueError('Precursor_mz missing. Apply `add_precursor_mz` filter first.')
+    n_ref = len(ref[2])-1
+    bound = _upper_bounds(query, ref, np.zeros(n_ref, dtype=np.int64), np.arange(n_ref),
+                          tolerance, mz_power, intensity_power)
+    order = np.argsort(-bound, kind='stable')
+    order = order[bound[order] > 0]
+
+    # min-heap of (score, index, matches): its first entry is the lowest kept candidate
+    heap = []
+    i, size, n_scored = 0, _FIRST_ROUND, 0
+    while (i < len(order)):
+        lowest = heap[0][0] if len(heap) == k else 0.0
+        if (bound[order[i]] * (1 + _SLACK) < lowest):
+            break
+        batch = order[i:i+size]
+        batch = batch[bound[batch] * (1 + _SLACK) >= lowest]
+        score, matches = _modified_cosine_pairs(query, ref, np.zeros(len(batch), dtype=np.int64), batch,
+                                                tolerance, mz_power, intensity_power)
+        n_scored += len(batch)
+        for j in np.flatnonzero(score > 0):
+            _push_bounded(heap, k, (float(score[j]), int(batch[j]), int(matches[j])))
+        i += size
+        size *= 2
+    top = [(idx, score, matches) for score, idx, matches in sorted(heap, reverse=True)]
+    return top, n_scored
+
+
+def _push_bounded(heap, k, item):
+    """
+    Push an item on a min-heap holding the k largest items seen.
+
+    Args:
+        heap (list): The heap.
+        k (int): The maximum size of the heap.
+        item (tuple): The item.
+    """
+    if (len(heap) < k):
+        heapq.heappush(heap, item)
+    elif (item > heap[0]):
+        heapq.heapreplace(heap, item)
+
+
+def _top_scores(score, matches, k):
+    """
+    Select the k best of already computed scores, with the ranking of _top_candidates.
+
+    Args:
+        score (numpy.ndarray): The scores of the candidates.
+        matches (numpy.ndarray): The numbers of matched peaks of the candidates.
+        k (int): The number of candidates to keep.
+
+    Returns:
+        list: List of (index, score, number of matched peaks) of the best candidates with a score above 0, best first.
+    """
+    heap = []
+    for j in np.flatnonzero(score > 0):
+        _push_bounded(heap, k, (float(score[j]), int(j), int(matches[j])))
+    return [(idx, score, matches) for score, idx, matches in sorted(heap, reverse=True)]
+
+
+def _best_candidate(sp, candidates, tolerance, mz_power, intensity_power):
+    """
+    Find the best candidate of a query spectrum, with the same result as scoring all candidates.
+
+    Among equal best scores the last candidate is kept (see _top_candidates).
+
+    Args:
+        sp (Spectrum): The query spectrum.
+        candidates (list or SpectralLibrary): The candidate spectra.
+        tolerance (float): The allowable mass difference for matching peaks.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+
+    Returns:
+        tuple: Index, score and number of matched peaks of the best candidate (index -1 if no score is
+        above 0), and the number of candidates scored.
+    """
+    top, n_scored = _top_candidates(sp, candidates, tolerance, mz_power, intensity_power, 1)
+    best, best_score, best_matches = top[0] if top else (-1, 0.0, 0)
+    return best, best_score, best_matches, n_scored
+
+
+def _score_pairs(query, library, row, col, tolerance, mz_power, intensity_power, max_probes=_MAX_PROBES,
+                 stats=None, score_function=None, return_peaks=False):
+    """
+    Score (query, library entry) pairs in passes of at most max_probes library peaks.
+
+    Each pass only gathers the library entries it needs into memory. Pairs with a malformed spectrum
+    (see _invalid_spectra) are not scored and keep a score of 0.
+
+    Args:
+        query (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the queries.
+        library (SpectralLibrary): The spectral library.
+        row (numpy.ndarray): Query of each pair, in increasing order.
+        col (numpy.ndarray): Library entry of each pair.
+        tolerance (float or tuple): The allowable mass difference for matching peaks, a tuple of tolerances
+            for _modified_cosine_sweep.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+        max_probes (int, optional): Maximum number of library peaks scored in one pass. Defaults to _MAX_PROBES.
+        stats (dict, optional): Counters of malformed spectra, updated like Util.MATCH_STATS. Defaults to None.
+        score_function (callable, optional): Pair scoring function with the signature of _modified_cosine_pairs
+            (see SimilarityBackends). Defaults to None, the modified cosine.
+        return_peaks (bool, optional): Whether to also return the assigned peak pairs, for a score function
+            supporting it (_modified_cosine_pairs). Defaults to False.
+
+    Returns:
+        tuple: Scores and numbers of matched peaks of the pairs (one column per tolerance for a tuple), and with
+        return_peaks the pair, library peak and query peak of each assigned peak pair.
+    """
+    if (score_function is None):
+        score_function = _modified_cosine_pairs
+    n_queries = len(query[2])-1
+    score = np.zeros((len(row),) + np.shape(tolerance))
+    matches = np.zeros((len(row),) + np.shape(tolerance), dtype=np.int64)
+    invalid_query = _invalid_spectra(query)
+    invalid = invalid_query[row]
+    peaks = []
+
+    for a, b in _passes(library, row, col, n_queries, max_probes):
+        needed, pair_ref = np.unique(col[a:b], return_inverse=True)
+        ref = _as_csr(library.take(needed))
+        invalid[a:b] |= _invalid_spectra(ref)[pair_ref.ravel()]
+        ok = a + np.flatnonzero(~invalid[a:b])
+        pair_ref = pair_ref.ravel()[ok-a]
+        if (not return_peaks):
+            score[ok], matches[ok] = score_function(
+                query, ref, row[ok], pair_ref, tolerance, mz_power, intensity_power)
+            continue
+        score[ok], matches[ok], (owner, rpeak, qpeak) = score_function(
+            query, ref, row[ok], pair_ref, tolerance, mz_power, intensity_power, return_peaks=True)
+        # reference peaks are numbered in the library, not in the pass
+        rpeak = np.asarray(library.offsets[col[ok[owner]]]) + rpeak - ref[2][pair_ref[owner]]
+        peaks.append((ok[owner], rpeak, qpeak))
+
+    if (stats is not None):
+        failed = np.bincount(row[invalid], minlength=n_queries) > 0
+        stats['queries'] += len(np.unique(row))
+        stats['candidates'] += len(row)
+        stats['failed_queries'] += int(np.count_nonzero(failed))
+        stats['invalid_candidates'] += int(np.count_nonzero(invalid & ~invalid_query[row]))
+    if (return_peaks):
+        peaks = tuple(np.concatenate([p[k] for p in peaks]).astype(np.int64) if peaks else np.zeros(0, np.int64)
+                      for k in range(3))
+        return score, matches, peaks
+    return score, matches
+
+
+def _rescore_pairs(query, library, row, col, peaks, mz_power, intensity_power, max_probes=_MAX_PROBES):
+    """
+    Score (query, library entry) pairs from their stored peak pairs (see _rescore_peaks), in passes of at most
+    max_probes library peaks.
+
+    Args:
+        query (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the queries.
+        library (SpectralLibrary): The spectral library.
+        row (numpy.ndarray): Query of each pair, in increasing order.
+        col (numpy.ndarray): Library entry of each pair.
+        peaks (tuple): Pair, library peak and query peak of each assigned peak pair, as returned by _score_pairs.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+        max_probes (int, optional): Maximum number of library peaks scored in one pass. Defaults to _MAX_PROBES.
+
+    Returns:
+        tuple: Scores and numbers of matched peaks of the pairs.
+    """
+    pair, rpeak, qpeak = peaks
+    score = np.zeros(len(row))
+    matches = np.zeros(len(row), dtype=np.int64)
+    for a, b in _passes(library, row, col, len(query[2])-1, max_probes):
+        needed, pair_ref = np.unique(col[a:b], return_inverse=True)
+        pair_ref = pair_ref.ravel()
+        ref = _as_csr(library.take(needed))
+        c, d = np.searchsorted(pair, [a, b])
+        owner = pair[c:d] - a
+        local = rpeak[c:d] - np.asarray(library.offsets[col[pair[c:d]]]) + ref[2][pair_ref[owner]]
+        score[a:b], matches[a:b] = _rescore_peaks(query, ref, row[a:b], pair_ref, (owner, local, qpeak[c:d]),
+                                                  mz_power, intensity_power)
+    return score, matches
+
+
+def _passes(library, row, col, n_queries, max_probes):
+    """
+    Cut (query, library entry) pairs into passes of at most max_probes library peaks.
+
+    Passes are cut between queries, a query with more probes than max_probes gets its own pass.
+
+    Args:
+        library (SpectralLibrary): The spectral library.
+        row (numpy.ndarray): Query of each pair, in increasing order.
+        col (numpy.ndarray): Library entry of each pair.
+        n_queries (int): Number of queries.
+        max_probes (int): Maximum number of library peaks in one pass.
+
+    Returns:
+        list: The (start, end) pair bounds of the non-empty passes.
+    """
+    size = np.asarray(library.offsets[col+1] - library.offsets[col])
+    row_probes = np.bincount(row, weights=size, minlength=n_queries)
+    cut = [0]
+    total = 0
+    for q in range(n_queries):
+        if (total != 0) and (total + row_probes[q] > max_probes):
+            cut.append(q)
+            total = 0
+        total += row_probes[q]
+    cut.append(n_queries)
+    bounds = np.searchsorted(row, cut)
+    return ([(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if a != b])
+
+
+def _score_matrix(spectra, library, tolerance, mz_power, intensity_power, max_probes=_MAX_PROBES, prefilter=None,
+                  stats=None, score_function=None):
+    """
+    Score all spectra of a run against a library, restricted to the precursor windows of the spectra.
+
+    The precursor windows of all spectra are selected at once, and the allowed pairs are scored together
+    (see _score_pairs).
+
+    Args:
+        spectra (list): The query spectra.
+        library (SpectralLibrary): The spectral library.
+        tolerance (float): Mass tolerance for precursor selection and peak matching.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+        max_probes (int, optional): Maximum number of library peaks scored in one pass. Defaults to _MAX_PROBES.
+        prefilter (Prefilter, optional): Prefilter pruning the pairs of the precursor windows. Defaults to None.
+        stats (dict, optional): Counters of malformed spectra, updated like Util.MATCH_STATS. Defaults to None.
+        score_function (callable, optional): Pair scoring function (see _score_pairs). Defaults to None.
+
+    Returns:
+        tuple: Scores and numbers of matched peaks as scipy.sparse.csr_matrix of shape (spectra, library),
+        with an explicit entry for every (kept) pair of the precursor windows, in library order in each row.
+    """
+    query = _as_csr(spectra)
+    row, col = library.precursor_index.select_many(query[3], tolerance)
+    if (prefilter is not None):
+        row, col = prefilter.filter_pairs(spectra, library, row, col)
+    score, matches = _score_pairs(query, library, row, col, tolerance, mz_power, intensity_power,
+                                  max_probes, stats, score_function)
+
+    indptr = np.zeros(len(spectra)+1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(row, minlength=len(spectra)))
+    shape = (len(spectra), len(library))
+    return (sparse.csr_matrix((score, col, indptr), shape=shape),
+            sparse.csr_matrix((matches, col, indptr), shape=shape))
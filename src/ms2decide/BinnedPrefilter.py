@@ -0,0 +1,208 @@
+"""
+This module prunes the candidates of a precursor window with cheap binned spectrum vectors, before the
+modified cosine scoring.
+
+Each spectrum is reduced to a sparse vector: peaks are grouped into m/z bins of fixed width, the weight of a bin
+is the sum of the square roots of its intensities, and the vector is L2-normalised. The vectors of a library are
+computed once and stored next to the columns of its cache directory (binned_<width>_*.npy), so later runs only
+memory-map them.
+
+A (query, candidate) pair is scored by the dot product of the two vectors, where each candidate bin is compared
+to the same query bin and to the query bin shifted by the precursor mass difference, keeping the larger of the two;
+this mimics the two kinds of peak matches of the modified cosine. Only the best candidates of each query are kept.
+
+The prefilter is a heuristic: the best modified cosine hit may be pruned. Its `check` mode also runs the
+annotation without the prefilter and reports how often the best hit was preserved.
+
+Typical usage example:
+    prefilter = Prefilter(top_m=20)
+    isdb_res = get_cfm_annotation(mgf, 0.5, prefilter=prefilter)
+    prefilter.report()
+"""
+
+from .BatchScoring import _as_csr, _expand_ranges, _segmented_searchsorted
+from pathlib import Path
+import numpy as np
+import os
+
+# vectors of the opened libraries, {(cache directory, bin width): (bins, weights, offsets)}
+_VECTORS = {}
+
+
+def _bin_spectra(mz, intensities, offsets, bin_width):
+    """
+    Compute the binned vectors of CSR spectra.
+
+    Args:
+        mz (numpy.ndarray): Concatenated m/z values.
+        intensities (numpy.ndarray): Concatenated intensities.
+        offsets (numpy.ndarray): Offsets of the spectra.
+        bin_width (float): Width of the m/z bins.
+
+    Returns:
+        tuple: CSR vectors, as sorted bin numbers, L2-normalised weights and offsets.
+    """
+    owner = np.repeat(np.arange(len(offsets)-1), np.diff(offsets))
+    bins = np.floor(np.asarray(mz) / bin_width).astype(np.int64)
+    order = np.lexsort((bins, owner))
+    owner, bins = owner[order], bins[order]
+    weights = np.asarray(intensities)[order] ** 0.5
+
+    # merge the peaks of one spectrum falling into the same bin
+    first = np.ones(len(bins), dtype=bool)
+    first[1:] = (owner[1:] != owner[:-1]) | (bins[1:] != bins[:-1])
+    group = np.cumsum(first) - 1
+    weights = np.bincount(group, weights=weights, minlength=int(first.sum()))
+    owner, bins = owner[first], bins[first]
+
+    norm = np.sqrt(np.bincount(owner, weights=weights**2, minlength=len(offsets)-1))
+    weights = weights / np.where(norm == 0, 1, norm)[owner]
+    vector_offsets = np.zeros(len(offsets), dtype=np.int64)
+    vector_offsets[1:] = np.cumsum(np.bincount(owner, minlength=len(offsets)-1))
+    return bins, weights, vector_offsets
+
+
+def library_vectors(library, bin_width=1.0):
+    """
+    Get the binned vectors of a library, computing and caching them on first use.
+
+    The vectors are stored in the cache directory of the library; if it is not writable they are only kept in memory.
+
+    Args:
+        library (SpectralLibrary): The spectral library.
+        bin_width (float, optional): Width of the m/z bins. Defaults to 1.0.
+
+    Returns:
+        tuple: CSR vectors of all library entries, as bin numbers, weights and offsets.
+    """
+    key = (str(library.path), float(bin_width))
+    if (key in _VECTORS):
+        return (_VECTORS[key])
+    names = ['binned_' + str(float(bin_width)) + '_' + k + '.npy' for k in ('bins', 'weights', 'offsets')]
+    paths = [Path(library.path) / name for name in names]
+    if all(p.exists() for p in paths):
+        vectors = tuple(np.load(str(p), mmap_mode='r') for p in paths)
+    else:
+        print('==================')
+        print('COMPUTING BINNED VECTORS OF ' + Path(library.path).name)
+        print('==================')
+        vectors = _bin_spectra(library.mz, library.intensities, library.offsets, bin_width)
+        try:
+            for p, v in zip(paths, vectors):
+                tmp = p.with_name(p.stem + '.tmp.npy')
+                np.save(str(tmp), v)
+                os.replace(str(tmp), str(p))
+        except OSError:
+            pass
+    _VECTORS[key] = vectors
+    return (vectors)
+
+
+def _pair_scores(query, ref, pair_query, pair_ref, shift_bins):
+    """
+    Compute the binned scores of (query, reference) pairs.
+
+    Args:
+        query (tuple): CSR vectors (bins, weights, offsets) of the queries.
+        ref (tuple): CSR vectors (bins, weights, offsets) of the references.
+        pair_query (numpy.ndarray): Query of each pair.
+        pair_ref (numpy.ndarray): Reference of each pair.
+        shift_bins (numpy.ndarray): Precursor mass difference of each pair, in bins.
+
+    Returns:
+        numpy.ndarray: The scores of the pairs.
+    """
+    query_bins, query_weights, query_offsets = query
+    ref_bins, ref_weights, ref_offsets = ref
+    probe_pair, probe = _expand_ranges(np.asarray(ref_offsets[pair_ref]), np.asarray(ref_offsets[pair_ref+1]))
+    probe_query = pair_query[probe_pair]
+    values = query_bins.astype(np.float64)
+    best = np.zeros(len(probe))
+    for shift in (np.zeros(len(probe), dtype=np.int64), shift_bins[probe_pair]):
+        b = (np.asarray(ref_bins)[probe] - shift).astype(np.float64)
+        start, stop = _segmented_searchsorted(values, query_offsets, probe_query, b - 0.5, b + 0.5)
+        found = (stop > start)
+        weight = np.zeros(len(probe))
+        weight[found] = query_weights[start[found]]
+        best = np.maximum(best, weight)
+    return (np.bincount(probe_pair, weights=best * np.asarray(ref_weights)[probe], minlength=len(pair_query)))
+
+
+class Prefilter():
+    """
+    Represents a binned-vector prefilter of the candidates of local annotation, with its statistics.
+
+    Attributes:
+        top_m (int): Number of best candidates kept per query, None to keep all candidates above min_score.
+        min_score (float): Minimum binned score of a kept candidate.
+        bin_width (float): Width of the m/z bins.
+        check (bool): Whether to also annotate without the prefilter and count the preserved best hits.
+        stats (dict): Numbers of queries, candidates, kept candidates, checked queries and preserved best hits.
+
+    Example:
+        >>> prefilter = Prefilter(top_m=20)
+        >>> row, col = prefilter.filter_pairs(spectra, library, row, col)
+    """
+
+    def __init__(self, top_m=20, min_score=0.0, bin_width=1.0, check=False):
+        """
+        Initializes a Prefilter.
+
+        Args:
+            top_m (int, optional): Number of best candidates kept per query, None for no limit. Defaults to 20.
+            min_score (float, optional): Minimum binned score of a kept candidate. Defaults to 0.0.
+            bin_width (float, optional): Width of the m/z bins. Defaults to 1.0.
+            check (bool, optional): Whether to count the preserved best hits. Defaults to False.
+        """
+        self.top_m = top_m
+        self.min_score = min_score
+        self.bin_width = bin_width
+        self.check = check
+        self.stats = {'queries': 0, 'candidates': 0, 'kept': 0, 'checked': 0, 'preserved': 0}
+
+    def filter_pairs(self, spectra, library, row, col):
+        """
+        Prune (query, library entry) candidate pairs.
+
+        Args:
+            spectra (list): The query spectra.
+            library (SpectralLibrary): The spectral library, as loaded from its cache (not a subset).
+            row (numpy.ndarray): Query of each candidate pair.
+            col (numpy.ndarray): Library entry of each candidate pair.
+
+        Returns:
+            tuple: Query and library indices of the kept pairs, ordered by query then library index.
+        """
+        self.stats['queries'] += len(spectra)
+        self.stats['candidates'] += len(row)
+        if (len(row) == 0):
+            return row, col
+        mz, intensities, offsets, precursor = _as_csr(spectra)
+        query = _bin_spectra(mz, intensities, offsets, self.bin_width)
+        ref = library_vectors(library, self.bin_width)
+        shift = np.asarray(library.precursor_mz[col]) - precursor[row]
+        shift_bins = np.round(np.nan_to_num(shift) / self.bin_width).astype(np.int64)
+        score = _pair_scores(query, ref, row, col, shift_bins)
+
+        keep = score >= self.min_score
+        if (self.top_m is not None):
+            order = np.lexsort((col, -score, row))
+            first = np.searchsorted(row[order], row[order], side='left')
+            rank = np.empty(len(row), dtype=np.int64)
+            rank[order] = np.arange(len(row)) - first
+            keep &= rank < self.top_m
+        self.stats['kept'] += int(keep.sum())
+        return row[keep], col[keep]
+
+    def report(self):
+        """
+        Print the statistics of the prefilter.
+        """
+        pruned = self.stats['candidates'] - self.stats['kept']
+        print('==================')
+        print('PREFILTER: ' + str(pruned) + ' OF ' + str(self.stats['candidates']) +
+              ' CANDIDATES PRUNED FOR ' + str(self.stats['queries']) + ' SPECTRA')
+        if (self.stats['checked'] != 0):
+            print('BEST HIT PRESERVED FOR ' + str(self.stats['preserved']) + ' OF ' +
+                  str(self.stats['checked']) + ' SPECTRA')
+        print('==================')
@@ -1,8 +1,8 @@
 from .MatchedSpectra import MatchedSpectra
 from .MgfInstance import MgfInstance
-from .Util import path_gnps, Parametres, get_correct_inchi, _mass_selection_by_tolerance, _get_match
-from matchms.importing import load_from_mgf
-from matchms import Spectrum
+from .Util import path_gnps, Parametres, get_correct_inchi
+from .LibraryCache import load_library
+from .LocalAnnotation import _annotate_library, _annotate_library_iterative
 import urllib.request
 import json
 import requests
@@ -537,54 +537,72 @@ def closest_gnps(auth, input_file_mgf, input_file_quan, folder, score_threshold)
     return (matched_spectra_dict)
 
 
-def closest_gnps_local(mgf):
+def closest_gnps_local(mgf, n_jobs=1, sparse=False, prefilter=None, backend='modified_cosine', top_k=None,
+                       cache=None, clustering=None):
     """
     Returns a dictionary of MatchedSpectra objects for the closest matches in GNPS using local processing.
 
     Args:
         mgf : mgfInstance
+        n_jobs (int, optional): Number of worker processes, -1 for all CPUs. Defaults to 1.
+        sparse (bool, optional): Score all spectra in one sparse job instead of one by one. Defaults to False.
+        prefilter (Prefilter, optional): Binned-vector prefilter pruning the candidates before scoring. Defaults to None.
+        backend (str, optional): Similarity backend, see SimilarityBackends. Defaults to 'modified_cosine'.
+        top_k (int, optional): Number of ranked hits kept in MatchedSpectra.ranked. Defaults to None.
+        cache (MatchCache, optional): Persistent cache of the results (see MatchCache). Defaults to None.
+        clustering (QueryClustering, optional): Clustering of near-duplicate query spectra. Defaults to None.
 
     Returns:
         dict: Dictionary {id: MatchedSpectra}.
     """
-    gnps_mass, gnps = _load_gnps()
+    _, gnps = _load_gnps()
     tolerance, mz_power, intensity_power, shift = Parametres()
     print('==================')
     print('==================')
-    RES = {}
-    for i in mgf.data:
-        sp = mgf.data[i]
-        selected = _mass_selection_by_tolerance(sp, gnps_mass, gnps, tolerance)
-        rsp, res = _get_match(sp, selected, tolerance,
-                              mz_power, intensity_power, shift)
-        if (type(rsp) == Spectrum):
-            RES[i] = MatchedSpectra(i, get_correct_inchi(rsp), res[0])
-        else:
-            RES[i] = MatchedSpectra(i, rsp, res)
-    return RES
+    return (_annotate_library(mgf, gnps, tolerance, mz_power, intensity_power, shift, n_jobs, sparse, prefilter,
+                              backend, top_k, cache, clustering))
+
+
+def closest_gnps_iterative_local(mgf, score_threshold=0.001, n_jobs=1):
+    """
+    Returns a dictionary of MatchedSpectra objects for the iterative weighted analog search against a local GNPS library.
+
+    Local counterpart of closest_gnps_iterative: the 27 (MIN_MATCHED_PEAKS, MAX_SHIFT_MASS) settings are derived
+    from one scoring of every candidate pair instead of 27 GNPS jobs, and weighted by _get_iterative_parameters.
+
+    Args:
+        mgf : mgfInstance
+        score_threshold (float, optional): Minimum score of a hit, as SCORE_THRESHOLD of the GNPS jobs. Defaults to 0.001.
+        n_jobs (int, optional): Number of worker processes, -1 for all CPUs. Defaults to 1.
+
+    Returns:
+        dict: Dictionary {id: MatchedSpectra}, as closest_gnps_ietrative_by_id.
+    """
+    _, gnps = _load_gnps()
+    tolerance, mz_power, intensity_power, _ = Parametres()
+    alpha = _get_iterative_parameters()
+    print('==================')
+    print('==================')
+    return (_annotate_library_iterative(mgf, gnps, tolerance, mz_power, intensity_power, alpha, score_threshold,
+                                        n_jobs))
 
 
 def _load_gnps():
     """
     Load GNPS data from an MGF file.
 
-    This function retrieves the path to the GNPS data file, loads the data, and extracts
-    precursor mass information along with the GNPS data objects. It returns a list of
-    precursor masses and a list of GNPS data objects.
+    This function retrieves the path to the GNPS data file, loads the data through its compiled
+    columnar cache (see LibraryCache), and extracts precursor mass information along with the
+    GNPS data objects. It returns the precursor mass index and the memory-mapped library.
 
     Returns:
-        tuple: A tuple containing two lists:
-            - mass (list): A list of precursor m/z values.
-            - gnps (list): A list of GNPS data objects.
+        tuple: A tuple containing:
+            - mass (PrecursorIndex): Sorted index of the precursor m/z values.
+            - gnps (SpectralLibrary): The memory-mapped GNPS data.
     """
     path_data_gnps = path_gnps()
-    gnps_data = load_from_mgf(path_data_gnps)
-    mass = []
-    gnps = []
-    for i in gnps_data:
-        mass.append(i.metadata['precursor_mz'])
-        gnps.append(i)
-    return mass, gnps
+    gnps = load_library(path_data_gnps)
+    return gnps.precursor_index, gnps
 
 
 def closest_gnps_by_id(job_id, mgf_path):
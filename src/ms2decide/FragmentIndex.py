@@ -0,0 +1,193 @@
+"""
+This module generates analog-search candidates from a fragment-ion and neutral-loss inverted index of a library.
+
+With a wide MAX_SHIFT_MASS almost the whole library falls in the precursor window of a feature, so the window
+no longer selects anything. The modified cosine can only assign a library peak that lies within tolerance of a
+query peak, either directly (same fragment m/z) or after the precursor shift (same neutral loss, precursor m/z
+minus fragment m/z). The index holds all fragment m/z and all neutral losses of the library in sorted order;
+the library peaks matchable by a query are found with `numpy.searchsorted` windows, and their number per library
+spectrum bounds the number of matched peaks from above. Only spectra reaching MIN_MATCHED_PEAKS need scoring,
+and no spectrum that could reach it is ever dropped. The hits are expanded for groups of queries of at most
+_MAX_HITS hits, so the memory does not grow with the number of queries searched together.
+
+The index is built once per library and stored next to the columns of its cache directory (fragments_*.npy),
+so later runs only memory-map it.
+
+Typical usage example:
+    index = fragment_index(gnps)
+    row, col = index.candidates(query, 0.02, 4)
+"""
+
+from .BatchScoring import _expand_ranges
+from pathlib import Path
+import numpy as np
+import os
+
+# margin added to the searchsorted bounds, covers the rounding of the neutral losses
+_MARGIN = 1e-6
+# indices of the opened libraries, {cache directory: FragmentIndex}
+_INDICES = {}
+_COLUMNS = ['fragment_order', 'fragment_sorted', 'loss_order', 'loss_sorted']
+# maximum number of library peak hits expanded at once by candidates (a single query may exceed it)
+_MAX_HITS = 1 << 22
+
+
+class FragmentIndex():
+    """
+    Represents a sorted inverted index over the fragment m/z and neutral losses of a spectral library.
+
+    Attributes:
+        offsets (numpy.ndarray): Offsets of the library peaks, to map a peak to its spectrum.
+        fragment_order (numpy.ndarray): Library peaks sorted by m/z.
+        fragment_sorted (numpy.ndarray): Sorted fragment m/z values.
+        loss_order (numpy.ndarray): Library peaks sorted by neutral loss.
+        loss_sorted (numpy.ndarray): Sorted neutral losses (NaN for spectra without precursor m/z, at the end).
+
+    Example:
+        >>> index = FragmentIndex.build(library)
+        >>> row, col = index.candidates((mz, intensities, offsets, precursor), 0.02, 4)
+    """
+
+    def __init__(self, offsets, fragment_order, fragment_sorted, loss_order, loss_sorted):
+        """
+        Initializes a FragmentIndex.
+
+        Args:
+            offsets (numpy.ndarray): Offsets of the library peaks.
+            fragment_order (numpy.ndarray): Library peaks sorted by m/z.
+            fragment_sorted (numpy.ndarray): Sorted fragment m/z values.
+            loss_order (numpy.ndarray): Library peaks sorted by neutral loss.
+            loss_sorted (numpy.ndarray): Sorted neutral losses.
+        """
+        self.offsets = offsets
+        self.fragment_order = fragment_order
+        self.fragment_sorted = fragment_sorted
+        self.loss_order = loss_order
+        self.loss_sorted = loss_sorted
+
+    @staticmethod
+    def build(library):
+        """
+        Build the index of a library.
+
+        Args:
+            library (SpectralLibrary): The spectral library.
+
+        Returns:
+            FragmentIndex: The index.
+        """
+        mz = np.asarray(library.mz)
+        offsets = np.asarray(library.offsets)
+        precursor = np.asarray(library.precursor_mz)
+        loss = np.repeat(precursor, np.diff(offsets)) - mz
+        fragment_order = np.argsort(mz, kind='stable')
+        loss_order = np.argsort(loss, kind='stable')
+        return (FragmentIndex(offsets, fragment_order, mz[fragment_order], loss_order, loss[loss_order]))
+
+    def _windows(self, sorted_values, values, tolerance):
+        """
+        Find the range of sorted library values within tolerance of each value.
+
+        Args:
+            sorted_values (numpy.ndarray): The sorted values.
+            values (numpy.ndarray): The query values.
+            tolerance (float): The allowed deviation.
+
+        Returns:
+            tuple: Start and stop positions in sorted_values of each query value.
+        """
+        low = np.searchsorted(sorted_values, values - tolerance - _MARGIN, side='left')
+        high = np.searchsorted(sorted_values, values + tolerance + _MARGIN, side='right')
+        high = np.where(np.isnan(values), low, np.maximum(high, low))
+        return low, high
+
+    def _groups(self, hits):
+        """
+        Split the queries into consecutive groups of at most _MAX_HITS hits.
+
+        Args:
+            hits (numpy.ndarray): Number of hits of each query.
+
+        Returns:
+            list: Bounds of the groups, from 0 to the number of queries.
+        """
+        cumulative = np.concatenate(([0], np.cumsum(hits)))
+        bounds = [0]
+        while (bounds[-1] < len(hits)):
+            stop = int(np.searchsorted(cumulative, cumulative[bounds[-1]] + _MAX_HITS, side='right')) - 1
+            bounds.append(max(stop, bounds[-1] + 1))
+        return (bounds)
+
+    def candidates(self, query, tolerance, min_peaks):
+        """
+        Select the library spectra with at least min_peaks peaks matchable by each query.
+
+        Args:
+            query (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the queries.
+            tolerance (float): The allowable mass difference for matching peaks.
+            min_peaks (int): The minimum number of matched peaks (MIN_MATCHED_PEAKS).
+
+        Returns:
+            tuple: Query and library indices of the candidate pairs, ordered by query then library index.
+        """
+        mz, _, offsets, precursor = query
+        n_queries = len(offsets)-1
+        owner = np.repeat(np.arange(n_queries), np.diff(offsets))
+        loss = precursor[owner] - mz
+        low0, high0 = self._windows(self.fragment_sorted, mz, tolerance)
+        low1, high1 = self._windows(self.loss_sorted, loss, tolerance)
+        hits = np.bincount(owner, weights=(high0-low0) + (high1-low1), minlength=n_queries)
+
+        n_peaks = max(1, int(self.offsets[-1]))
+        n_spectra = max(1, len(self.offsets)-1)
+        rows, cols = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        bounds = self._groups(hits)
+        for q0, q1 in zip(bounds[:-1], bounds[1:]):
+            p0, p1 = offsets[q0], offsets[q1]
+            peak0, position0 = _expand_ranges(low0[p0:p1], high0[p0:p1])
+            peak1, position1 = _expand_ranges(low1[p0:p1], high1[p0:p1])
+            peak = np.concatenate((peak0, peak1)) + p0
+            hit = np.concatenate((np.asarray(self.fragment_order[position0]), np.asarray(self.loss_order[position1])))
+            # a library peak counts once per query, whichever query peaks and kinds of match reach it
+            key = np.unique(owner[peak] * n_peaks + hit)
+            row, library_peak = np.divmod(key, n_peaks)
+            col = np.searchsorted(self.offsets, library_peak, side='right') - 1
+            pair, count = np.unique(row * n_spectra + col, return_counts=True)
+            row, col = np.divmod(pair[count >= min_peaks], n_spectra)
+            rows.append(row)
+            cols.append(col)
+        return np.concatenate(rows), np.concatenate(cols)
+
+
+def fragment_index(library):
+    """
+    Get the fragment index of a library, building and caching it on first use.
+
+    The index is stored in the cache directory of the library; if it is not writable it is only kept in memory.
+
+    Args:
+        library (SpectralLibrary): The spectral library, as loaded from its cache (not a subset).
+
+    Returns:
+        FragmentIndex: The index.
+    """
+    key = str(library.path)
+    if (key in _INDICES):
+        return (_INDICES[key])
+    paths = [Path(library.path) / ('fragments_' + k + '.npy') for k in _COLUMNS]
+    if all(p.exists() for p in paths):
+        index = FragmentIndex(library.offsets, *[np.load(str(p), mmap_mode='r') for p in paths])
+    else:
+        print('==================')
+        print('BUILDING FRAGMENT INDEX OF ' + Path(library.path).name)
+        print('==================')
+        index = FragmentIndex.build(library)
+        try:
+            for p, k in zip(paths, _COLUMNS):
+                tmp = p.with_name(p.stem + '.tmp.npy')
+                np.save(str(tmp), getattr(index, k))
+                os.replace(str(tmp), str(p))
+        except OSError:
+            pass
+    _INDICES[key] = index
+    return (index)
@@ -0,0 +1,233 @@
+"""
+This module re-annotates an MgfInstance incrementally, scoring only the scans added or changed since the
+previous run.
+
+An IncrementalRun stores, for each annotation tool, the MatchedSpectra of every scan together with the content
+hash of its spectrum (see MatchCache.spectrum_hash), and the signature of the run that computed them: the
+annotation function, its parameters (tolerance, powers, backend...) and the hash of the library. A new MGF is
+diffed against it by scan number and hash: only the added or changed scans are annotated, the others reuse their
+stored MatchedSpectra, and removed scans are dropped. When the signature changes, as MatchCache keys its rows,
+none of the stored rows of the tool are reused. The rows of MultipleSourceAnnotation are stored with the tool annotations they were computed from, so
+only the rows whose annotations changed (including SIRIUS ones) are recomputed.
+
+The run is saved as a pickle file next to the results of the project.
+
+Typical usage example:
+    run = IncrementalRun.load('run.pkl')
+    isdb_res = run.annotate(mgf, 'ISDB', lambda m: get_cfm_annotation_GUI(path_isdb_mgf, m, tol=0.02),
+                            parameters={'tol': 0.02}, library=path_isdb_mgf)
+    gnps_res = run.annotate(mgf, 'GNPS', closest_gnps_local, library=path_gnps())
+    results = run.multiple_source_annotation(mgf, True, True, True, gnps_res, sirius_res, isdb_res, 'Matching')
+    run.save('run.pkl')
+"""
+
+from .MultipleSourceAnnotation import MultipleSourceAnnotation
+from .MatchCache import spectrum_hash, library_id
+from .LibraryCache import _file_signature
+from pathlib import Path
+import pickle
+import json
+import copy
+import os
+
+_RUN_VERSION = 2
+
+
+def _signature(annotate, parameters, library):
+    """
+    Compute the signature of the annotation run of a tool.
+
+    Args:
+        annotate (callable): Annotation function of the tool.
+        parameters (dict): Parameters of the annotation, including those the function closes over.
+        library (SpectralLibrary or str or Path): The spectral library, or the path to its MGF file, or None.
+
+    Returns:
+        str: The signature.
+    """
+    function = getattr(annotate, 'func', annotate)
+    name = str(getattr(function, '__module__', '')) + '.' + str(getattr(function, '__qualname__', function))
+    if (library is None):
+        source = None
+    elif (isinstance(library, (str, Path))):
+        signature = _file_signature(library)
+        source = str(signature['hash']) + ':' + str(signature['size'])
+    else:
+        source = library_id(library)
+    return (json.dumps([name, parameters, source], sort_keys=True, default=str))
+
+
+class IncrementalRun():
+    """
+    Represents the stored annotations of a previous run.
+
+    Attributes:
+        tools (dict): Stored annotations of each tool, {tool: {scan: (hash, MatchedSpectra)}}.
+        signatures (dict): Signature of the run that computed the stored annotations of each tool.
+        estimators (dict): Stored rows of MultipleSourceAnnotation, {estimator: {scan: (annotations, result)}}.
+
+    Example:
+        >>> run = IncrementalRun.load('run.pkl')
+        >>> isdb_res = run.annotate(mgf, 'ISDB', annotate_isdb)
+    """
+
+    def __init__(self, tools=None, estimators=None, signatures=None):
+        """
+        Initializes an IncrementalRun.
+
+        Args:
+            tools (dict, optional): Stored annotations of each tool. Defaults to None (empty).
+            estimators (dict, optional): Stored rows of MultipleSourceAnnotation. Defaults to None (empty).
+            signatures (dict, optional): Signature of the stored annotations of each tool. Defaults to None (empty).
+        """
+        self.tools = {} if tools is None else tools
+        self.estimators = {} if estimators is None else estimators
+        self.signatures = {} if signatures is None else signatures
+
+    @staticmethod
+    def load(path):
+        """
+        Load a run, or start an empty one if the file does not exist.
+
+        Args:
+            path (str or Path): Path of the run file.
+
+        Returns:
+            IncrementalRun: The run.
+        """
+        if (not Path(path).exists()):
+            return (IncrementalRun())
+        with open(str(path), 'rb') as f:
+            state = pickle.load(f)
+        if (state.get('version') != _RUN_VERSION):
+            return (IncrementalRun())
+        return (IncrementalRun(state['tools'], state['estimators'], state['signatures']))
+
+    def save(self, path):
+        """
+        Save the run.
+
+        Args:
+            path (str or Path): Path of the run file.
+        """
+        tmp = str(path) + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump({'version': _RUN_VERSION, 'tools': self.tools, 'estimators': self.estimators,
+                         'signatures': self.signatures}, f)
+        os.replace(tmp, str(path))
+
+    def _stored(self, tool, signature):
+        """
+        Get the stored annotations of a tool, if they were computed by a run with the same signature.
+
+        Args:
+            tool (str): Name of the tool.
+            signature (str): Signature of the new run, None to skip the check.
+
+        Returns:
+            dict: The stored annotations, {scan: (hash, MatchedSpectra)}, empty when the signature changed.
+        """
+        if (signature is not None) and (self.signatures.get(tool) != signature):
+            return ({})
+        return (self.tools.get(tool, {}))
+
+    def diff(self, mgf, tool, signature=None):
+        """
+        Compare the scans of an MgfInstance with the stored annotations of a tool.
+
+        Args:
+            mgf (MgfInstance): The new MgfInstance.
+            tool (str): Name of the tool.
+            signature (str, optional): Signature of the new run (see _signature); when it differs from the stored
+                one, all scans are added. Defaults to None (not checked).
+
+        Returns:
+            tuple: Lists of the added, changed and removed scans, and the hash of every scan of mgf.
+        """
+        stored = self._stored(tool, signature)
+        hashes = {i: spectrum_hash(sp) for i, sp in mgf.data.items()}
+        added = [i for i in mgf.data if i not in stored]
+        changed = [i for i in mgf.data if (i in stored) and (stored[i][0] != hashes[i])]
+        removed = [i for i in stored if i not in mgf.data]
+        return added, changed, removed, hashes
+
+    def annotate(self, mgf, tool, annotate, parameters=None, library=None):
+        """
+        Annotate the added and changed scans of an MgfInstance with a tool, reusing the stored annotations of a
+        run with the same function, parameters and library.
+
+        Args:
+            mgf (MgfInstance): The new MgfInstance.
+            tool (str): Name of the tool.
+            annotate (callable): Annotation function of the tool, called with an MgfInstance holding only the
+                scans to annotate and returning a dictionary {scan: MatchedSpectra}.
+            parameters (dict, optional): Parameters of the annotation (tolerance, mz_power, intensity_power,
+                backend...), including those annotate closes over. Defaults to None.
+            library (SpectralLibrary or str or Path, optional): The spectral library, or the path to its MGF file.
+                Defaults to None.
+
+        Returns:
+            dict: Dictionary {scan: MatchedSpectra} for all scans of mgf.
+        """
+        signature = _signature(annotate, parameters, library)
+        if (tool in self.signatures) and (self.signatures[tool] != signature):
+            print('==================')
+            print(tool + ': PARAMETERS OR LIBRARY CHANGED, STORED ANNOTATIONS DROPPED')
+            print('==================')
+        added, changed, removed, hashes = self.diff(mgf, tool, signature)
+        print('==================')
+        print(tool + ': ' + str(len(added)) + ' ADDED, ' + str(len(changed)) + ' CHANGED, ' + str(len(removed)) +
+              ' REMOVED OF ' + str(len(mgf.data)) + ' SPECTRA')
+        print('==================')
+        stale = set(added) | set(changed)
+        res = {}
+        if (len(stale) != 0):
+            subset = copy.copy(mgf)
+            subset.data = {i: sp for i, sp in mgf.data.items() if i in stale}
+            res = annotate(subset)
+        stored = self._stored(tool, signature)
+        self.tools[tool] = {i: (hashes[i], res[i] if i in stale else stored[i][1]) for i in mgf.data}
+        self.signatures[tool] = signature
+        return {i: self.tools[tool][i][1] for i in mgf.data}
+
+    def multiple_source_annotation(self, mgf_instance, get_gnps, get_sirius, get_isdb, gnps_res, sirius_res,
+                                   isdb_res, estimator, structure_cache=None):
+        """
+        Get the aggregated annotations of MultipleSourceAnnotation, recomputing only the rows whose tool
+        annotations changed.
+
+        Args:
+            mgf_instance (MgfInstance): Instance of MgfInstance containing spectra data.
+            get_gnps (bool): Flag to determine whether to get GNPS annotation.
+            get_sirius (bool): Flag to determine whether to get Sirius annotation.
+            get_isdb (bool): Flag to determine whether to get ISDB-Lotus annotation.
+            gnps_res (dict): Result of GNPS annotation.
+            sirius_res (SiriusAnnotation): Result of Sirius annotation.
+            isdb_res (dict): Result of ISDB-Lotus annotation.
+            estimator (str): ['ConvEval', 'Matching', 'K', 'K_old']
+            structure_cache (str or Path, optional): JSON file of structure normalisations shared across runs (see
+                MultipleSourceAnnotation). Defaults to None.
+
+        Returns:
+            dict: Dictionary containing combined annotations for each spectrum ID.
+        """
+        tools = []
+        if (get_gnps == True) and (gnps_res != None):
+            tools.append(gnps_res)
+        if (get_sirius == True) and (sirius_res != None):
+            tools.append(sirius_res.data)
+        if (get_isdb == True) and (isdb_res != None):
+            tools.append(isdb_res)
+        annotations = {i: tuple((res[i].inchi, res[i].score) for res in tools) for i in mgf_instance.data}
+        stored = self.estimators.get(estimator, {})
+        scans = [i for i in mgf_instance.data if (i not in stored) or (stored[i][0] != annotations[i])]
+        print('==================')
+        print(estimator + ': ' + str(len(scans)) + ' OF ' + str(len(mgf_instance.data)) + ' ROWS RECOMPUTED')
+        print('==================')
+        data = MultipleSourceAnnotation(mgf_instance, get_gnps, get_sirius, get_isdb, gnps_res, sirius_res, isdb_res,
+                                        estimator, scans, structure_cache)
+        if (data is None):
+            return (data)
+        self.estimators[estimator] = {i: (annotations[i], data[i] if i in data else stored[i][1])
+                                      for i in mgf_instance.data}
+        return {i: self.estimators[estimator][i][1] for i in mgf_instance.data}
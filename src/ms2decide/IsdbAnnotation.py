@@ -12,9 +12,15 @@ Functions:
 
     3. _load_isdb:
        Loads the ISDB-Lotus data from the specified file based on the ion mode (positive or negative) and organizes it by precursor mass for easy lookup.
+       The library is read through its compiled columnar cache (see LibraryCache), which is built on first use,
+       and memory-mapped as a SpectralLibrary.
+
+    4. get_cfm_annotation_sweep_GUI:
+       Returns ISDB-Lotus annotations at several mass tolerances, scoring the features once at the widest one.
 
 Classes and Libraries Used:
     - MatchedSpectra: Represents the matched spectra for a given spectrum ID.
+    - _annotate_library: Matches every spectrum against the library, optionally on several worker processes.
     - Parametres: Provides parameters such as mass tolerance, mz_power, intensity_power, and shift used in the matching process.
     - matchms.Spectrum: Represents a mass spectrum from the `matchms` library.
     - numpy (np): Used for handling numerical data like arrays.
@@ -23,11 +29,9 @@ Typical usage example:
     annotations = get_cfm_annotation(mgf_instance)
 """
 
-from .MatchedSpectra import MatchedSpectra
-from .Util import path_isdb, Parametres, get_correct_inchi, _mass_selection_by_tolerance, _get_match, _downolad_file
-from matchms.importing import load_from_mgf
-from matchms import Spectrum
-import numpy as np
+from .Util import path_isdb, Parametres, _downolad_file
+from .LibraryCache import load_library
+from .LocalAnnotation import _annotate_library, _annotate_library_sweep
 import os
 import sys
 current = os.path.dirname(os.path.realpath('__file__'))
@@ -35,12 +39,21 @@ parent = os.path.dirname(current)
 sys.path.append(parent)
 
 
-def get_cfm_annotation(mgf_instance, tol):
+def get_cfm_annotation(mgf_instance, tol, n_jobs=1, sparse=False, prefilter=None, backend='modified_cosine',
+                       top_k=None, cache=None, clustering=None):
     """
     Returns ISDB-Lotus annotations based on ISDB-Lotus subdivision.
 
     Args:
         mgf_instance (MgfInstance): An instance of MgfInstance containing Mass Spectrometry data.
+        tol (float): Mass tolerance for ISDB-Lotus annotation.
+        n_jobs (int, optional): Number of worker processes, -1 for all CPUs. Defaults to 1.
+        sparse (bool, optional): Score all spectra in one sparse job instead of one by one. Defaults to False.
+        prefilter (Prefilter, optional): Binned-vector prefilter pruning the candidates before scoring. Defaults to None.
+        backend (str, optional): Similarity backend, see SimilarityBackends. Defaults to 'modified_cosine'.
+        top_k (int, optional): Number of ranked hits kept in MatchedSpectra.ranked. Defaults to None.
+        cache (MatchCache, optional): Persistent cache of the results (see MatchCache). Defaults to None.
+        clustering (QueryClustering, optional): Clustering of near-duplicate query spectra. Defaults to None.
 
     Returns:
         dict: A dictionary where the key is the spectrum ID and the value is a MatchedSpectra object with ISDB-Lotus annotation.
@@ -48,42 +61,39 @@ def get_cfm_annotation(mgf_instance, tol):
     ion_mode = input(
         'SELECT ION MODE FOR ISDB-LOTUS ANNOTATION (POS for positive and NEG for negative)')
     ion_mode = ion_mode.lower()
-    return (_get_cfm_annotation(mgf_instance, ion_mode, tol))
+    return (_get_cfm_annotation(mgf_instance, ion_mode, tol, n_jobs, sparse, prefilter, backend, top_k, cache,
+                                clustering))
 
 
-def _get_cfm_annotation(mgf, ion_mode, tol):
+def _get_cfm_annotation(mgf, ion_mode, tol, n_jobs=1, sparse=False, prefilter=None, backend='modified_cosine',
+                        top_k=None, cache=None, clustering=None):
     """
     Internal function to get ISDB-Lotus annotations for the given MGF instance.
 
     Args:
         mgf (MgfInstance): An instance of MgfInstance containing spectra data.
         ion_mode (str, optional): Specifies the ionization mode ('pos' for positive, 'neg' for negative). Defaults to 'pos'.
+        tol (float): Mass tolerance for ISDB-Lotus annotation.
+        n_jobs (int, optional): Number of worker processes, -1 for all CPUs. Defaults to 1.
+        sparse (bool, optional): Score all spectra in one sparse job instead of one by one. Defaults to False.
+        prefilter (Prefilter, optional): Binned-vector prefilter pruning the candidates before scoring. Defaults to None.
+        backend (str, optional): Similarity backend, see SimilarityBackends. Defaults to 'modified_cosine'.
+        top_k (int, optional): Number of ranked hits kept in MatchedSpectra.ranked. Defaults to None.
+        cache (MatchCache, optional): Persistent cache of the results (see MatchCache). Defaults to None.
+        clustering (QueryClustering, optional): Clustering of near-duplicate query spectra. Defaults to None.
 
     Returns:
         dict: A dictionary where the key is the spectrum ID and the value is a MatchedSpectra object with ISDB-Lotus annotation.
     """
-    isdb_mass, isdb = _load_isdb(ion_mode)
+    _, isdb = _load_isdb(ion_mode)
     tolerance, mz_power, intensity_power, shift = Parametres()
     tolerance = tol
 
     print('==================')
     print('cfm file is loaded')
     print('==================')
-    RES = {}
-    for i in mgf.data:
-        sp = mgf.data[i]
-        selected = _mass_selection_by_tolerance(sp, isdb_mass, isdb, tolerance)
-        rsp, res = _get_match(sp, selected, tolerance,
-                              mz_power, intensity_power, shift)
-        if (type(rsp) == Spectrum):
-            if (type(res) == np.ndarray):
-                res = float(res['score'])
-            else:
-                res = res[0]
-            RES[i] = MatchedSpectra(i, get_correct_inchi(rsp), res)
-        else:
-            RES[i] = MatchedSpectra(i, rsp, res)
-    return RES
+    return (_annotate_library(mgf, isdb, tolerance, mz_power, intensity_power, shift, n_jobs, sparse, prefilter,
+                              backend, top_k, cache, clustering))
 
 
 def _load_isdb(ion_mode):
@@ -94,41 +104,36 @@ def _load_isdb(ion_mode):
         ion_mode (str): The ionization mode ('pos' for positive, 'neg' for negative).
 
     Returns:
-        tuple: A tuple containing two lists:
-            - mass (list): Precursor masses from the ISDB-Lotus data.
-            - isdb (list): List of ISDB-Lotus spectra.
+        tuple: A tuple containing:
+            - mass (PrecursorIndex): Sorted index of the precursor masses from the ISDB-Lotus data.
+            - isdb (SpectralLibrary): The memory-mapped ISDB-Lotus spectra.
     """
     path_isdb_data = path_isdb(ion_mode)
-    isdb_data = load_from_mgf(str(path_isdb_data))
-    mass = []
-    isdb = []
-    for i in isdb_data:
-        mass.append(i.metadata['precursor_mz'])
-        isdb.append(i)
-    return mass, isdb
+    isdb = load_library(path_isdb_data)
+    return isdb.precursor_index, isdb
 
 
-def get_cfm_annotation_GUI(path_isdb, mgf, ion_mode='pos', tol=0.02):
+def get_cfm_annotation_GUI(path_isdb, mgf, ion_mode='pos', tol=0.02, n_jobs=1, sparse=False, prefilter=None,
+                           backend='modified_cosine', top_k=None, cache=None, clustering=None):
     """
     Internal function to get ISDB-Lotus annotations for the given MGF instance.
 
     Args:
         mgf (MgfInstance): An instance of MgfInstance containing spectra data.
         ion_mode (str, optional): Specifies the ionization mode ('pos' for positive, 'neg' for negative). Defaults to 'pos'.
+        tol (float, optional): Mass tolerance for ISDB-Lotus annotation. Defaults to 0.02.
+        n_jobs (int, optional): Number of worker processes, -1 for all CPUs. Defaults to 1.
+        sparse (bool, optional): Score all spectra in one sparse job instead of one by one. Defaults to False.
+        prefilter (Prefilter, optional): Binned-vector prefilter pruning the candidates before scoring. Defaults to None.
+        backend (str, optional): Similarity backend, see SimilarityBackends. Defaults to 'modified_cosine'.
+        top_k (int, optional): Number of ranked hits kept in MatchedSpectra.ranked. Defaults to None.
+        cache (MatchCache, optional): Persistent cache of the results (see MatchCache). Defaults to None.
+        clustering (QueryClustering, optional): Clustering of near-duplicate query spectra. Defaults to None.
 
     Returns:
         dict: A dictionary where the key is the spectrum ID and the value is a MatchedSpectra object with ISDB-Lotus annotation.
     """
-    if (str(path_isdb)[-4:] != '.mgf'):
-        tool = 'isdb_'+ion_mode
-        _downolad_file(path_isdb, tool)
-        path_isdb = str(path_isdb)+'\\'+tool+'.mgf'
-    isdb_data = load_from_mgf(str(path_isdb))
-    isdb_mass = []
-    isdb = []
-    for i in isdb_data:
-        isdb_mass.append(i.metadata['precursor_mz'])
-        isdb.append(i)
+    isdb = _load_isdb_GUI(path_isdb, ion_mode)
 
     tolerance, mz_power, intensity_power, shift = Parametres()
     tolerance = tol
@@ -136,18 +141,51 @@ def get_cfm_annotation_GUI(path_isdb, mgf, ion_mode='pos', tol=0.02):
     print('==================')
     print('cfm file is loaded')
     print('==================')
-    RES = {}
-    for i in mgf.data:
-        sp = mgf.data[i]
-        selected = _mass_selection_by_tolerance(sp, isdb_mass, isdb, tolerance)
-        rsp, res = _get_match(sp, selected, tolerance,
-                              mz_power, intensity_power, shift)
-        if (type(rsp) == Spectrum):
-            if (type(res) == np.ndarray):
-                res = float(res['score'])
-            else:
-                res = res[0]
-            RES[i] = MatchedSpectra(i, get_correct_inchi(rsp), res)
-        else:
-            RES[i] = MatchedSpectra(i, rsp, res)
-    return RES
+    return (_annotate_library(mgf, isdb, tolerance, mz_power, intensity_power, shift, n_jobs, sparse, prefilter,
+                              backend, top_k, cache, clustering))
+
+
+def get_cfm_annotation_sweep_GUI(path_isdb, mgf, ion_mode='pos', tolerances=(0.01, 0.02, 0.05, 0.1), n_jobs=1,
+                                 top_k=None):
+    """
+    Get ISDB-Lotus annotations for the given MGF instance at several mass tolerances.
+
+    The candidates and matched peaks are computed once at the widest tolerance and the best hit at each
+    tolerance is derived from them, so a sweep costs about one annotation run (see _annotate_library_sweep).
+
+    Args:
+        path_isdb (str): Path of the ISDB-Lotus MGF file, or of the folder to download it into.
+        mgf (MgfInstance): An instance of MgfInstance containing spectra data.
+        ion_mode (str, optional): Specifies the ionization mode ('pos' for positive, 'neg' for negative). Defaults to 'pos'.
+        tolerances (tuple, optional): Mass tolerances for ISDB-Lotus annotation. Defaults to (0.01, 0.02, 0.05, 0.1).
+        n_jobs (int, optional): Number of worker processes, -1 for all CPUs. Defaults to 1.
+        top_k (int, optional): Number of ranked hits kept in MatchedSpectra.ranked. Defaults to None.
+
+    Returns:
+        dict: A dictionary {tolerance: {scan: MatchedSpectra}} with the ISDB-Lotus annotation at each tolerance.
+    """
+    isdb = _load_isdb_GUI(path_isdb, ion_mode)
+    _, mz_power, intensity_power, _ = Parametres()
+
+    print('==================')
+    print('cfm file is loaded')
+    print('==================')
+    return (_annotate_library_sweep(mgf, isdb, tolerances, mz_power, intensity_power, n_jobs, top_k))
+
+
+def _load_isdb_GUI(path_isdb, ion_mode):
+    """
+    Loads ISDB-Lotus data from a given path, downloading it first if the path is a folder.
+
+    Args:
+        path_isdb (str): Path of the ISDB-Lotus MGF file, or of the folder to download it into.
+        ion_mode (str): The ionization mode ('pos' for positive, 'neg' for negative).
+
+    Returns:
+        SpectralLibrary: The memory-mapped ISDB-Lotus spectra.
+    """
+    if (str(path_isdb)[-4:] != '.mgf'):
+        tool = 'isdb_'+ion_mode
+        _downolad_file(path_isdb, tool)
+        path_isdb = str(path_isdb)+'\\'+tool+'.mgf'
+    return (load_library(path_isdb))
@@ -0,0 +1,275 @@
+"""
+This module compiles spectral library MGF files (ISDB-LOTUS, ALL_GNPS) into a columnar on-disk cache.
+
+Parsing a multi-GB library with `matchms.importing.load_from_mgf` takes minutes. The compile step
+parses the MGF once and stores peaks, precursor m/z and structure metadata as flat NumPy/JSON columns
+in a directory next to the MGF file. Later loads read the columns back in seconds.
+
+The cache is keyed by the size and the BLAKE2b hash of the source MGF; it is rebuilt automatically
+when the source file changes. Columns are plain .npy files so that they can be memory-mapped and
+shared between processes (see SpectralLibrary).
+
+Cache layout (directory `<library>.ms2decide`):
+    - source.json: cache version, size and hash of the source MGF.
+    - mz.npy, intensities.npy: all peaks of the library, concatenated.
+    - offsets.npy: peaks of spectrum i are mz[offsets[i]:offsets[i+1]].
+    - precursor_mz.npy: precursor m/z of each spectrum (NaN when missing).
+    - precursor_order.npy, precursor_sorted.npy: stable argsort of precursor_mz and the sorted values.
+    - meta_<key>.npy, meta_<key>_offsets.npy: one UTF-8 string column per key of `_METADATA_KEYS`,
+      missing values are stored as a single NUL character.
+    - meta_canonical_inchi, meta_inchikey: string columns of the structure of each entry, precomputed with a
+      process pool: the InChI returned by Util.get_correct_inchi (missing when it raises) and its InChIKey
+      (missing when the InChI is not its own canonical form, so that it can stand for Util.normalise_structure).
+    - fingerprints.npy: 2048-bit Morgan fingerprint (radius 2) of each entry packed by Util.pack_fingerprint, as 32
+      little-endian uint64 words per row, zero when the entry has no structure.
+
+Typical usage example:
+    isdb = load_library(path_isdb('pos'))
+"""
+
+from .SpectralLibrary import SpectralLibrary, _METADATA_KEYS, _FINGERPRINT_WORDS
+from .Util import get_correct_inchi, pack_fingerprint
+from concurrent.futures import ProcessPoolExecutor
+from matchms.importing import load_from_mgf
+from rdkit import Chem
+from rdkit.Chem import AllChem
+from pathlib import Path
+import numpy as np
+import warnings
+import hashlib
+import shutil
+import json
+import os
+
+CACHE_VERSION = 4
+_HASH_BLOCK = 1 << 20
+# number of entries sent at once to a worker process computing structures
+_STRUCTURE_CHUNK = 512
+
+
+def _file_signature(path_mgf):
+    """
+    Compute the signature of a library MGF file.
+
+    Args:
+        path_mgf (str or Path): The path to the MGF file.
+
+    Returns:
+        dict: Size in bytes and BLAKE2b hex digest of the file.
+    """
+    h = hashlib.blake2b()
+    with open(str(path_mgf), 'rb') as f:
+        block = f.read(_HASH_BLOCK)
+        while block:
+            h.update(block)
+            block = f.read(_HASH_BLOCK)
+    return ({'size': os.path.getsize(str(path_mgf)), 'hash': h.hexdigest()})
+
+
+def cache_path(path_mgf):
+    """
+    Get the cache directory of a library MGF file.
+
+    Args:
+        path_mgf (str or Path): The path to the MGF file.
+
+    Returns:
+        Path: The cache directory, next to the MGF file.
+    """
+    return (Path(path_mgf).with_suffix('.ms2decide'))
+
+
+def _read_source(cache_dir):
+    """
+    Read the source description of a cache directory.
+
+    Args:
+        cache_dir (Path): The cache directory.
+
+    Returns:
+        dict: The content of source.json, or None if the cache is missing or unreadable.
+    """
+    try:
+        with open(str(Path(cache_dir) / 'source.json'), 'r') as f:
+            return (json.load(f))
+    except (OSError, ValueError):
+        return (None)
+
+
+def _is_valid_cache(cache_dir, signature):
+    """
+    Check that a cache directory was compiled from a source with the given signature.
+
+    Args:
+        cache_dir (Path): The cache directory.
+        signature (dict): The signature of the source MGF file.
+
+    Returns:
+        bool: True if the cache can be used.
+    """
+    source = _read_source(cache_dir)
+    if (source is None):
+        return (False)
+    return ((source.get('version') == CACHE_VERSION) and
+            (source.get('size') == signature['size']) and
+            (source.get('hash') == signature['hash']))
+
+
+def _save_strings(cache_dir, name, values):
+    """
+    Save a string column as a UTF-8 byte blob and an offsets array.
+
+    Args:
+        cache_dir (Path): The cache directory.
+        name (str): The column name.
+        values (list): The column values, None for missing values.
+    """
+    encoded = [('\x00' if v is None else v).encode('utf-8') for v in values]
+    offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(v) for v in encoded])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    np.save(str(Path(cache_dir) / ('meta_' + name + '.npy')), blob)
+    np.save(str(Path(cache_dir) / ('meta_' + name + '_offsets.npy')), offsets)
+
+
+def _structure(entry):
+    """
+    Compute the canonical InChI, InChIKey and packed Morgan fingerprint of a library entry.
+
+    Args:
+        entry (tuple): The inchi and smiles metadata of the entry, None when missing.
+
+    Returns:
+        tuple: The InChI returned by get_correct_inchi (None if it raises), the InChIKey and the packed
+        fingerprint bytes (both None when there is no structure, or when the InChI is not its own canonical form).
+    """
+    data = {k: v for k, v in zip(['inchi', 'smiles'], entry) if v is not None}
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            # not memoized, the entries of a library are each normalised once
+            inchi = get_correct_inchi(data, memo=False)
+    except Exception:
+        return None, None, None
+    mol = None if inchi in ['#', '?', '*'] else Chem.MolFromInchi(inchi)
+    # the precomputed structure replaces Util.normalise_structure and morgan_fingerprint of this InChI
+    if (mol is None) or (Chem.MolToInchi(mol) != inchi):
+        return inchi, None, None
+    fp = AllChem.GetMorganFingerprintAsBitVect(mol, 2, nBits=2048)
+    return inchi, Chem.MolToInchiKey(mol), pack_fingerprint(fp).tobytes()
+
+
+def _structures(entries, n_jobs):
+    """
+    Compute the structures of many library entries, on several worker processes.
+
+    Args:
+        entries (list): The (inchi, smiles) metadata of the entries.
+        n_jobs (int): Number of worker processes, -1 for all CPUs.
+
+    Returns:
+        list: The results of _structure, in the order of entries.
+    """
+    if (n_jobs is None) or (n_jobs < 1):
+        n_jobs = os.cpu_count()
+    if (n_jobs == 1) or (len(entries) < 2*_STRUCTURE_CHUNK):
+        return ([_structure(entry) for entry in entries])
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        return (list(executor.map(_structure, entries, chunksize=_STRUCTURE_CHUNK)))
+
+
+def compile_library(path_mgf, signature=None, n_jobs=-1):
+    """
+    Compile a library MGF file into its columnar cache.
+
+    Args:
+        path_mgf (str or Path): The path to the library MGF file.
+        signature (dict, optional): The signature of the MGF file, computed if not given.
+        n_jobs (int, optional): Number of worker processes computing the structures, -1 for all CPUs.
+            Defaults to -1.
+
+    Returns:
+        Path: The cache directory.
+    """
+    if (signature is None):
+        signature = _file_signature(path_mgf)
+    cache_dir = cache_path(path_mgf)
+    print('==================')
+    print('COMPILING LIBRARY CACHE FOR ' + Path(path_mgf).name)
+    print('==================')
+
+    mz, intensities, offsets, precursor = [], [], [0], []
+    metadata = {k: [] for k in _METADATA_KEYS}
+    for sp in load_from_mgf(str(path_mgf)):
+        mz.append(sp.peaks.mz)
+        intensities.append(sp.peaks.intensities)
+        offsets.append(offsets[-1] + len(sp.peaks.mz))
+        m = sp.metadata.get('precursor_mz')
+        precursor.append(np.nan if m is None else float(m))
+        for k in _METADATA_KEYS:
+            v = sp.metadata.get(k)
+            metadata[k].append(None if v is None else str(v))
+
+    # write into a temporary directory first so that an interrupted compile never leaves a valid-looking cache
+    tmp_dir = cache_dir.with_name(cache_dir.name + '.tmp')
+    if (tmp_dir.exists()):
+        shutil.rmtree(str(tmp_dir))
+    tmp_dir.mkdir(parents=True)
+    np.save(str(tmp_dir / 'mz.npy'), np.concatenate(mz) if mz else np.zeros(0))
+    np.save(str(tmp_dir / 'intensities.npy'),
+            np.concatenate(intensities) if intensities else np.zeros(0))
+    np.save(str(tmp_dir / 'offsets.npy'), np.array(offsets, dtype=np.int64))
+    precursor = np.array(precursor, dtype=np.float64)
+    order = np.argsort(precursor, kind='stable')
+    np.save(str(tmp_dir / 'precursor_mz.npy'), precursor)
+    np.save(str(tmp_dir / 'precursor_order.npy'), order.astype(np.int64))
+    np.save(str(tmp_dir / 'precursor_sorted.npy'), precursor[order])
+    for k in _METADATA_KEYS:
+        _save_strings(tmp_dir, k, metadata[k])
+    structures = _structures(list(zip(metadata['inchi'], metadata['smiles'])), n_jobs)
+    _save_strings(tmp_dir, 'canonical_inchi', [inchi for inchi, _, _ in structures])
+    _save_strings(tmp_dir, 'inchikey', [key for _, key, _ in structures])
+    fingerprints = np.zeros((len(structures), _FINGERPRINT_WORDS), dtype=np.uint64)
+    for i, (_, _, fp) in enumerate(structures):
+        if (fp is not None):
+            fingerprints[i] = np.frombuffer(fp, dtype='<u8')
+    np.save(str(tmp_dir / 'fingerprints.npy'), fingerprints)
+    with open(str(tmp_dir / 'source.json'), 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'source': Path(path_mgf).name,
+                   'size': signature['size'], 'hash': signature['hash']}, f)
+
+    if (cache_dir.exists()):
+        shutil.rmtree(str(cache_dir))
+    os.replace(str(tmp_dir), str(cache_dir))
+    return (cache_dir)
+
+
+def get_library_cache(path_mgf):
+    """
+    Get the cache directory of a library MGF file, compiling it if missing or outdated.
+
+    Args:
+        path_mgf (str or Path): The path to the library MGF file.
+
+    Returns:
+        Path: The cache directory.
+    """
+    signature = _file_signature(path_mgf)
+    cache_dir = cache_path(path_mgf)
+    if (_is_valid_cache(cache_dir, signature)):
+        return (cache_dir)
+    return (compile_library(path_mgf, signature))
+
+
+def load_library(path_mgf, mmap_mode='r'):
+    """
+    Load a spectral library through its columnar cache.
+
+    Args:
+        path_mgf (str or Path): The path to the library MGF file.
+        mmap_mode (str, optional): Memory-map mode of the library arrays, None to load them in memory. Defaults to 'r'.
+
+    Returns:
+        SpectralLibrary: The memory-mapped library.
+    """
+    return (SpectralLibrary(get_library_cache(path_mgf), mmap_mode))
@@ -0,0 +1,683 @@
+"""
+This module annotates the spectra of an MgfInstance against a local spectral library (ISDB-LOTUS or GNPS).
+
+Each feature is matched independently, so the features can be spread over worker processes. Workers do not
+receive the library by pickling: each one re-opens the memory-mapped SpectralLibrary from its cache directory,
+so all of them share a single physical copy of the library. The results are gathered in the order of
+`mgf.data`, and are identical to the serial run whatever the number of workers. Identical spectra are scored
+once and their annotation is given to all of their scans (see MgfInstance.deduplicate). Optionally, near-duplicate
+spectra are clustered too and only the representative of each cluster is scored (see QueryClustering).
+
+In sparse mode, the features are not matched one by one: the precursor windows of all features are selected
+at once and all allowed (feature, library entry) pairs are scored together into a sparse score matrix (see
+BatchScoring._score_matrix), whose row-wise argmax gives the best hits. This trades memory for throughput on
+large runs, with the same results as the per-feature mode.
+
+Both modes score with any backend of SimilarityBackends (the modified cosine by default) and accept a Prefilter
+(see BinnedPrefilter), which prunes the candidates of each precursor window before scoring. Its statistics are
+gathered from the worker processes, like the counters of malformed spectra (Util.MATCH_STATS), which are reported
+at the end of the run.
+
+The iterative weighted analog search reproduces locally the 27 GNPS jobs of ClosestGNPS.closest_gnps_iterative
+(MIN_MATCHED_PEAKS_SEARCH 6/5/4 x MAX_SHIFT_MASS 0.02 ... 500/0): every (feature, library entry) pair within the
+widest shift that can reach MIN_MATCHED_PEAKS (see FragmentIndex) is scored once, then each tier keeps the pairs
+with enough matched peaks and a small enough precursor difference, and the first tier with a hit gives the
+annotation, weighted by its alpha.
+
+Functions:
+    1. _annotate_library:
+       Returns a dictionary {scan: MatchedSpectra} with the best library match of each feature.
+
+    2. _annotate_spectrum:
+       Returns the InChI and the score of the best library match of one spectrum.
+
+    3. _annotate_sparse:
+       Returns the InChI and the score of the best library match of many spectra, scored in one sparse job.
+
+    4. _annotate_library_iterative:
+       Returns a dictionary {scan: MatchedSpectra} with the weighted best hit of the iterative analog search.
+
+    5. _annotate_library_sweep:
+       Returns a dictionary {tolerance: {scan: MatchedSpectra}}, scoring the features once for all tolerances.
+
+    6. _match_library, _rescore_library:
+       Store the peak pairs assigned to every (feature, library entry) pair (see MatchedPeaks), then return a
+       dictionary {scan: MatchedSpectra} scored from them with other m/z and intensity powers.
+"""
+
+from .MatchedSpectra import MatchedSpectra
+from .SpectralLibrary import SpectralLibrary
+from .Util import get_correct_inchi, _mass_selection_by_tolerance, _get_match, MATCH_STATS, report_match_stats
+from .BatchScoring import _score_matrix, _score_pairs, _as_csr, _top_scores, _modified_cosine_sweep
+from .BinnedPrefilter import library_vectors
+from .FragmentIndex import fragment_index
+from .SimilarityBackends import get_backend
+from .MatchCache import spectrum_hash, library_id
+from .MatchedPeaks import MatchedPeaks
+from concurrent.futures import ProcessPoolExecutor
+from matchms import Spectrum
+import numpy as np
+import os
+
+# state of a worker process, set once by _init_worker
+_WORKER = {}
+# tiers of the iterative analog search, in the order of ClosestGNPS.closest_gnps_ietrative_by_id
+_PEAKS = [6, 5, 4]
+_MASS_DIFFS = [0.02, 0.1, 10, 25, 50, 100, 250, 500, 0]
+# number of features of the iterative analog search scored together, the candidate generation (FragmentIndex) and
+# the scoring (BatchScoring._passes) bound their own memory within a block
+_ITERATIVE_BLOCK = 256
+
+
+def _annotate_spectrum(sp, library, tolerance, mz_power, intensity_power, shift, backend='modified_cosine',
+                       top_k=None, prefilter=None):
+    """
+    Get the best library match of one spectrum.
+
+    Args:
+        sp (Spectrum): The query spectrum.
+        library (SpectralLibrary): The spectral library.
+        tolerance (float): Mass tolerance for precursor selection and peak matching.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+        shift (float): Value to shift the mass values during matching.
+        backend (str, optional): Name of the similarity backend. Defaults to 'modified_cosine'.
+        top_k (int, optional): Number of ranked hits to keep. Defaults to None.
+        prefilter (Prefilter, optional): Prefilter pruning the candidates. Defaults to None.
+
+    Returns:
+        tuple: The InChI of the best match ('#' if none), its score and, with top_k, the list of (inchi, score)
+        of the k best hits (None otherwise).
+    """
+    if (prefilter is None):
+        selected = _mass_selection_by_tolerance(sp, library.precursor_index, library, tolerance)
+    else:
+        idx = library.precursor_index.select(sp.metadata['precursor_mz'], tolerance)
+        _, idx = prefilter.filter_pairs([sp], library, np.zeros(len(idx), dtype=np.int64), idx)
+        selected = library.take(idx)
+    match = _get_match(sp, selected, tolerance, mz_power, intensity_power, shift, backend, top_k)
+    rsp, res = match[:2]
+    ranked = None if top_k is None else [(_spectrum_inchi(hit), score) for hit, (score, _) in match[2]]
+    if (type(rsp) == Spectrum):
+        return _spectrum_inchi(rsp), res[0], ranked
+    return rsp, res, ranked
+
+
+def _annotate_sparse(items, library, tolerance, mz_power, intensity_power, shift, backend='modified_cosine',
+                     top_k=None, prefilter=None):
+    """
+    Get the best library match of many spectra, scored together into a sparse score matrix.
+
+    Args:
+        items (list): List of (scan, Spectrum) tuples.
+        library (SpectralLibrary): The spectral library.
+        tolerance (float): Mass tolerance for precursor selection and peak matching.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+        shift (float): Unused, the precursor mass shift of each pair is always used, as in _get_match.
+        backend (str, optional): Name of the similarity backend. Defaults to 'modified_cosine'.
+        top_k (int, optional): Number of ranked hits to keep. Defaults to None.
+        prefilter (Prefilter, optional): Prefilter pruning the candidates. Defaults to None.
+
+    Returns:
+        list: List of (scan, inchi, score, ranked) tuples, ranked being as in _annotate_spectrum.
+    """
+    score, matches = _score_matrix([sp for _, sp in items], library, tolerance, mz_power, intensity_power,
+                                   prefilter=prefilter, stats=MATCH_STATS, score_function=get_backend(backend))
+    res = []
+    for r, (i, _) in enumerate(items):
+        a, b = score.indptr[r], score.indptr[r+1]
+        res.append((i, *_ranked_hits(library, score.indices[a:b], score.data[a:b], matches.data[a:b], top_k)))
+    return (res)
+
+
+def _library_inchi(library, i):
+    """
+    Get the InChI of a library entry, precomputed in the library cache.
+
+    Args:
+        library (SpectralLibrary): The spectral library.
+        i (int): Index of the library entry.
+
+    Returns:
+        str: The InChI, as get_correct_inchi.
+    """
+    inchi = library.get('canonical_inchi', i)
+    if (inchi is None):
+        # not precomputed because get_correct_inchi failed, let it fail here as before
+        return (get_correct_inchi(library[i]))
+    return (inchi)
+
+
+def _spectrum_inchi(sp):
+    """
+    Get the InChI of a library spectrum, precomputed in the library cache.
+
+    Args:
+        sp (Spectrum): A spectrum built by SpectralLibrary.
+
+    Returns:
+        str: The InChI, as get_correct_inchi.
+    """
+    inchi = sp.get('canonical_inchi')
+    if (inchi is None):
+        return (get_correct_inchi(sp))
+    return (inchi)
+
+
+def _matched(library, i, inchi, score, ranked=None):
+    """
+    Build the MatchedSpectra of a feature, with the precomputed InChIKey and fingerprint of its structure.
+
+    Args:
+        library (SpectralLibrary): The spectral library.
+        i: The scan of the feature (or its spectrum).
+        inchi (str): The InChI of the best match.
+        score (float): The score of the best match.
+        ranked (list, optional): The ranked hits. Defaults to None.
+
+    Returns:
+        MatchedSpectra: The annotation of the feature.
+    """
+    inchikey, fingerprint = library.structure(inchi)
+    return (MatchedSpectra(i, inchi, score, ranked, inchikey, fingerprint))
+
+
+def _ranked_hits(library, col, score, matches, top_k=None, inchis=None):
+    """
+    Get the best hits of one spectrum from the scores of its candidates.
+
+    Args:
+        library (SpectralLibrary): The spectral library.
+        col (numpy.ndarray): Library entry of each candidate.
+        score (numpy.ndarray): Score of each candidate.
+        matches (numpy.ndarray): Number of matched peaks of each candidate.
+        top_k (int, optional): Number of ranked hits to keep. Defaults to None.
+        inchis (dict, optional): InChI of the library entries already read, {entry: inchi}. Defaults to None.
+
+    Returns:
+        tuple: The InChI of the best hit ('#' if none), its score and the ranked hits as in _annotate_spectrum.
+    """
+    if (inchis is None):
+        inchis = {}
+    # among equal scores the last candidate ranks first, as in _get_match
+    top = _top_scores(score, matches, 1 if top_k is None else top_k)
+    for j, _, _ in top:
+        if (int(col[j]) not in inchis):
+            inchis[int(col[j])] = _library_inchi(library, int(col[j]))
+    ranked = [(inchis[int(col[j])], s) for j, s, _ in top]
+    best = ranked[0] if len(ranked) != 0 else ('#', 0)
+    return best[0], best[1], None if top_k is None else ranked
+
+
+def _annotate_items(items, library, parameters, sparse, prefilter=None):
+    """
+    Annotate a list of features, one by one or in one sparse job.
+
+    Args:
+        items (list): List of (scan, Spectrum) tuples.
+        library (SpectralLibrary): The spectral library.
+        parameters (tuple): tolerance, mz_power, intensity_power, shift, similarity backend and top_k.
+        sparse (bool): Whether to score all features in one sparse job.
+        prefilter (Prefilter, optional): Prefilter pruning the candidates. Defaults to None.
+
+    Returns:
+        list: List of (scan, inchi, score, ranked) tuples.
+    """
+    if (sparse):
+        res = _annotate_sparse(items, library, *parameters, prefilter=prefilter)
+    else:
+        res = [(i, *_annotate_spectrum(sp, library, *parameters, prefilter=prefilter)) for i, sp in items]
+    if (prefilter is not None) and (prefilter.check):
+        counters = dict(MATCH_STATS)
+        full = _annotate_items(items, library, parameters, sparse)
+        MATCH_STATS.update(counters)
+        prefilter.stats['checked'] += len(res)
+        prefilter.stats['preserved'] += sum(r[1:3] == f[1:3] for r, f in zip(res, full))
+    return (res)
+
+
+def _shift_candidates(query, library, tolerance, max_shift, min_peaks):
+    """
+    Select the (query, library entry) pairs within max_shift that can reach min_peaks matched peaks.
+
+    Args:
+        query (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the queries.
+        library (SpectralLibrary): The spectral library.
+        tolerance (float): The allowable mass difference for matching peaks.
+        max_shift (float): The maximum precursor difference, None for no limit.
+        min_peaks (int): The minimum number of matched peaks.
+
+    Returns:
+        tuple: Query and library indices of the pairs, ordered by query then library index.
+    """
+    row, col = fragment_index(library).candidates(query, tolerance, min_peaks)
+    if (max_shift is not None):
+        keep = np.abs(np.asarray(library.precursor_mz[col]) - query[3][row]) <= max_shift
+        row, col = row[keep], col[keep]
+    return row, col
+
+
+def _annotate_iterative(items, library, tolerance, mz_power, intensity_power, alpha, score_threshold):
+    """
+    Get the weighted best hit of the iterative analog search for many spectra.
+
+    Args:
+        items (list): List of (scan, Spectrum) tuples.
+        library (SpectralLibrary): The spectral library.
+        tolerance (float): Mass tolerance for peak matching.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+        alpha (dict): Weight of each tier, {peak: {mass_diff: weight}} (see ClosestGNPS._get_iterative_parameters).
+        score_threshold (float): Minimum score of a hit, as SCORE_THRESHOLD of the GNPS jobs.
+
+    Returns:
+        list: List of (scan, inchi, score) tuples.
+    """
+    max_shift = None if (0 in _MASS_DIFFS) else max(_MASS_DIFFS)
+    res = []
+    for start in range(0, len(items), _ITERATIVE_BLOCK):
+        block_items = items[start:start+_ITERATIVE_BLOCK]
+        query = _as_csr([sp for _, sp in block_items])
+        row, col = _shift_candidates(query, library, tolerance, max_shift, min(_PEAKS))
+        score, matches = _score_pairs(query, library, row, col, tolerance, mz_power, intensity_power,
+                                      stats=MATCH_STATS)
+        shift = np.abs(np.asarray(library.precursor_mz[col]) - query[3][row])
+        bounds = np.searchsorted(row, np.arange(len(block_items)+1))
+
+        for r, (i, _) in enumerate(block_items):
+            a, b = bounds[r], bounds[r+1]
+            inchis = {}
+            hit, last = None, ('#', 0)
+            for peak in _PEAKS:
+                for mass in _MASS_DIFFS:
+                    ok = (matches[a:b] >= peak) & (score[a:b] >= score_threshold) & (score[a:b] > 0)
+                    if (mass != 0):
+                        ok &= (shift[a:b] <= mass)
+                    if (not ok.any()):
+                        continue
+                    # best hit of the tier, the last one among equal scores as in _get_match
+                    candidates = np.flatnonzero(ok)
+                    k = a + candidates[len(candidates) - 1 - int(np.argmax(score[a:b][candidates][::-1]))]
+                    if (k not in inchis):
+                        inchis[k] = _library_inchi(library, int(col[k]))
+                    if (peak == _PEAKS[-1]) and (mass == _MASS_DIFFS[-1]):
+                        last = (inchis[k], float(score[k])*alpha[peak][mass])
+                    if (inchis[k] not in ['#', '?']):
+                        hit = (inchis[k], float(score[k])*alpha[peak][mass])
+                        break
+                if (hit is not None):
+                    break
+            res.append((i, *(last if hit is None else hit)))
+    return (res)
+
+
+def _annotate_iterative_chunk(chunk):
+    """
+    Run the iterative analog search on a chunk of features in a worker process.
+
+    Args:
+        chunk (list): List of (scan, Spectrum) tuples.
+
+    Returns:
+        tuple: List of (scan, inchi, score) tuples and the counters of malformed spectra of the chunk.
+    """
+    for k in MATCH_STATS:
+        MATCH_STATS[k] = 0
+    res = _annotate_iterative(chunk, _WORKER['library'], *_WORKER['parameters'])
+    return res, dict(MATCH_STATS)
+
+
+def _annotate_library_iterative(mgf, library, tolerance, mz_power, intensity_power, alpha, score_threshold=0.001,
+                                n_jobs=1):
+    """
+    Run the iterative weighted analog search of all spectra of an MgfInstance against a local library.
+
+    Args:
+        mgf (MgfInstance): An instance of MgfInstance containing spectra data.
+        library (SpectralLibrary): The memory-mapped spectral library.
+        tolerance (float): Mass tolerance for peak matching.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+        alpha (dict): Weight of each tier, {peak: {mass_diff: weight}} (see ClosestGNPS._get_iterative_parameters).
+        score_threshold (float, optional): Minimum score of a hit. Defaults to 0.001.
+        n_jobs (int, optional): Number of worker processes, -1 for all CPUs. Defaults to 1 (serial).
+
+    Returns:
+        dict: A dictionary where the key is the spectrum ID and the value is a MatchedSpectra object
+        holding the query Spectrum, as ClosestGNPS.closest_gnps_ietrative_by_id.
+    """
+    parameters = (tolerance, mz_power, intensity_power, alpha, score_threshold)
+    if (n_jobs is None) or (n_jobs < 1):
+        n_jobs = os.cpu_count()
+    items = list(mgf.data.items())
+    # built once here, so that the workers only load it
+    fragment_index(library)
+
+    if (n_jobs == 1) or (len(items) < 2):
+        res = _annotate_iterative(items, library, *parameters)
+    else:
+        chunks = _chunks(items, min(len(items), 4*n_jobs))
+        res = []
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                 initargs=(library.path, parameters)) as executor:
+            for chunk, match_stats in executor.map(_annotate_iterative_chunk, chunks):
+                res.extend(chunk)
+                for k in match_stats:
+                    MATCH_STATS[k] += match_stats[k]
+    report_match_stats()
+
+    RES = {}
+    for i, inchi, score in res:
+        RES[i] = _matched(library, mgf.data[i], inchi, score)
+    return RES
+
+
+def _annotate_sweep(items, library, tolerances, mz_power, intensity_power, top_k=None):
+    """
+    Get the best library match of many spectra at several tolerances, scoring them once at the widest tolerance.
+
+    The precursor windows and peak pairs of the widest tolerance hold those of every narrower tolerance; each
+    tolerance keeps the pairs within its own precursor window, with the same test as PrecursorIndex.select_many,
+    and its own peak pairs (see BatchScoring._modified_cosine_sweep). The results are the same as separate runs.
+
+    Args:
+        items (list): List of (scan, Spectrum) tuples.
+        library (SpectralLibrary): The spectral library.
+        tolerances (list): Mass tolerances for precursor selection and peak matching.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+        top_k (int, optional): Number of ranked hits to keep. Defaults to None.
+
+    Returns:
+        list: For each tolerance, the list of (scan, inchi, score, ranked) tuples.
+    """
+    query = _as_csr([sp for _, sp in items])
+    row, col = library.precursor_index.select_many(query[3], max(tolerances))
+    score, matches = _score_pairs(query, library, row, col, tuple(tolerances), mz_power, intensity_power,
+                                  stats=MATCH_STATS, score_function=_modified_cosine_sweep)
+    difference = np.abs(np.asarray(library.precursor_mz[col]) - query[3][row])
+    bounds = np.searchsorted(row, np.arange(len(items)+1))
+    inchis = {}
+    res = []
+    for t, tolerance in enumerate(tolerances):
+        res.append([])
+        for r, (i, _) in enumerate(items):
+            pair = bounds[r] + np.flatnonzero(difference[bounds[r]:bounds[r+1]] <= tolerance)
+            res[t].append((i, *_ranked_hits(library, col[pair], score[pair, t], matches[pair, t], top_k, inchis)))
+    return (res)
+
+
+def _annotate_sweep_chunk(chunk):
+    """
+    Run a tolerance sweep on a chunk of features in a worker process.
+
+    Args:
+        chunk (list): List of (scan, Spectrum) tuples.
+
+    Returns:
+        tuple: The results of _annotate_sweep and the counters of malformed spectra of the chunk.
+    """
+    for k in MATCH_STATS:
+        MATCH_STATS[k] = 0
+    res = _annotate_sweep(chunk, _WORKER['library'], *_WORKER['parameters'])
+    return res, dict(MATCH_STATS)
+
+
+def _annotate_library_sweep(mgf, library, tolerances, mz_power, intensity_power, n_jobs=1, top_k=None, dedup=True):
+    """
+    Annotate all spectra of an MgfInstance against a local spectral library at several tolerances, in about
+    the time of one run at the widest tolerance.
+
+    Args:
+        mgf (MgfInstance): An instance of MgfInstance containing spectra data.
+        library (SpectralLibrary): The memory-mapped spectral library.
+        tolerances (list): Mass tolerances for precursor selection and peak matching.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+        n_jobs (int, optional): Number of worker processes, -1 for all CPUs. Defaults to 1 (serial).
+        top_k (int, optional): Number of ranked hits kept in MatchedSpectra.ranked. Defaults to None.
+        dedup (bool, optional): Score identical spectra once (see MgfInstance.deduplicate). Defaults to True.
+
+    Returns:
+        dict: A dictionary {tolerance: {scan: MatchedSpectra}}, as _annotate_library for each tolerance.
+    """
+    if (dedup):
+        unique, representative = mgf.deduplicate()
+        RES = _annotate_library_sweep(unique, library, tolerances, mz_power, intensity_power, n_jobs, top_k,
+                                      dedup=False)
+        return {tolerance: _fan_out(RES[tolerance], representative) for tolerance in RES}
+    tolerances = list(tolerances)
+    parameters = (tolerances, mz_power, intensity_power, top_k)
+    if (n_jobs is None) or (n_jobs < 1):
+        n_jobs = os.cpu_count()
+    items = list(mgf.data.items())
+
+    if (n_jobs == 1) or (len(items) < 2):
+        res = _annotate_sweep(items, library, *parameters)
+    else:
+        chunks = _chunks(items, min(len(items), 4*n_jobs))
+        res = [[] for _ in tolerances]
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                 initargs=(library.path, parameters)) as executor:
+            for chunk, match_stats in executor.map(_annotate_sweep_chunk, chunks):
+                for t in range(len(tolerances)):
+                    res[t].extend(chunk[t])
+                for k in match_stats:
+                    MATCH_STATS[k] += match_stats[k]
+    report_match_stats()
+
+    RES = {}
+    for tolerance, res_tolerance in zip(tolerances, res):
+        RES[tolerance] = {}
+        for i, inchi, score, ranked in res_tolerance:
+            RES[tolerance][i] = _matched(library, i, inchi, score, ranked)
+    return RES
+
+
+def _match_library(mgf, library, tolerance, mz_power, intensity_power):
+    """
+    Score all spectra of an MgfInstance against a local spectral library and keep the assigned peak pairs.
+
+    Args:
+        mgf (MgfInstance): An instance of MgfInstance containing spectra data.
+        library (SpectralLibrary): The memory-mapped spectral library.
+        tolerance (float): Mass tolerance for precursor selection and peak matching.
+        mz_power (float): Power applied to mass values for the peak assignment.
+        intensity_power (float): Power applied to intensity values for the peak assignment.
+
+    Returns:
+        MatchedPeaks: The peak pairs of every (feature, library entry) pair within the precursor tolerance.
+    """
+    query = _as_csr(list(mgf.data.values()))
+    row, col = library.precursor_index.select_many(query[3], tolerance)
+    _, _, peaks = _score_pairs(query, library, row, col, tolerance, mz_power, intensity_power, stats=MATCH_STATS,
+                               return_peaks=True)
+    report_match_stats()
+    return (MatchedPeaks(mgf.data.keys(), query, row, col, peaks, tolerance, mz_power, intensity_power,
+                         library_id(library)))
+
+
+def _rescore_library(peaks, library, mz_power, intensity_power, top_k=None):
+    """
+    Annotate the spectra of a stored run with new m/z and intensity powers, without assigning peaks again.
+
+    Args:
+        peaks (MatchedPeaks): The peak pairs stored by _match_library.
+        library (SpectralLibrary): The memory-mapped spectral library.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+        top_k (int, optional): Number of ranked hits kept in MatchedSpectra.ranked. Defaults to None.
+
+    Returns:
+        dict: A dictionary where the key is the scan and the value is a MatchedSpectra object with the best match.
+    """
+    score, matches = peaks.rescore(library, mz_power, intensity_power)
+    bounds = np.searchsorted(peaks.row, np.arange(len(peaks.scans)+1))
+    inchis = {}
+    RES = {}
+    for r, i in enumerate(peaks.scans):
+        a, b = bounds[r], bounds[r+1]
+        RES[i] = _matched(library, i, *_ranked_hits(library, peaks.col[a:b], score[a:b], matches[a:b], top_k, inchis))
+    return RES
+
+
+def _init_worker(cache_dir, parameters, sparse=False, prefilter=None):
+    """
+    Open the memory-mapped library in a worker process.
+
+    Args:
+        cache_dir (Path): The cache directory of the library.
+        parameters (tuple): The scoring parameters of the annotation function run by the worker.
+        sparse (bool, optional): Whether to score each chunk in one sparse job. Defaults to False.
+        prefilter (Prefilter, optional): Copy of the prefilter. Defaults to None.
+    """
+    _WORKER['library'] = SpectralLibrary(cache_dir)
+    _WORKER['parameters'] = parameters
+    _WORKER['sparse'] = sparse
+    _WORKER['prefilter'] = prefilter
+
+
+def _annotate_chunk(chunk):
+    """
+    Annotate a chunk of features in a worker process.
+
+    Args:
+        chunk (list): List of (scan, Spectrum) tuples.
+
+    Returns:
+        tuple: List of (scan, inchi, score, ranked) tuples, the prefilter statistics of the chunk (None without
+        prefilter) and its counters of malformed spectra.
+    """
+    prefilter = _WORKER['prefilter']
+    if (prefilter is not None):
+        prefilter.stats = dict.fromkeys(prefilter.stats, 0)
+    for k in MATCH_STATS:
+        MATCH_STATS[k] = 0
+    res = _annotate_items(chunk, _WORKER['library'], _WORKER['parameters'], _WORKER['sparse'], prefilter)
+    return res, (None if prefilter is None else prefilter.stats), dict(MATCH_STATS)
+
+
+def _fan_out(RES, representative, penalty=0.0):
+    """
+    Give every scan the annotation of its representative spectrum.
+
+    Args:
+        RES (dict): Annotations of the representative spectra, {scan: MatchedSpectra}.
+        representative (dict): Representative scan of each scan, as returned by MgfInstance.deduplicate or
+            QueryClustering.cluster.
+        penalty (float, optional): Relative penalty on the scores of the scans that are not representatives.
+            Defaults to 0.0.
+
+    Returns:
+        dict: A dictionary {scan: MatchedSpectra} for all scans.
+    """
+    FAN = {}
+    for i, r in representative.items():
+        factor = 1.0 if (i == r) else 1.0 - penalty
+        ranked = RES[r].ranked
+        if (ranked is not None) and (factor != 1.0):
+            ranked = [(inchi, score*factor) for inchi, score in ranked]
+        FAN[i] = MatchedSpectra(i, RES[r].inchi, RES[r].score*factor, ranked, RES[r].inchikey, RES[r].fingerprint)
+    return FAN
+
+
+def _chunks(items, n_chunks):
+    """
+    Split a list into n_chunks contiguous chunks of nearly equal size.
+
+    Args:
+        items (list): The list to split.
+        n_chunks (int): The number of chunks.
+
+    Returns:
+        list: The non-empty chunks, in order.
+    """
+    size, rest = divmod(len(items), n_chunks)
+    chunks, k = [], 0
+    for c in range(n_chunks):
+        step = size + (c < rest)
+        if (step != 0):
+            chunks.append(items[k:k+step])
+        k += step
+    return (chunks)
+
+
+def _annotate_library(mgf, library, tolerance, mz_power, intensity_power, shift, n_jobs=1, sparse=False,
+                      prefilter=None, backend='modified_cosine', top_k=None, cache=None, clustering=None, dedup=True):
+    """
+    Annotate all spectra of an MgfInstance against a local spectral library.
+
+    Args:
+        mgf (MgfInstance): An instance of MgfInstance containing spectra data.
+        library (SpectralLibrary): The memory-mapped spectral library.
+        tolerance (float): Mass tolerance for precursor selection and peak matching.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+        shift (float): Value to shift the mass values during matching.
+        n_jobs (int, optional): Number of worker processes, -1 for all CPUs. Defaults to 1 (serial).
+        sparse (bool, optional): Score all features (of each worker) in one sparse job. Defaults to False.
+        prefilter (Prefilter, optional): Prefilter pruning the candidates, its statistics are updated. Defaults to None.
+        backend (str, optional): Name of the similarity backend (see SimilarityBackends). Defaults to 'modified_cosine'.
+        top_k (int, optional): Number of ranked hits kept in MatchedSpectra.ranked. Defaults to None.
+        cache (MatchCache, optional): Persistent cache of the results, only the features missing from it are
+            scored. Defaults to None.
+        clustering (QueryClustering, optional): Clustering of near-duplicate spectra, only the representative of
+            each cluster is scored. Defaults to None.
+        dedup (bool, optional): Score identical spectra once (see MgfInstance.deduplicate). Defaults to True.
+
+    Returns:
+        dict: A dictionary where the key is the spectrum ID and the value is a MatchedSpectra object.
+    """
+    get_backend(backend)
+    if (dedup):
+        unique, representative = mgf.deduplicate()
+        RES = _annotate_library(unique, library, tolerance, mz_power, intensity_power, shift, n_jobs, sparse,
+                                prefilter, backend, top_k, cache, clustering, dedup=False)
+        return (_fan_out(RES, representative))
+    if (clustering is not None):
+        representatives, representative = clustering.cluster(mgf, tolerance, mz_power, intensity_power)
+        clustering.report(reset=False)
+        RES = _annotate_library(representatives, library, tolerance, mz_power, intensity_power, shift, n_jobs,
+                                sparse, prefilter, backend, top_k, cache, dedup=False)
+        return (_fan_out(RES, representative, clustering.penalty))
+    parameters = (tolerance, mz_power, intensity_power, shift, backend, top_k)
+    if (n_jobs is None) or (n_jobs < 1):
+        n_jobs = os.cpu_count()
+    items = list(mgf.data.items())
+    if (cache is not None):
+        hashes = {i: spectrum_hash(sp) for i, sp in items}
+        cached = cache.lookup(library, parameters, prefilter, hashes)
+        items = [(i, sp) for i, sp in items if i not in cached]
+    if (prefilter is not None) and (len(items) != 0):
+        # computed once here, so that the workers only load them
+        library_vectors(library, prefilter.bin_width)
+
+    if (len(items) == 0):
+        res = []
+    elif (n_jobs == 1) or (len(items) < 2):
+        res = _annotate_items(items, library, parameters, sparse, prefilter)
+    else:
+        # several chunks per worker to balance features with many candidates
+        chunks = _chunks(items, min(len(items), 4*n_jobs))
+        res = []
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                 initargs=(library.path, parameters, sparse, prefilter)) as executor:
+            for chunk, stats, match_stats in executor.map(_annotate_chunk, chunks):
+                res.extend(chunk)
+                if (stats is not None):
+                    for k in stats:
+                        prefilter.stats[k] += stats[k]
+                for k in match_stats:
+                    MATCH_STATS[k] += match_stats[k]
+    report_match_stats()
+    if (cache is not None):
+        cache.store(library, parameters, prefilter, [(hashes[i], *r) for i, *r in res])
+        cached.update((i, tuple(r)) for i, *r in res)
+        res = [(i, *cached[i]) for i in mgf.data]
+        cache.report()
+
+    RES = {}
+    for i, inchi, score, ranked in res:
+        RES[i] = _matched(library, i, inchi, score, ranked)
+    return RES
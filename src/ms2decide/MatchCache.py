@@ -0,0 +1,165 @@
+"""
+This module stores the results of local annotation in a persistent SQLite file, so that re-running an annotation
+on the same features only scores the features that are new or changed.
+
+A result is keyed by the content hash of the query spectrum (peaks and precursor m/z, not the scan number), the
+hash of the library source (see LibraryCache), and every parameter that changes the result: tolerance, mz_power,
+intensity_power, shift, similarity backend, number of ranked hits and prefilter settings. Changing the library
+MGF or any parameter therefore never returns a stale result; such entries are simply not found.
+
+Typical usage example:
+    cache = MatchCache('isdb_matches.sqlite')
+    isdb_res = get_cfm_annotation(mgf, 0.02, cache=cache)
+"""
+
+from .LibraryCache import _read_source
+import numpy as np
+import hashlib
+import sqlite3
+import json
+
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS matches (
+    spectrum TEXT, library TEXT, tolerance REAL, mz_power REAL, intensity_power REAL, shift REAL,
+    backend TEXT, top_k INTEGER, prefilter TEXT, inchi TEXT, score REAL, ranked TEXT,
+    PRIMARY KEY (spectrum, library, tolerance, mz_power, intensity_power, shift, backend, top_k, prefilter))'''
+_KEY = ('spectrum = ? AND library = ? AND tolerance = ? AND mz_power = ? AND intensity_power = ? AND shift = ? '
+        'AND backend = ? AND top_k = ? AND prefilter = ?')
+
+
+def spectrum_hash(sp):
+    """
+    Compute the content hash of a spectrum, from its peaks and precursor m/z.
+
+    Args:
+        sp (Spectrum): The spectrum.
+
+    Returns:
+        str: BLAKE2b hex digest.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.ascontiguousarray(sp.peaks.mz, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(sp.peaks.intensities, dtype=np.float64).tobytes())
+    precursor = sp.get('precursor_mz')
+    h.update(np.float64(np.nan if precursor is None else precursor).tobytes())
+    return (h.hexdigest())
+
+
+def library_id(library):
+    """
+    Get the identifier of a library, from the signature of its source MGF file.
+
+    Args:
+        library (SpectralLibrary): The spectral library.
+
+    Returns:
+        str: The identifier.
+    """
+    source = _read_source(library.path)
+    if (source is None):
+        return (str(library.path))
+    return (str(source.get('hash')) + ':' + str(source.get('size')))
+
+
+class MatchCache():
+    """
+    Represents a persistent cache of local annotation results.
+
+    Attributes:
+        path (str): Path of the SQLite file.
+        stats (dict): Numbers of features found in and missing from the cache.
+
+    Example:
+        >>> cache = MatchCache('isdb_matches.sqlite')
+        >>> cached = cache.lookup(library, parameters, None, {scan: spectrum_hash(sp)})
+    """
+
+    def __init__(self, path):
+        """
+        Initializes a MatchCache, creating the SQLite file if needed.
+
+        Args:
+            path (str or Path): Path of the SQLite file.
+        """
+        self.path = str(path)
+        self.stats = {'hits': 0, 'misses': 0}
+        self._connection = sqlite3.connect(self.path)
+        with self._connection:
+            self._connection.execute(_SCHEMA)
+
+    def _key(self, library, parameters, prefilter):
+        """
+        Get the key columns shared by all features of an annotation run.
+
+        Args:
+            library (SpectralLibrary): The spectral library.
+            parameters (tuple): tolerance, mz_power, intensity_power, shift, similarity backend and top_k.
+            prefilter (Prefilter): The prefilter, or None.
+
+        Returns:
+            tuple: The key columns, without the spectrum hash.
+        """
+        tolerance, mz_power, intensity_power, shift, backend, top_k = parameters
+        settings = '' if prefilter is None else json.dumps([prefilter.top_m, prefilter.min_score, prefilter.bin_width])
+        return (library_id(library), float(tolerance), float(mz_power), float(intensity_power), float(shift),
+                backend, 0 if top_k is None else int(top_k), settings)
+
+    def lookup(self, library, parameters, prefilter, hashes):
+        """
+        Find the cached results of features.
+
+        Args:
+            library (SpectralLibrary): The spectral library.
+            parameters (tuple): tolerance, mz_power, intensity_power, shift, similarity backend and top_k.
+            prefilter (Prefilter): The prefilter, or None.
+            hashes (dict): Content hash of each feature, {scan: hash}.
+
+        Returns:
+            dict: The (inchi, score, ranked) of the features found, {scan: result}.
+        """
+        key = self._key(library, parameters, prefilter)
+        found = {}
+        for i, h in hashes.items():
+            row = self._connection.execute('SELECT inchi, score, ranked FROM matches WHERE ' + _KEY,
+                                           (h,) + key).fetchone()
+            if (row is not None):
+                ranked = None if row[2] is None else [tuple(r) for r in json.loads(row[2])]
+                found[i] = (row[0], row[1], ranked)
+        self.stats['hits'] += len(found)
+        self.stats['misses'] += len(hashes) - len(found)
+        return (found)
+
+    def store(self, library, parameters, prefilter, results):
+        """
+        Store the results of features.
+
+        Args:
+            library (SpectralLibrary): The spectral library.
+            parameters (tuple): tolerance, mz_power, intensity_power, shift, similarity backend and top_k.
+            prefilter (Prefilter): The prefilter, or None.
+            results (list): List of (hash, inchi, score, ranked) tuples.
+        """
+        key = self._key(library, parameters, prefilter)
+        rows = [(h,) + key + (inchi, float(score), None if ranked is None else json.dumps(ranked))
+                for h, inchi, score, ranked in results]
+        with self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO matches VALUES (' + ', '.join(['?'] * 12) + ')', rows)
+
+    def close(self):
+        """
+        Close the SQLite file.
+        """
+        self._connection.close()
+
+    def report(self, reset=True):
+        """
+        Print the statistics of the cache.
+
+        Args:
+            reset (bool, optional): Whether to reset the statistics afterwards. Defaults to True.
+        """
+        print('==================')
+        print('MATCH CACHE: ' + str(self.stats['hits']) + ' OF ' + str(self.stats['hits'] + self.stats['misses']) +
+              ' SPECTRA REUSED')
+        print('==================')
+        if (reset):
+            self.stats = dict.fromkeys(self.stats, 0)
@@ -0,0 +1,116 @@
+"""
+This module stores the peak pairs assigned by a local annotation run, so that the run can be scored again with
+other m/z and intensity powers (see Parametres) without collecting and assigning peaks again.
+
+For every (query, library entry) pair within the precursor tolerance, the matched peaks of the modified cosine
+are kept as (pair, library peak, query peak) index arrays, in summation order, together with the query peaks.
+Rescoring only computes the weighted products of the stored peak pairs and the spectrum norms, which is a
+vectorized dot product per pair. It gives the score of a full run whenever the new powers keep the order of the
+peak products, e.g. with mz_power 0 and any positive intensity_power (the default setting); otherwise the
+stored assignment is kept as it is.
+
+Typical usage example:
+    peaks = _match_library(mgf, isdb, 0.02, 0.0, 0.5)
+    peaks.save('isdb_peaks.npz')
+    isdb_res = _rescore_library(MatchedPeaks.load('isdb_peaks.npz'), isdb, 0.0, 1.0)
+"""
+
+from .BatchScoring import _rescore_pairs
+from .MatchCache import library_id
+import numpy as np
+import json
+
+
+class MatchedPeaks():
+    """
+    Represents the peak pairs assigned by a local annotation run.
+
+    Attributes:
+        scans (list): Scan of each query.
+        query (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the queries.
+        row (numpy.ndarray): Query of each (query, library entry) pair, in increasing order.
+        col (numpy.ndarray): Library entry of each pair.
+        peaks (tuple): Pair, library peak and query peak of each assigned peak pair.
+        tolerance (float): Mass tolerance of the run.
+        mz_power (float): Power applied to mass values when the peaks were assigned.
+        intensity_power (float): Power applied to intensity values when the peaks were assigned.
+        library (str): Identifier of the library (see MatchCache.library_id).
+
+    Example:
+        >>> peaks = MatchedPeaks.load('isdb_peaks.npz')
+        >>> score, matches = peaks.rescore(isdb, 0.0, 1.0)
+    """
+
+    def __init__(self, scans, query, row, col, peaks, tolerance, mz_power, intensity_power, library):
+        """
+        Initializes a MatchedPeaks.
+
+        Args:
+            scans (list): Scan of each query.
+            query (tuple): CSR arrays of the queries.
+            row (numpy.ndarray): Query of each pair.
+            col (numpy.ndarray): Library entry of each pair.
+            peaks (tuple): Pair, library peak and query peak of each assigned peak pair.
+            tolerance (float): Mass tolerance of the run.
+            mz_power (float): Power applied to mass values when the peaks were assigned.
+            intensity_power (float): Power applied to intensity values when the peaks were assigned.
+            library (str): Identifier of the library.
+        """
+        self.scans = list(scans)
+        self.query = query
+        self.row = row
+        self.col = col
+        self.peaks = peaks
+        self.tolerance = tolerance
+        self.mz_power = mz_power
+        self.intensity_power = intensity_power
+        self.library = library
+
+    def rescore(self, library, mz_power, intensity_power):
+        """
+        Score all pairs with new powers from the stored peak pairs.
+
+        Args:
+            library (SpectralLibrary): The spectral library the peaks were assigned with.
+            mz_power (float): Power applied to mass values for scoring.
+            intensity_power (float): Power applied to intensity values for scoring.
+
+        Returns:
+            tuple: Scores and numbers of matched peaks of the pairs.
+        """
+        if (library_id(library) != self.library):
+            raise ValueError('The peaks were not assigned with this library')
+        return (_rescore_pairs(self.query, library, self.row, self.col, self.peaks, mz_power, intensity_power))
+
+    def save(self, path):
+        """
+        Save the peak pairs in a .npz file.
+
+        Args:
+            path (str or Path): Path of the file.
+        """
+        settings = {'scans': self.scans, 'tolerance': self.tolerance, 'mz_power': self.mz_power,
+                    'intensity_power': self.intensity_power, 'library': self.library}
+        with open(str(path), 'wb') as f:
+            np.savez(f, settings=np.array(json.dumps(settings)), query_mz=self.query[0],
+                     query_intensities=self.query[1], query_offsets=self.query[2], query_precursor=self.query[3],
+                     row=self.row, col=self.col, pair=self.peaks[0], ref_peak=self.peaks[1],
+                     query_peak=self.peaks[2])
+
+    @staticmethod
+    def load(path):
+        """
+        Load peak pairs saved by MatchedPeaks.save.
+
+        Args:
+            path (str or Path): Path of the file.
+
+        Returns:
+            MatchedPeaks: The peak pairs.
+        """
+        with np.load(str(path)) as data:
+            settings = json.loads(str(data['settings']))
+            query = (data['query_mz'], data['query_intensities'], data['query_offsets'], data['query_precursor'])
+            return (MatchedPeaks(settings['scans'], query, data['row'], data['col'],
+                                 (data['pair'], data['ref_peak'], data['query_peak']), settings['tolerance'],
+                                 settings['mz_power'], settings['intensity_power'], settings['library']))
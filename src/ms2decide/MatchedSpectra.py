@@ -9,6 +9,10 @@ class MatchedSpectra:
         spectrum: The matched spectrum data.
         inchi (str): The InChI (International Chemical Identifier) of the corresponding compound.
         score (float): The matching score indicating the degree of similarity between the spectrum and the compound.
+        ranked (list): The (inchi, score) of the best hits, best first, when several hits were kept (None otherwise).
+        inchikey (str): The InChIKey of the compound, when precomputed by a local library (None otherwise).
+        fingerprint (numpy.ndarray): The packed Morgan fingerprint of the compound (see LibraryCache), when
+            precomputed by a local library (None otherwise).
 
     Example:
         Creating an instance of MatchedSpectra:
@@ -19,7 +23,7 @@ class MatchedSpectra:
         >>> matched_spectrum = MatchedSpectra(spectrum_data, inchi_code, matching_score)
     """
 
-    def __init__(self, sp, inchi, score):
+    def __init__(self, sp, inchi, score, ranked=None, inchikey=None, fingerprint=None):
         """
         Initializes a MatchedSpectra instance.
 
@@ -27,7 +31,13 @@ class MatchedSpectra:
             spectrum: The matched spectrum data.
             inchi (str): The InChI (International Chemical Identifier) of the corresponding compound.
             score (float): The matching score indicating the degree of similarity between the spectrum and the compound.
+            ranked (list, optional): The (inchi, score) of the best hits, best first. Defaults to None.
+            inchikey (str, optional): The InChIKey of the compound. Defaults to None.
+            fingerprint (numpy.ndarray, optional): The packed Morgan fingerprint of the compound. Defaults to None.
         """
         self.spectrum = sp
         self.inchi = inchi
         self.score = score
+        self.ranked = ranked
+        self.inchikey = inchikey
+        self.fingerprint = fingerprint
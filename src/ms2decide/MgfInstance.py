@@ -1,6 +1,8 @@
 from matchms.importing import load_from_mgf
 from matchms.filtering import normalize_intensities
+from .MatchCache import spectrum_hash
 from pathlib import Path
+import copy
 
 
 class MgfInstance():
@@ -19,6 +21,9 @@ class MgfInstance():
         subdiv_file(step: int) -> List[List[Spectrum]]:
             Subdivides the loaded spectra into smaller chunks.
 
+        deduplicate() -> Tuple[MgfInstance, Dict[int, int]]:
+            Keeps one spectrum of each group of identical spectra.
+
     Example:
         Initializing an MgfInstance from a file:
 
@@ -82,3 +87,24 @@ class MgfInstance():
             k += 1
         db_div.append(data[k*step:])
         return (db_div)
+
+    def deduplicate(self):
+        """
+        Keeps one spectrum of each group of identical spectra (same peaks and precursor m/z, see
+        MatchCache.spectrum_hash), so that it is scored once for all scans of the group.
+
+        Returns:
+            tuple: An MgfInstance with the first spectrum of each group, and a dictionary {scan: representative scan}
+            for all scans.
+        """
+        representative = {}
+        first = {}
+        for i, sp in self.data.items():
+            representative[i] = first.setdefault(spectrum_hash(sp), i)
+        unique = copy.copy(self)
+        unique.data = {i: self.data[i] for i in first.values()}
+        print('==================')
+        print('DEDUPLICATION: ' + str(len(unique.data)) + ' UNIQUE OF ' + str(len(self.data)) + ' SPECTRA (RATIO ' +
+              str(round(len(self.data)/max(len(unique.data), 1), 2)) + ')')
+        print('==================')
+        return unique, representative
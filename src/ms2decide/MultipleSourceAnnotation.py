@@ -27,10 +27,12 @@ from .K import K
 from .K_old import K_old
 from .ConfEval import ConfEval
 from .Tanimotos import Tanimotos
+from .Util import report_fingerprint_stats, report_tanimoto_stats, load_structure_cache, save_structure_cache
 import pandas as pd
 
 
-def MultipleSourceAnnotation(mgf_instance, get_gnps, get_sirius, get_isdb, gnps_res, sirius_res, isdb_res, estimator):
+def MultipleSourceAnnotation(mgf_instance, get_gnps, get_sirius, get_isdb, gnps_res, sirius_res, isdb_res, estimator,
+                             scans=None, structure_cache=None):
     """
     Get aggregated annotations from GNPS, Sirius, and ISDB-LOTUS sources.
 
@@ -43,6 +45,9 @@ def MultipleSourceAnnotation(mgf_instance, get_gnps, get_sirius, get_isdb, gnps_
         sirius_res (SiriusAnnotation): Result of Sirius annotation (default=None). (sirius_res.data is the dict)
         isdb_res (dict): Result of ISDB-Lotus annotation (default=None).
         estimator (str): ['ConvEval', 'Matching', 'K', 'K_old']
+        scans (list, optional): Only annotate these spectrum IDs (see IncrementalAnnotation). Defaults to None (all).
+        structure_cache (str or Path, optional): JSON file of structure normalisations shared across runs, loaded
+            before and saved after the run (see Util.save_structure_cache). Defaults to None.
     Returns:
         dict: Dictionary containing combined annotations for each spectrum ID.
     """
@@ -65,30 +70,43 @@ def MultipleSourceAnnotation(mgf_instance, get_gnps, get_sirius, get_isdb, gnps_
     if (len(tool_dict) == 0):
         print("ERROR")
     else:
+        if (structure_cache is not None):
+            load_structure_cache(structure_cache)
         data = {}
-        for ID in mgf_instance.data:
+        dict_indexes, tanimotos = {}, {}
+        for ID in (mgf_instance.data if scans is None else scans):
             dict_index = {i: 0 for i in tool_dict}
-            dict_inchi = {i: '' for i in tool_dict}
+            dict_matched = {}
             for tool in tool_dict:
                 try:
                     dict_index[tool] = tool_dict[tool][ID].score
-                    dict_inchi[tool] = tool_dict[tool][ID].inchi
+                    dict_matched[tool] = tool_dict[tool][ID]
                 except:
                     raise TypeError(
                         "can't get annotaion for {ID="+str(ID)+", tool="+str(tool)+"}")
+            dict_indexes[ID] = dict_index
+            tanimotos[ID] = Tanimotos.from_matched(dict_matched)
+        # the similarities of all features in one bulk call, the estimators then read them from the instances
+        Tanimotos.compute_all(list(tanimotos.values()))
+        for ID in dict_indexes:
+            dict_index = dict_indexes[ID]
             if (estimator == 'ConvEval'):
-                data[ID] = ConfEval(dict_index, Tanimotos(
-                    dict_inchi)).recommendation()
+                data[ID] = ConfEval(dict_index, tanimotos[ID]).recommendation()
             elif (estimator == 'Matching'):
-                data[ID] = Matching(dict_index, Tanimotos(dict_inchi)).k()
+                data[ID] = Matching(dict_index, tanimotos[ID]).k()
             elif (estimator == 'K'):
-                data[ID] = K(dict_index, Tanimotos(dict_inchi)).k()
+                data[ID] = K(dict_index, tanimotos[ID]).k()
             elif (estimator == 'K_old'):
-                data[ID] = K_old(dict_index, Tanimotos(dict_inchi)).k()
+                data[ID] = K_old(dict_index, tanimotos[ID]).k()
+        report_tanimoto_stats()
+        report_fingerprint_stats()
+        if (structure_cache is not None):
+            save_structure_cache(structure_cache)
         return (data)
 
 
-def MultipleSourceAnnotation_to_dataframe(mgf_instance, get_gnps, get_sirius, get_isdb, gnps_res, sirius_res, isdb_res, results):
+def MultipleSourceAnnotation_to_dataframe(mgf_instance, get_gnps, get_sirius, get_isdb, gnps_res, sirius_res, isdb_res, results,
+                                          structure_cache=None):
     """
     Converts the combined annotation results into a Pandas DataFrame for easy viewing and analysis.
 
@@ -101,6 +119,8 @@ def MultipleSourceAnnotation_to_dataframe(mgf_instance, get_gnps, get_sirius, ge
         sirius_res (SiriusAnnotation): Result of Sirius annotation.
         isdb_res (dict): Result of ISDB-LOTUS annotation.
         results (dict): Combined results of different estimators in the form {estimator: results_estimator}.
+        structure_cache (str or Path, optional): JSON file of structure normalisations shared across runs, loaded
+            before and saved after the run. Defaults to None.
 
     Returns:
         pd.DataFrame: DataFrame containing combined annotations and scores for each spectrum ID.
@@ -125,6 +145,10 @@ def MultipleSourceAnnotation_to_dataframe(mgf_instance, get_gnps, get_sirius, ge
     if (get_isdb == True) and (isdb_res != None):
         tool_dict[Tool(3).name] = isdb_res
 
+    if (structure_cache is not None):
+        load_structure_cache(structure_cache)
+    tanimotos = {ID: Tanimotos.from_matched({i: tool_dict[i][ID] for i in tool_dict}) for ID in mgf_instance.data}
+    Tanimotos.compute_all(list(tanimotos.values()))
     data = []
     for ID in mgf_instance.data:
         inchi_gnps = tool_dict[Tool(1).name][ID].inchi
@@ -134,9 +158,7 @@ def MultipleSourceAnnotation_to_dataframe(mgf_instance, get_gnps, get_sirius, ge
         inchi_isdb = tool_dict[Tool(3).name][ID].inchi
         score_isdb = tool_dict[Tool(3).name][ID].score
         
-        dict_inchi = {i: tool_dict[i][ID].inchi for i in tool_dict}
-        t = Tanimotos(dict_inchi)
-        tgs, tgi, tsi = t.compute_tanimoto()
+        tgs, tgi, tsi = tanimotos[ID].compute_tanimoto()
         if(inchi_sirius=='#'):
             tgs+=0.25
             tsi+=0.25
@@ -151,4 +173,6 @@ def MultipleSourceAnnotation_to_dataframe(mgf_instance, get_gnps, get_sirius, ge
         data.append(l)
     df = pd.DataFrame(data, columns=['ID', 'inchi_gnps', 'score_gnps', 'inchi_sirius',
                       'score_sirius', 'inchi_isdb', 'score_isdb', 'tgs', 'tgi', 'tsi']+list(results.keys()))
+    if (structure_cache is not None):
+        save_structure_cache(structure_cache)
     return (df)
@@ -1,9 +1,11 @@
 import pandas as pd
 from .Tool import Tool
 from .Tanimotos import Tanimotos
+from .Util import load_structure_cache, save_structure_cache
 
 
-def MultipleSourceAnnotation_to_dataframeForSiriusFormula(mgf, get_gnps, get_sirius, get_isdb, gnps_res, sirius_res_anno, sirius_res_calcule, isdb_res, results):
+def MultipleSourceAnnotation_to_dataframeForSiriusFormula(mgf, get_gnps, get_sirius, get_isdb, gnps_res, sirius_res_anno, sirius_res_calcule, isdb_res, results,
+                                                          structure_cache=None):
     if (type(results) != dict):
         Exception(
             'results type is no dict \n please insert a resylt : dict {estimator : results_estimator} \n estimator : Matching, K, K_old, ConvEval')
@@ -24,6 +26,10 @@ def MultipleSourceAnnotation_to_dataframeForSiriusFormula(mgf, get_gnps, get_sir
     if (get_isdb == True) and (isdb_res != None):
         tool_dict['ISDB'] = isdb_res
 
+    if (structure_cache is not None):
+        load_structure_cache(structure_cache)
+    tanimotos = {ID: Tanimotos.from_matched({i: tool_dict[i][ID] for i in tool_dict}) for ID in mgf.data}
+    Tanimotos.compute_all(list(tanimotos.values()))
     data = []
     for ID in mgf.data:
         inchi_gnps = tool_dict['GNPS'][ID].inchi
@@ -33,9 +39,7 @@ def MultipleSourceAnnotation_to_dataframeForSiriusFormula(mgf, get_gnps, get_sir
         inchi_isdb = tool_dict['ISDB'][ID].inchi
         score_isdb = tool_dict['ISDB'][ID].score
 
-        dict_inchi = {i: tool_dict[i][ID].inchi for i in tool_dict}
-        t = Tanimotos(dict_inchi)
-        tgs, tgi, tsi = t.compute_tanimoto()
+        tgs, tgi, tsi = tanimotos[ID].compute_tanimoto()
         l = [ID, inchi_gnps, score_gnps, inchi_sirius_ann,
              score_sirius, inchi_isdb, score_isdb, tgs, tgi, tsi]
         for estimator in results:
@@ -43,4 +47,6 @@ def MultipleSourceAnnotation_to_dataframeForSiriusFormula(mgf, get_gnps, get_sir
         data.append(l)
     df = pd.DataFrame(data, columns=['ID', 'inchi_gnps', 'score_gnps', 'inchi_sirius',
                       'score_sirius', 'inchi_isdb', 'score_isdb', 'tgs', 'tgi', 'tsi']+list(results.keys()))
+    if (structure_cache is not None):
+        save_structure_cache(structure_cache)
     return (df)
@@ -0,0 +1,85 @@
+import numpy as np
+
+# margin added to the searchsorted bounds; the exact tolerance test is applied afterwards
+_MARGIN = 1e-6
+
+
+class PrecursorIndex():
+    """
+    Represents a sorted index over the precursor masses of a spectral library.
+
+    The index is built once per library and answers precursor-window queries in O(log N + k) with
+    `numpy.searchsorted`, instead of a full O(N) scan per query.
+
+    Attributes:
+        mass (numpy.ndarray): Precursor masses in library order (NaN when missing).
+        order (numpy.ndarray): Stable argsort of mass.
+        sorted_mass (numpy.ndarray): mass sorted in increasing order.
+
+    Example:
+        >>> index = PrecursorIndex([301.07, 287.05, 449.11])
+        >>> index.select(301.08, 0.02)
+        array([0])
+    """
+
+    def __init__(self, mass, order=None, sorted_mass=None):
+        """
+        Initializes a PrecursorIndex.
+
+        Args:
+            mass (list or numpy.ndarray): Precursor masses in library order.
+            order (numpy.ndarray, optional): Precomputed stable argsort of mass.
+            sorted_mass (numpy.ndarray, optional): Precomputed mass[order].
+        """
+        self.mass = np.asarray(mass, dtype=np.float64)
+        if (order is None) or (sorted_mass is None):
+            order = np.argsort(self.mass, kind='stable')
+            sorted_mass = self.mass[order]
+        self.order = order
+        self.sorted_mass = sorted_mass
+
+    def __len__(self):
+        return (len(self.mass))
+
+    def select(self, m, tolerance):
+        """
+        Select the library entries whose precursor mass is within tolerance of m.
+
+        Args:
+            m (float): The query precursor mass.
+            tolerance (float): The maximum allowable difference between the precursor masses.
+
+        Returns:
+            numpy.ndarray: Indices of the selected entries, in library order.
+        """
+        if (m is None) or (np.isnan(m)):
+            return (np.zeros(0, dtype=np.int64))
+        low = np.searchsorted(self.sorted_mass, m - tolerance - _MARGIN, side='left')
+        high = np.searchsorted(self.sorted_mass, m + tolerance + _MARGIN, side='right')
+        idx = np.asarray(self.order[low:high])
+        idx = idx[np.abs(self.mass[idx]-m) <= tolerance]
+        return (np.sort(idx))
+
+    def select_many(self, masses, tolerance):
+        """
+        Select the library entries within tolerance of each of many query masses at once.
+
+        Args:
+            masses (list or numpy.ndarray): The query precursor masses (NaN when missing).
+            tolerance (float): The maximum allowable difference between the precursor masses.
+
+        Returns:
+            tuple: Query and library indices of all selected pairs, ordered by query then library index.
+        """
+        masses = np.asarray(masses, dtype=np.float64)
+        low = np.searchsorted(self.sorted_mass, masses - tolerance - _MARGIN, side='left')
+        high = np.searchsorted(self.sorted_mass, masses + tolerance + _MARGIN, side='right')
+        high = np.where(np.isnan(masses), low, np.maximum(high, low))
+        counts = high - low
+        row = np.repeat(np.arange(len(masses)), counts)
+        position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + low[row]
+        col = np.asarray(self.order[position], dtype=np.int64)
+        keep = np.abs(self.mass[col]-masses[row]) <= tolerance
+        row, col = row[keep], col[keep]
+        order = np.lexsort((col, row))
+        return row[order], col[order]
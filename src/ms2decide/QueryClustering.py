@@ -0,0 +1,120 @@
+"""
+This module clusters near-duplicate query spectra before local annotation, so that only one spectrum of each
+cluster is searched against the library.
+
+Two spectra of an MgfInstance are neighbours when their precursor m/z are within the tolerance and the cosine
+of their peaks (matchms CosineGreedy, see SimilarityBackends) is at least the threshold. Clusters are built
+greedily: the spectrum with the most unclustered neighbours becomes the representative of a cluster holding
+those neighbours, until all spectra are clustered. Every member is therefore similar to its representative,
+without chaining through other members. The representative is a spectrum of the run (a medoid), not a merged
+spectrum, so that its annotation is the one of a plain run.
+
+The annotation of a representative is given to the other members of its cluster with a score penalty.
+
+Typical usage example:
+    clustering = QueryClustering(threshold=0.95, penalty=0.05)
+    isdb_res = get_cfm_annotation_GUI(path_isdb, mgf, clustering=clustering)
+    clustering.report()
+"""
+
+from .BatchScoring import _as_csr, _invalid_spectra, _modified_cosine_pairs
+from .PrecursorIndex import PrecursorIndex
+from scipy import sparse
+import numpy as np
+import heapq
+import copy
+
+
+class QueryClustering():
+    """
+    Represents the clustering of near-duplicate query spectra, with its statistics.
+
+    Attributes:
+        threshold (float): Minimum cosine of two spectra of a cluster with its representative.
+        penalty (float): Relative penalty on the scores given to the members of a cluster.
+        stats (dict): Numbers of clustered spectra and of clusters.
+
+    Example:
+        >>> clustering = QueryClustering(threshold=0.95)
+        >>> representatives, representative = clustering.cluster(mgf, 0.02, 0.0, 0.5)
+    """
+
+    def __init__(self, threshold=0.95, penalty=0.05):
+        """
+        Initializes a QueryClustering.
+
+        Args:
+            threshold (float, optional): Minimum cosine of a member with its representative. Defaults to 0.95.
+            penalty (float, optional): Relative penalty on the scores of the members, a member gets the score of
+                its representative times (1 - penalty). Defaults to 0.05.
+        """
+        if (not 0 <= penalty <= 1):
+            raise ValueError('penalty must be between 0 and 1')
+        self.threshold = threshold
+        self.penalty = penalty
+        self.stats = {'spectra': 0, 'clusters': 0}
+
+    def cluster(self, mgf, tolerance, mz_power, intensity_power):
+        """
+        Cluster the spectra of an MgfInstance.
+
+        Args:
+            mgf (MgfInstance): An instance of MgfInstance containing spectra data.
+            tolerance (float): Mass tolerance for the precursor window and peak matching.
+            mz_power (float): Power applied to mass values for scoring.
+            intensity_power (float): Power applied to intensity values for scoring.
+
+        Returns:
+            tuple: An MgfInstance with the representative of each cluster, and a dictionary
+            {scan: representative scan} for all scans.
+        """
+        scans = list(mgf.data)
+        query = _as_csr(list(mgf.data.values()))
+        row, col = PrecursorIndex(query[3]).select_many(query[3], tolerance)
+        invalid = _invalid_spectra(query)
+        keep = (row < col) & ~invalid[row] & ~invalid[col]
+        row, col = row[keep], col[keep]
+        score, _ = _modified_cosine_pairs(query, query, row, col, tolerance, mz_power, intensity_power,
+                                          shifted=False)
+        similar = score >= self.threshold
+        row, col = row[similar], col[similar]
+        neighbours = sparse.csr_matrix((np.ones(2*len(row), dtype=bool), (np.r_[row, col], np.r_[col, row])),
+                                       shape=(len(scans), len(scans)))
+
+        owner = np.full(len(scans), -1)
+        # the spectrum with most unclustered neighbours first, in scan order among equal numbers; the numbers
+        # only decrease, so a popped spectrum whose number dropped is pushed back with its current number
+        heap = [(-int(d), r) for r, d in enumerate(np.diff(neighbours.indptr))]
+        heapq.heapify(heap)
+        while (len(heap) != 0):
+            degree, r = heapq.heappop(heap)
+            if (owner[r] != -1):
+                continue
+            members = neighbours.indices[neighbours.indptr[r]:neighbours.indptr[r+1]]
+            members = members[owner[members] == -1]
+            if (len(members) != -degree):
+                heapq.heappush(heap, (-len(members), r))
+                continue
+            owner[members] = r
+            owner[r] = r
+
+        representative = {scans[r]: scans[owner[r]] for r in range(len(scans))}
+        representatives = copy.copy(mgf)
+        representatives.data = {i: mgf.data[i] for i in mgf.data if representative[i] == i}
+        self.stats['spectra'] += len(scans)
+        self.stats['clusters'] += len(representatives.data)
+        return representatives, representative
+
+    def report(self, reset=True):
+        """
+        Print the statistics of the clustering.
+
+        Args:
+            reset (bool, optional): Whether to reset the statistics afterwards. Defaults to True.
+        """
+        print('==================')
+        print('QUERY CLUSTERING: ' + str(self.stats['clusters']) + ' CLUSTERS OF ' + str(self.stats['spectra']) +
+              ' SPECTRA (RATIO ' + str(round(self.stats['spectra']/max(self.stats['clusters'], 1), 2)) + ')')
+        print('==================')
+        if (reset):
+            self.stats = dict.fromkeys(self.stats, 0)
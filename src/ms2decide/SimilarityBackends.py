@@ -0,0 +1,215 @@
+"""
+This module holds the registry of spectral similarity backends used by local annotation.
+
+Every backend is a pair scoring function with the interface of BatchScoring._modified_cosine_pairs: it scores
+many (query, reference) spectrum pairs given as CSR peak arrays and returns the scores and numbers of matched
+peaks of the pairs. A backend therefore plugs both into the per-feature search (Util._get_match) and into the
+sparse score matrix (BatchScoring._score_matrix).
+
+Backends:
+    1. modified_cosine:
+       matchms ModifiedCosineGreedy, peaks matched without shift and with the precursor mass shift (default).
+
+    2. cosine_greedy:
+       matchms CosineGreedy, the same greedy assignment without the shifted peak pairs.
+
+    3. cosine_hungarian:
+       matchms CosineHungarian, the optimal assignment of the unshifted peak pairs (scipy linear_sum_assignment).
+
+    4. spectral_entropy:
+       Unweighted spectral entropy similarity: intensities are normalised to sum to 1 in each spectrum, peaks
+       are matched greedily by intensity product without shift, and each matched pair (a, b) contributes
+       ((a+b)ln(a+b) - a ln(a) - b ln(b))/ln(4). The m/z and intensity powers are not used.
+
+The throughput of the backends on the test MGF file is measured by benchmarks/backends.py.
+
+Typical usage example:
+    isdb_res = get_cfm_annotation(mgf, 0.5, backend='spectral_entropy')
+"""
+
+from .BatchScoring import _as_csr, _peak_pairs, _greedy_assignment, _modified_cosine_pairs, _pair_products
+from scipy.optimize import linear_sum_assignment
+from scipy.special import xlogy
+import numpy as np
+
+
+def _cosine_greedy_pairs(query, ref, pair_query, pair_ref, tolerance, mz_power, intensity_power):
+    """
+    Score many (query, reference) spectrum pairs with the cosine of matchms CosineGreedy.
+
+    Args:
+        query (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the queries.
+        ref (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the references.
+        pair_query (numpy.ndarray): Query of each spectrum pair.
+        pair_ref (numpy.ndarray): Reference of each spectrum pair.
+        tolerance (float): The allowable mass difference for matching peaks.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+
+    Returns:
+        tuple: Scores and numbers of matched peaks of the spectrum pairs.
+    """
+    return (_modified_cosine_pairs(query, ref, pair_query, pair_ref, tolerance, mz_power, intensity_power,
+                                   shifted=False))
+
+
+def _cosine_hungarian_pairs(query, ref, pair_query, pair_ref, tolerance, mz_power, intensity_power):
+    """
+    Score many (query, reference) spectrum pairs with the cosine of matchms CosineHungarian.
+
+    Each spectrum pair is solved on its own, with the cost matrix and the NumPy normalisation of matchms.
+
+    Args:
+        query (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the queries.
+        ref (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the references.
+        pair_query (numpy.ndarray): Query of each spectrum pair.
+        pair_ref (numpy.ndarray): Reference of each spectrum pair.
+        tolerance (float): The allowable mass difference for matching peaks.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+
+    Returns:
+        tuple: Scores and numbers of matched peaks of the spectrum pairs.
+    """
+    query_mz, query_intensities, query_offsets, _ = query
+    ref_mz, ref_intensities, ref_offsets, _ = ref
+    n_pairs = len(pair_query)
+    probe_pair, probe_peak, probe, qpeak = _peak_pairs(query, ref, pair_query, pair_ref, tolerance, shifted=False)
+    owner = probe_pair[probe]
+    rpeak = probe_peak[probe]
+
+    ref_power = ref_mz ** mz_power * ref_intensities ** intensity_power
+    query_power = query_mz ** mz_power * query_intensities ** intensity_power
+    product = _pair_products(ref_mz, ref_intensities, rpeak, query_mz, query_intensities, qpeak,
+                             float(mz_power), float(intensity_power))
+
+    score = np.zeros(n_pairs)
+    matches = np.zeros(n_pairs, dtype=np.int64)
+    bounds = np.flatnonzero(np.diff(owner, prepend=-1, append=-1))
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        # rows and columns in the order of matchms: sets of the peaks of the pairs sorted by decreasing product
+        i, j = pair_ref[owner[a]], pair_query[owner[a]]
+        r = (rpeak[a:b] - ref_offsets[i]).tolist()
+        c = (qpeak[a:b] - query_offsets[j]).tolist()
+        # rows and columns in the order of matchms: sets of the peaks of the pairs sorted by decreasing product
+        order = np.argsort(product[a:b], kind='mergesort')[::-1].tolist()
+        rows = {peak: k for k, peak in enumerate(set(r[k] for k in order))}
+        cols = {peak: k for k, peak in enumerate(set(c[k] for k in order))}
+        # cost 1 - product, as matchms, so that peaks without a pair are assigned at cost 1
+        cost = np.ones((len(rows), len(cols)))
+        cost[[rows[peak] for peak in r], [cols[peak] for peak in c]] -= product[a:b]
+        row_ind, col_ind = linear_sum_assignment(cost)
+        # the assignments of cost 1 are peaks without a pair: they add nothing to the score and are not matches
+        total = len(row_ind) - cost[row_ind, col_ind].sum()
+        matches[owner[a]] = (cost[row_ind, col_ind] < 1.0).sum()
+        score[owner[a]] = total/(np.sqrt(np.sum(ref_power[ref_offsets[i]:ref_offsets[i+1]]**2))
+                                 * np.sqrt(np.sum(query_power[query_offsets[j]:query_offsets[j+1]]**2)))
+    return score, matches
+
+
+def _spectral_entropy_pairs(query, ref, pair_query, pair_ref, tolerance, mz_power, intensity_power):
+    """
+    Score many (query, reference) spectrum pairs with the unweighted spectral entropy similarity.
+
+    Args:
+        query (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the queries.
+        ref (tuple): CSR arrays (m/z, intensities, offsets, precursor m/z) of the references.
+        pair_query (numpy.ndarray): Query of each spectrum pair.
+        pair_ref (numpy.ndarray): Reference of each spectrum pair.
+        tolerance (float): The allowable mass difference for matching peaks.
+        mz_power (float): Unused.
+        intensity_power (float): Unused.
+
+    Returns:
+        tuple: Scores and numbers of matched peaks of the spectrum pairs.
+    """
+    query_intensities, query_offsets = query[1], query[2]
+    ref_intensities, ref_offsets = ref[1], ref[2]
+    n_pairs = len(pair_query)
+    probe_pair, probe_peak, probe, qpeak = _peak_pairs(query, ref, pair_query, pair_ref, tolerance, shifted=False)
+    owner = probe_pair[probe]
+
+    a = _normalised_intensities(ref_intensities, ref_offsets)[probe_peak[probe]]
+    b = _normalised_intensities(query_intensities, query_offsets)[qpeak]
+    order = np.lexsort((-np.arange(len(probe)), -a*b, owner))
+    probe, qpeak, owner, a, b = probe[order], qpeak[order], owner[order], a[order], b[order]
+    accepted = _greedy_assignment(probe, owner * len(query_intensities) + qpeak)
+
+    a, b, owner = a[accepted], b[accepted], owner[accepted]
+    gain = xlogy(a+b, a+b) - xlogy(a, a) - xlogy(b, b)
+    score = np.bincount(owner, weights=gain, minlength=n_pairs) / np.log(4)
+    matches = np.bincount(owner, minlength=n_pairs)
+    return np.clip(score, 0.0, 1.0), matches
+
+
+def _normalised_intensities(intensities, offsets):
+    """
+    Normalise the intensities of CSR spectra to sum to 1 in each spectrum.
+
+    Args:
+        intensities (numpy.ndarray): Concatenated intensities.
+        offsets (numpy.ndarray): Offsets of the spectra.
+
+    Returns:
+        numpy.ndarray: The normalised intensities.
+    """
+    intensities = np.asarray(intensities, dtype=np.float64)
+    owner = np.repeat(np.arange(len(offsets)-1), np.diff(offsets))
+    total = np.bincount(owner, weights=intensities, minlength=len(offsets)-1)
+    return (intensities / np.where(total == 0, 1, total)[owner])
+
+
+BACKENDS = {
+    'modified_cosine': _modified_cosine_pairs,
+    'cosine_greedy': _cosine_greedy_pairs,
+    'cosine_hungarian': _cosine_hungarian_pairs,
+    'spectral_entropy': _spectral_entropy_pairs,
+}
+
+
+def register_backend(name, score_function):
+    """
+    Add a similarity backend to the registry.
+
+    Args:
+        name (str): Name of the backend.
+        score_function (callable): Pair scoring function with the interface of _modified_cosine_pairs.
+    """
+    BACKENDS[name] = score_function
+
+
+def get_backend(name):
+    """
+    Get the pair scoring function of a similarity backend.
+
+    Args:
+        name (str): Name of the backend.
+
+    Returns:
+        callable: The pair scoring function.
+    """
+    if (name not in BACKENDS):
+        raise ValueError('Unknown similarity backend ' + str(name) + ', expected one of ' + ', '.join(BACKENDS))
+    return (BACKENDS[name])
+
+
+def score_candidates(backend, sp, candidates, tolerance, mz_power, intensity_power):
+    """
+    Score a query spectrum against all of its candidates with a similarity backend.
+
+    Args:
+        backend (str): Name of the backend.
+        sp (Spectrum): The query spectrum.
+        candidates (list or SpectralLibrary): The candidate spectra.
+        tolerance (float): The allowable mass difference for matching peaks.
+        mz_power (float): Power applied to mass values for scoring.
+        intensity_power (float): Power applied to intensity values for scoring.
+
+    Returns:
+        tuple: Scores and numbers of matched peaks of the candidates.
+    """
+    score_function = get_backend(backend)
+    ref = _as_csr(candidates)
+    n_ref = len(ref[2])-1
+    return (score_function(_as_csr([sp]), ref, np.zeros(n_ref, dtype=np.int64), np.arange(n_ref),
+                           tolerance, mz_power, intensity_power))
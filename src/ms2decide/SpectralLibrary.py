@@ -0,0 +1,214 @@
+from .PrecursorIndex import PrecursorIndex
+from matchms import Spectrum
+from pathlib import Path
+import numpy as np
+
+_METADATA_KEYS = ['inchi', 'smiles', 'compound_name', 'spectrum_id']
+# precomputed structure columns (see LibraryCache._structure)
+_STRUCTURE_KEYS = ['canonical_inchi', 'inchikey']
+# uint64 words of a packed 2048-bit fingerprint
+_FINGERPRINT_WORDS = 32
+
+
+def _load_strings(cache_dir, name, mmap_mode='r'):
+    """
+    Load a string column written by LibraryCache.
+
+    Args:
+        cache_dir (Path): The cache directory.
+        name (str): The column name.
+        mmap_mode (str, optional): Memory-map mode passed to numpy.load. Defaults to 'r'.
+
+    Returns:
+        tuple: The UTF-8 byte blob and the offsets array of the column.
+    """
+    blob = np.load(str(Path(cache_dir) / ('meta_' + name + '.npy')), mmap_mode=mmap_mode)
+    offsets = np.load(str(Path(cache_dir) / ('meta_' + name + '_offsets.npy')), mmap_mode=mmap_mode)
+    return blob, offsets
+
+
+class SpectralLibrary():
+    """
+    Represents a spectral library stored as memory-mapped CSR arrays.
+
+    All peaks of the library live in two concatenated float arrays (m/z and intensities) and an
+    offsets array: the peaks of spectrum i are mz[offsets[i]:offsets[i+1]]. The arrays are
+    memory-mapped read-only from the library cache, so that several annotation processes on one
+    node share a single physical copy of the library through the OS page cache.
+
+    matchms Spectrum objects are only built on demand, when a library entry is accessed by index.
+
+    Attributes:
+        path (Path): The cache directory of the library.
+        mz (numpy.ndarray): Concatenated m/z values of all library spectra.
+        intensities (numpy.ndarray): Concatenated intensities of all library spectra.
+        offsets (numpy.ndarray): Start of the peaks of each spectrum, with a final end marker.
+        precursor_mz (numpy.ndarray): Precursor m/z of each spectrum (NaN when missing).
+        precursor_order (numpy.ndarray): Stable argsort of precursor_mz.
+        precursor_sorted (numpy.ndarray): precursor_mz sorted in increasing order.
+        precursor_index (PrecursorIndex): Precursor-window index over the memory-mapped arrays.
+        fingerprints (numpy.ndarray): Packed Morgan fingerprint of each spectrum, one row of uint64 words.
+
+    Example:
+        >>> library = SpectralLibrary(Path('path/to/isdb_pos.ms2decide'))
+        >>> len(library)
+        >>> sp = library[0]
+    """
+
+    def __init__(self, cache_dir, mmap_mode='r'):
+        """
+        Initializes a SpectralLibrary from a library cache directory.
+
+        Args:
+            cache_dir (Path): The cache directory written by LibraryCache.compile_library.
+            mmap_mode (str, optional): Memory-map mode passed to numpy.load, None to load in memory. Defaults to 'r'.
+        """
+        self.path = Path(cache_dir)
+        self.mz = np.load(str(self.path / 'mz.npy'), mmap_mode=mmap_mode)
+        self.intensities = np.load(str(self.path / 'intensities.npy'), mmap_mode=mmap_mode)
+        self.offsets = np.load(str(self.path / 'offsets.npy'), mmap_mode=mmap_mode)
+        self.precursor_mz = np.load(str(self.path / 'precursor_mz.npy'), mmap_mode=mmap_mode)
+        self.precursor_order = np.load(str(self.path / 'precursor_order.npy'), mmap_mode=mmap_mode)
+        self.precursor_sorted = np.load(str(self.path / 'precursor_sorted.npy'), mmap_mode=mmap_mode)
+        self.precursor_index = PrecursorIndex(
+            self.precursor_mz, self.precursor_order, self.precursor_sorted)
+        self._metadata = {k: _load_strings(self.path, k, mmap_mode) for k in _METADATA_KEYS + _STRUCTURE_KEYS}
+        self.fingerprints = np.load(str(self.path / 'fingerprints.npy'), mmap_mode=mmap_mode)
+        self._rows = None
+        self._structure_rows = None
+
+    def __len__(self):
+        return (len(self.precursor_mz))
+
+    def __getitem__(self, i):
+        """
+        Build the matchms Spectrum of a library entry.
+
+        Args:
+            i (int): Index of the library entry.
+
+        Returns:
+            Spectrum: The library spectrum with its precursor m/z and structure metadata.
+        """
+        mz, intensities = self.peaks(i)
+        metadata = {}
+        for k in _METADATA_KEYS + _STRUCTURE_KEYS:
+            v = self.get(k, i)
+            if (v is not None):
+                metadata[k] = v
+        m = self.precursor_mz[i]
+        metadata['precursor_mz'] = None if np.isnan(m) else float(m)
+        return (Spectrum(mz=mz, intensities=intensities, metadata=metadata, metadata_harmonization=False))
+
+    def take(self, idx):
+        """
+        Gather a subset of the library into memory.
+
+        The peaks of the selected entries are copied into new CSR arrays; metadata stay in the
+        memory-mapped columns of the parent library.
+
+        Args:
+            idx (numpy.ndarray): Indices of the library entries to keep.
+
+        Returns:
+            SpectralLibrary: The subset, in the order of idx.
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        start = np.asarray(self.offsets[idx])
+        counts = np.asarray(self.offsets[idx+1]) - start
+        offsets = np.zeros(len(idx)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        position = np.arange(offsets[-1]) + np.repeat(start - offsets[:-1], counts)
+
+        subset = SpectralLibrary.__new__(SpectralLibrary)
+        subset.path = self.path
+        subset.mz = np.asarray(self.mz[position])
+        subset.intensities = np.asarray(self.intensities[position])
+        subset.offsets = offsets
+        subset.precursor_mz = np.asarray(self.precursor_mz[idx])
+        subset.precursor_order = np.argsort(subset.precursor_mz, kind='stable')
+        subset.precursor_sorted = subset.precursor_mz[subset.precursor_order]
+        subset.precursor_index = PrecursorIndex(
+            subset.precursor_mz, subset.precursor_order, subset.precursor_sorted)
+        subset._metadata = self._metadata
+        subset.fingerprints = self.fingerprints
+        subset._rows = self._row(idx)
+        subset._structure_rows = self._structure_rows
+        return (subset)
+
+    def _row(self, i):
+        """
+        Get the row of an entry in the memory-mapped metadata columns.
+
+        Args:
+            i (int or numpy.ndarray): Index of the entry in this library.
+
+        Returns:
+            int or numpy.ndarray: Row of the entry in the metadata columns.
+        """
+        if (self._rows is None):
+            return (i)
+        return (self._rows[i])
+
+    def peaks(self, i):
+        """
+        Get the peaks of a library entry without building a Spectrum.
+
+        Args:
+            i (int): Index of the library entry.
+
+        Returns:
+            tuple: m/z and intensities arrays of the spectrum.
+        """
+        a, b = self.offsets[i], self.offsets[i+1]
+        return np.array(self.mz[a:b]), np.array(self.intensities[a:b])
+
+    def get(self, key, i):
+        """
+        Get a metadata value of a library entry.
+
+        Args:
+            key (str): The metadata key ('inchi', 'smiles', 'compound_name', 'spectrum_id', 'canonical_inchi',
+                'inchikey').
+            i (int): Index of the library entry.
+
+        Returns:
+            str: The metadata value, or None if missing.
+        """
+        blob, offsets = self._metadata[key]
+        i = self._row(i)
+        v = bytes(blob[offsets[i]:offsets[i+1]]).decode('utf-8')
+        if (v == '\x00'):
+            return (None)
+        return (v)
+
+    def structure(self, inchi):
+        """
+        Get the precomputed InChIKey and packed Morgan fingerprint of a structure of the library.
+
+        Args:
+            inchi (str): The canonical InChI of the structure, as returned by Util.get_correct_inchi.
+
+        Returns:
+            tuple: The InChIKey and the packed fingerprint, (None, None) if the structure is not in the library.
+        """
+        if (self._structure_rows is None):
+            blob, offsets = self._metadata['canonical_inchi']
+            text = bytes(blob).decode('utf-8')
+            # offsets are in bytes, decode each value on its own when the text is not pure ASCII
+            if (len(text) == len(blob)):
+                values = [text[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)]
+            else:
+                values = [bytes(blob[offsets[i]:offsets[i+1]]).decode('utf-8') for i in range(len(offsets)-1)]
+            rows = {}
+            for row, v in enumerate(values):
+                rows.setdefault(v, row)
+            self._structure_rows = rows
+        row = self._structure_rows.get(inchi)
+        if (row is None) or (inchi in ['#', '?', '*']):
+            return None, None
+        blob, offsets = self._metadata['inchikey']
+        key = bytes(blob[offsets[row]:offsets[row+1]]).decode('utf-8')
+        if (key == '\x00'):
+            return None, None
+        return key, np.array(self.fingerprints[row])
@@ -1,7 +1,6 @@
-from rdkit import Chem
 from itertools import combinations
 from .Tool import Tool
-from .Util import tanimoto
+from .Util import tanimoto, tanimoto_many, normalise_structure, register_structure
 
 
 class Tanimotos():
@@ -13,6 +12,7 @@ class Tanimotos():
 
     Attributes:
         data (dict): A dictionary containing tool annotations with tool names as keys.
+        keys (dict): The precomputed InChIKey of the annotation of each tool, None when unknown.
 
     Methods:
         __init__(dict_annotations: dict):
@@ -21,6 +21,12 @@ class Tanimotos():
         compute_tanimoto() -> Tuple[float, float, float]:
             Computes Tanimoto similarity scores between pairs of tools and returns the results.
 
+        from_matched(matched: dict) -> Tanimotos:
+            Initializes a Tanimotos instance from the MatchedSpectra of the tools.
+
+        compute_all(instances: list):
+            Computes the Tanimoto similarity scores of many instances at once.
+
     Example:
         Initializing a Tanimotos instance with tool annotations:
 
@@ -34,46 +40,97 @@ class Tanimotos():
         >>> tgs, tgi, tsi = tanimoto_instance.compute_tanimoto()
     """
 
-    def __init__(self,  dict_annotations):
+    def __init__(self,  dict_annotations, dict_structures=None):
         """
         Initializes a Tanimotos instance with a dictionary of tool annotations.
 
         Args:
             dict_annotations (dict): A dictionary containing tool annotations with tool names as keys.
+            dict_structures (dict, optional): The precomputed (InChIKey, packed fingerprint) of the annotations
+                found in a library cache, with tool names as keys. Defaults to None.
         """
+        structures = {} if dict_structures is None else dict_structures
         d = {i: 0 for i in dict_annotations}
+        keys = {i: None for i in dict_annotations}
         for i in d:
             
             # TODO the values '#' represent miss match in isdb
             if(dict_annotations[i] in ['#','?','*']):
                 d[i] = dict_annotations[i]
             elif(str(dict_annotations[i]) != 'nan'):
-                try:
-                    mol = Chem.MolFromInchi(dict_annotations[i])
-                    inchi = Chem.MolToInchi(mol)
-                    d[i] = inchi
-                except:
+                inchikey, fingerprint = structures.get(i, (None, None))
+                if (inchikey is not None):
+                    # a canonical InChI of the library, normalised and fingerprinted without RDKit
+                    register_structure(dict_annotations[i], fingerprint)
+                    keys[i] = inchikey
+                inchi, valid = normalise_structure(dict_annotations[i])
+                if (not valid):
                     raise Exception('check inchi for tool '+i)
+                d[i] = inchi
         self.data = d
+        self.keys = keys
         self.averages = None
         self.tgs = None
         self.tgi = None
         self.tsi = None
 
-    def _compute_tanimoto(self):
+    def _couples(self):
         """
-        Computes Tanimoto similarity scores between pairs of tools.
+        Get the pairs of tools of the instance with the attribute of their Tanimoto similarity score.
+
+        Returns:
+            list: List of (tool, tool, attribute) tuples.
         """
-        tools = list(self.data.keys())
-        couples = list(combinations(tools, 2))
-        data = self.data
-        for i in couples:
+        couples = []
+        for i in combinations(list(self.data.keys()), 2):
             if(i == ('GNPS', 'SIRIUS')) or (i == ('SIRIUS', 'GNPS')):
-                self.tgs = tanimoto(data[i[0]], data[i[1]])
+                couples.append(i + ('tgs',))
             if(i == ('GNPS', 'ISDB')) or (i == ('ISDB', 'GNPS')):
-                self.tgi = tanimoto(data[i[0]], data[i[1]])
+                couples.append(i + ('tgi',))
             if(i == ('ISDB', 'SIRIUS')) or (i == ('SIRIUS', 'ISDB')):
-                self.tsi = tanimoto(data[i[0]], data[i[1]])
+                couples.append(i + ('tsi',))
+        return (couples)
+
+    def _compute_tanimoto(self):
+        """
+        Computes Tanimoto similarity scores between pairs of tools.
+        """
+        data = self.data
+        for a, b, attribute in self._couples():
+            setattr(self, attribute, tanimoto(data[a], data[b], self.keys[a], self.keys[b]))
+
+    @staticmethod
+    def from_matched(matched):
+        """
+        Initializes a Tanimotos instance from the MatchedSpectra of the tools, with their precomputed structures.
+
+        Args:
+            matched (dict): The MatchedSpectra of the feature with tool names as keys.
+
+        Returns:
+            Tanimotos: The instance.
+        """
+        return (Tanimotos({i: matched[i].inchi for i in matched},
+                          {i: (getattr(matched[i], 'inchikey', None), getattr(matched[i], 'fingerprint', None))
+                           for i in matched}))
+
+    @staticmethod
+    def compute_all(instances):
+        """
+        Computes the Tanimoto similarity scores of all pairs of tools of many instances at once, with one bulk
+        fingerprint kernel call (see Util.bulk_tanimoto) instead of one call per pair.
+
+        Args:
+            instances (list): List of Tanimotos instances, e.g. one per feature of a run.
+        """
+        pairs, keys, targets = [], [], []
+        for t in instances:
+            for a, b, attribute in t._couples():
+                pairs.append((t.data[a], t.data[b]))
+                keys.append((t.keys[a], t.keys[b]))
+                targets.append((t, attribute))
+        for (t, attribute), s in zip(targets, tanimoto_many(pairs, keys)):
+            setattr(t, attribute, s)
 
     def compute_tanimoto(self):
         """
@@ -89,7 +146,7 @@ class Tanimotos():
 
     def _averages(self):
         d = {}
-        self._compute_tanimoto()
+        self.compute_tanimoto()
         for i in self.data:
             if i == Tool(1).name:
                 d[i] = (self.tgs+self.tgi)/2
@@ -6,9 +6,29 @@ from pathlib import Path
 from urllib import request
 from matchms import Spectrum
 from decimal import Decimal
-from matchms.similarity import ModifiedCosineGreedy
-from matchms import calculate_scores
+from .PrecursorIndex import PrecursorIndex
+from .BatchScoring import _top_candidates, _top_scores, _as_csr, _invalid_spectra
+from .SimilarityBackends import score_candidates
+from collections import OrderedDict
 import warnings
+import json
+
+# counters of _get_match: queries, queries that could not be scored (malformed query or candidates),
+# candidates, and malformed candidates left out of the scoring
+MATCH_STATS = {'queries': 0, 'failed_queries': 0, 'candidates': 0, 'invalid_candidates': 0}
+# bounded LRU cache of the packed Morgan fingerprints of tanimoto, {inchi: fingerprint}, and its counters
+FINGERPRINT_CACHE_SIZE = 100000
+_FINGERPRINTS = OrderedDict()
+FINGERPRINT_STATS = {'hits': 0, 'misses': 0}
+# fast path of tanimoto for agreeing structures: counters of the scored pairs and of the pairs answered without
+# fingerprints, and whether InChIs equal up to their stereo layers (same 2D InChIKey block) also count as agreeing
+TANIMOTO_STATS = {'pairs': 0, 'inchikey': 0, 'identical': 0, 'same_2d': 0}
+TANIMOTO_2D_FAST_PATH = False
+# bounded LRU memos of the structure normalisation, {raw InChI: (InChI, valid)} and {raw SMILES: InChI}; the
+# Mol objects are not kept, they are rebuilt from the canonical InChI when a fingerprint is computed
+STRUCTURE_CACHE_SIZE = 100000
+_STRUCTURES = OrderedDict()
+_SMILES = OrderedDict()
 
 
 # tool need to be gnps=> for gnps / isdb_pos => for isdb pos / isdb_neg => for isdb neg
@@ -106,26 +126,246 @@ def path_gnps():
     return (_check_file_and_download('gnps'))
 
 
-def tanimoto(inc1, inc2):
+def tanimoto(inc1, inc2, key1=None, key2=None):
     """
     Compute Tanimoto similarity between two InChI representations.
 
     Args:
         inc1 (str): The first InChI representation.
         inc2 (str): The second InChI representation.
+        key1 (str, optional): The precomputed InChIKey of inc1 (see LibraryCache). Defaults to None.
+        key2 (str, optional): The precomputed InChIKey of inc2. Defaults to None.
 
     Returns:
         float: Tanimoto similarity score.
     """
     if (inc1 in ['#','?','*']) or (inc2 in ['#','?','*']):
         return (0)
+    elif (_same_structure(inc1, inc2, key1, key2)):
+        return (1.0)
     else:
-        mol1 = Chem.MolFromInchi(inc1)
-        mol2 = Chem.MolFromInchi(inc2)
-        fp1 = AllChem.GetMorganFingerprintAsBitVect(mol1, 2,  nBits=2048)
-        fp2 = AllChem.GetMorganFingerprintAsBitVect(mol2, 2, nBits=2048)
-        s = DataStructs.TanimotoSimilarity(fp1, fp2)
-        return s
+        fp1 = morgan_fingerprint(inc1)
+        fp2 = morgan_fingerprint(inc2)
+        s = bulk_tanimoto(fp1[None], fp2[None])[0]
+        return float(s)
+
+
+def tanimoto_many(pairs, keys=None):
+    """
+    Compute the Tanimoto similarity of many pairs of InChI representations with one bulk_tanimoto call.
+
+    Args:
+        pairs (list): List of (inc1, inc2) tuples.
+        keys (list, optional): The precomputed InChIKeys (key1, key2) of each pair, None when unknown.
+            Defaults to None.
+
+    Returns:
+        list: Tanimoto similarity score of each pair, 0 when one of the InChIs is '#', '?' or '*' (as tanimoto).
+            Pairs of agreeing structures (see _same_structure) are 1 without fingerprints.
+    """
+    valid = [i for i, (inc1, inc2) in enumerate(pairs)
+             if (inc1 not in ['#','?','*']) and (inc2 not in ['#','?','*'])]
+    scores = [0] * len(pairs)
+    keys = [(None, None)] * len(pairs) if keys is None else keys
+    for i in valid:
+        if (_same_structure(*pairs[i], *keys[i])):
+            scores[i] = 1.0
+    valid = [i for i in valid if scores[i] == 0]
+    if (len(valid) == 0):
+        return (scores)
+    fp1 = np.stack([morgan_fingerprint(pairs[i][0]) for i in valid])
+    fp2 = np.stack([morgan_fingerprint(pairs[i][1]) for i in valid])
+    for i, s in zip(valid, bulk_tanimoto(fp1, fp2)):
+        scores[i] = float(s)
+    return (scores)
+
+
+def _same_structure(inc1, inc2, key1=None, key2=None):
+    """
+    Check whether two canonical InChIs are the same structure, so that their Tanimoto similarity is 1 without
+    computing fingerprints, and count the pair in TANIMOTO_STATS.
+
+    Identical InChIs (identical InChIKeys) always have the same fingerprint; the InChIKeys precomputed by a
+    library cache are compared when both are known, the InChIs otherwise. With TANIMOTO_2D_FAST_PATH, InChIs
+    differing only by their stereo layers (/b, /t, /m, /s, the second InChIKey block) also agree: the Morgan
+    fingerprint ignores stereochemistry, but a double bond stereo layer can fix a tautomer whose fingerprint
+    differs, so this is not exact for every pair.
+
+    Args:
+        inc1 (str): The first canonical InChI.
+        inc2 (str): The second canonical InChI.
+        key1 (str, optional): The precomputed InChIKey of inc1. Defaults to None.
+        key2 (str, optional): The precomputed InChIKey of inc2. Defaults to None.
+
+    Returns:
+        bool: Whether the structures agree.
+    """
+    TANIMOTO_STATS['pairs'] += 1
+    if (key1 is not None) and (key2 is not None):
+        if (key1 == key2):
+            TANIMOTO_STATS['inchikey'] += 1
+            return (True)
+    elif (inc1 == inc2):
+        TANIMOTO_STATS['identical'] += 1
+        return (True)
+    if (TANIMOTO_2D_FAST_PATH) and (_inchi_2d(inc1) == _inchi_2d(inc2)):
+        TANIMOTO_STATS['same_2d'] += 1
+        return (True)
+    return (False)
+
+
+def _inchi_2d(inchi):
+    """
+    Remove the stereo layers of an InChI.
+
+    Args:
+        inchi (str): The InChI representation.
+
+    Returns:
+        str: The InChI without its /b, /t, /m and /s layers.
+    """
+    layers = str(inchi).split('/')
+    # the version and the formula, which may start with any element, are always kept
+    return ('/'.join(layers[:2] + [l for l in layers[2:] if l[:1] not in ['b', 't', 'm', 's']]))
+
+
+def pack_fingerprint(fp):
+    """
+    Pack a fingerprint bit vector into uint64 words, bit i of the vector being bit i % 64 of word i // 64.
+
+    Args:
+        fp (ExplicitBitVect): The fingerprint.
+
+    Returns:
+        numpy.ndarray: The packed fingerprint, fp.GetNumBits() / 64 little-endian uint64 words.
+    """
+    bits = np.zeros(fp.GetNumBits(), dtype=np.uint8)
+    DataStructs.ConvertToNumpyArray(fp, bits)
+    return (np.packbits(bits, bitorder='little').view('<u8'))
+
+
+def _popcount(words):
+    """
+    Count the set bits of packed fingerprints.
+
+    Args:
+        words (numpy.ndarray): Packed fingerprints, words on the last axis.
+
+    Returns:
+        numpy.ndarray: Number of set bits of each fingerprint.
+    """
+    if (hasattr(np, 'bitwise_count')):
+        return (np.bitwise_count(words).sum(axis=-1, dtype=np.int64))
+    # numpy < 2.0
+    return (np.unpackbits(np.ascontiguousarray(words).view(np.uint8), axis=-1).sum(axis=-1, dtype=np.int64))
+
+
+def bulk_tanimoto(fp1, fp2):
+    """
+    Compute the Tanimoto similarity of many pairs of packed fingerprints at once.
+
+    The counts of common and set bits are exact integers, so the scores are the ones of
+    DataStructs.TanimotoSimilarity, including 0 for two empty fingerprints.
+
+    Args:
+        fp1 (numpy.ndarray): Packed fingerprints (see pack_fingerprint) of the first members, shape (n, words).
+        fp2 (numpy.ndarray): Packed fingerprints of the second members, shape (n, words).
+
+    Returns:
+        numpy.ndarray: Tanimoto similarity score of each pair.
+    """
+    common = _popcount(fp1 & fp2)
+    union = _popcount(fp1) + _popcount(fp2) - common
+    score = np.zeros(np.shape(common))
+    np.divide(common, union, out=score, where=union != 0)
+    return (score)
+
+
+def morgan_fingerprint(inchi):
+    """
+    Get the packed 2048-bit Morgan fingerprint (radius 2) of an InChI, from a bounded LRU cache.
+
+    The cache holds the FINGERPRINT_CACHE_SIZE most recently used InChIs; its hits and misses are counted in
+    FINGERPRINT_STATS.
+
+    Args:
+        inchi (str): The InChI representation.
+
+    Returns:
+        numpy.ndarray: The fingerprint packed by pack_fingerprint, 32 uint64 words.
+    """
+    fp = _FINGERPRINTS.get(inchi)
+    if (fp is not None):
+        _FINGERPRINTS.move_to_end(inchi)
+        FINGERPRINT_STATS['hits'] += 1
+        return (fp)
+    FINGERPRINT_STATS['misses'] += 1
+    mol = _mol(inchi)
+    fp = pack_fingerprint(AllChem.GetMorganFingerprintAsBitVect(mol, 2, nBits=2048))
+    _FINGERPRINTS[inchi] = fp
+    if (len(_FINGERPRINTS) > FINGERPRINT_CACHE_SIZE):
+        _FINGERPRINTS.popitem(last=False)
+    return (fp)
+
+
+def register_structure(inchi, fingerprint=None):
+    """
+    Seed the normalisation memo and the fingerprint cache with a structure precomputed by a library cache (see
+    LibraryCache), so that it is not built again with RDKit.
+
+    Args:
+        inchi (str): The canonical InChI, which must be its own canonical form.
+        fingerprint (numpy.ndarray, optional): Its packed Morgan fingerprint. Defaults to None.
+    """
+    _memo(_STRUCTURES, inchi, lambda _: (inchi, True), True)
+    if (fingerprint is not None) and (inchi not in _FINGERPRINTS):
+        _FINGERPRINTS[inchi] = np.asarray(fingerprint, dtype=np.uint64)
+        if (len(_FINGERPRINTS) > FINGERPRINT_CACHE_SIZE):
+            _FINGERPRINTS.popitem(last=False)
+
+
+def report_tanimoto_stats(reset=True):
+    """
+    Print the counters of the fast path of tanimoto for agreeing structures.
+
+    Args:
+        reset (bool, optional): Whether to reset the counters afterwards. Defaults to True.
+
+    Returns:
+        dict: A copy of the counters.
+    """
+    stats = dict(TANIMOTO_STATS)
+    skipped = stats['inchikey'] + stats['identical'] + stats['same_2d']
+    print('==================')
+    print('TANIMOTO FAST PATH: ' + str(skipped) + ' OF ' + str(stats['pairs']) + ' PAIRS WITHOUT FINGERPRINTS (' +
+          str(stats['inchikey']) + ' SAME INCHIKEY, ' + str(stats['identical']) + ' IDENTICAL, ' + str(stats['same_2d']) + ' SAME 2D, RATE ' +
+          str(round(skipped/max(stats['pairs'], 1), 2)) + ')')
+    print('==================')
+    if (reset):
+        for k in TANIMOTO_STATS:
+            TANIMOTO_STATS[k] = 0
+    return (stats)
+
+
+def report_fingerprint_stats(reset=True):
+    """
+    Print the counters of the fingerprint cache of tanimoto.
+
+    Args:
+        reset (bool, optional): Whether to reset the counters afterwards. Defaults to True.
+
+    Returns:
+        dict: A copy of the counters.
+    """
+    stats = dict(FINGERPRINT_STATS)
+    print('==================')
+    print('FINGERPRINT CACHE: ' + str(stats['hits']) + ' HITS, ' + str(stats['misses']) + ' MISSES, ' +
+          str(len(_FINGERPRINTS)) + ' CACHED')
+    print('==================')
+    if (reset):
+        for k in FINGERPRINT_STATS:
+            FINGERPRINT_STATS[k] = 0
+    return (stats)
 
 
 def _correct_inchi_string(inchi):
@@ -151,16 +391,30 @@ def _correct_inchi_string(inchi):
         return (inchi)
 
 
-def _is_mol(inc):
+def _is_mol(inc, memo=True):
     """
     Check if the input is a valid molecular structure and return its InChI representation.
 
     Args:
         inc (str): The InChI or SMILES representation.
+        memo (bool, optional): Whether to use the memo of normalise_structure. Defaults to True.
 
     Returns:
         str: The InChI representation of the molecule, or '?' if invalid.
     """
+    return (normalise_structure(inc, memo)[0])
+
+
+def _mol(inc):
+    """
+    Build the RDKit Mol of an InChI (or SMILES) string.
+
+    Args:
+        inc (str): The InChI or SMILES representation.
+
+    Returns:
+        Mol: The molecule, None if invalid.
+    """
     try:
         mol = Chem.MolFromInchi(inc)
     except:
@@ -168,18 +422,134 @@ def _is_mol(inc):
             mol = Chem.MolFromSmiles(inc)
         except:
             mol = ''
-    if (type(mol) == Chem.rdchem.Mol):
-        return (Chem.MolToInchi(mol))
-    else:
-        return ('?')
+    return (mol if type(mol) == Chem.rdchem.Mol else None)
+
+
+def _memo(cache, key, compute, memo):
+    """
+    Get a value from a bounded LRU memo, computing and storing it when missing.
+
+    Args:
+        cache (OrderedDict): The memo, holding at most STRUCTURE_CACHE_SIZE values.
+        key (str): The key.
+        compute (callable): Computes the value from the key.
+        memo (bool): Whether to use the memo, otherwise the value is only computed.
+
+    Returns:
+        The value.
+    """
+    if (not memo):
+        return (compute(key))
+    if (key in cache):
+        cache.move_to_end(key)
+        return (cache[key])
+    value = compute(key)
+    cache[key] = value
+    if (len(cache) > STRUCTURE_CACHE_SIZE):
+        cache.popitem(last=False)
+    return (value)
+
+
+def _normalise(inc):
+    """
+    Canonicalise an InChI (or SMILES) string through RDKit.
+
+    Args:
+        inc (str): The InChI or SMILES representation.
+
+    Returns:
+        tuple: The canonical InChI ('?' if invalid) and the validity flag.
+    """
+    mol = _mol(inc)
+    if (mol is None):
+        return ('?', False)
+    return (Chem.MolToInchi(mol), True)
+
+
+def normalise_structure(inc, memo=True):
+    """
+    Canonicalise an InChI (or SMILES) string through RDKit, memoized by the raw string.
+
+    Args:
+        inc (str): The InChI or SMILES representation.
+        memo (bool, optional): Whether to use the memo, e.g. not when compiling a whole library. Defaults to True.
+
+    Returns:
+        tuple: The canonical InChI ('?' if invalid) and the validity flag.
+    """
+    return (_memo(_STRUCTURES, inc, _normalise, memo))
+
+
+def _smiles_inchi(smiles, memo=True):
+    """
+    Convert a SMILES string to InChI, memoized by the raw string.
+
+    Args:
+        smiles (str): The SMILES representation.
+        memo (bool, optional): Whether to use the memo. Defaults to True.
+
+    Returns:
+        str: The InChI representation, None if the conversion fails.
+    """
+    return (_memo(_SMILES, smiles, _smiles_to_inchi, memo))
 
 
-def get_correct_inchi(data):
+def _smiles_to_inchi(smiles):
+    """
+    Convert a SMILES string to InChI.
+
+    Args:
+        smiles (str): The SMILES representation.
+
+    Returns:
+        str: The InChI representation, None if the conversion fails.
+    """
+    try:
+        return (Chem.MolToInchi(Chem.MolFromSmiles(smiles)))
+    except:
+        return (None)
+
+
+def load_structure_cache(path):
+    """
+    Load structure normalisations saved by save_structure_cache into the memo, if the file exists.
+
+    Args:
+        path (str or Path): Path of the JSON file.
+    """
+    if (not Path(path).exists()):
+        return
+    with open(str(path), 'r') as f:
+        data = json.load(f)
+    for inc, (inchi, valid) in data.get('inchi', {}).items():
+        _memo(_STRUCTURES, inc, lambda _: (inchi, valid), True)
+    for smiles, inchi in data.get('smiles', {}).items():
+        _memo(_SMILES, smiles, lambda _: inchi, True)
+
+
+def save_structure_cache(path):
+    """
+    Save the memoized structure normalisations, merged with those already in the file, to share them across runs.
+
+    Args:
+        path (str or Path): Path of the JSON file.
+    """
+    load_structure_cache(path)
+    data = {'inchi': {inc: [inchi, valid] for inc, (inchi, valid) in _STRUCTURES.items() if type(inc) == str},
+            'smiles': {smiles: inchi for smiles, inchi in _SMILES.items() if type(smiles) == str}}
+    tmp = str(path) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, str(path))
+
+
+def get_correct_inchi(data, memo=True):
     """
     Get the correct InChI representation from Spectrum data.
 
     Args:
         data (Spectrum or dict): Spectrum data.
+        memo (bool, optional): Whether to use the memos of the structure normalisation. Defaults to True.
 
     Returns:
         str: The correct InChI representation.
@@ -189,24 +559,20 @@ def get_correct_inchi(data):
     elif (type(data) == Spectrum):
         inchi = _correct_inchi_string(data.metadata['inchi'])
         if (str(inchi) == 'nan') or (len(inchi) == 0) or (str(inchi) == '*'):
-            try:
-                inchi = Chem.MolToInchi(
-                    Chem.MolFromSmiles(data.metadata['smiles']))
-            except:
+            inchi = _smiles_inchi(data.metadata.get('smiles'), memo)
+            if (inchi is None):
                 warnings.warn('no valide inchi found.')
                 return ('*')
     elif (type(data) == dict):
         inchi = _correct_inchi_string(data['inchi'])
         if (str(inchi) == 'nan') or (len(inchi) == 0) or (str(inchi) == '*'):
-            try:
-                inchi = Chem.MolToInchi(
-                    Chem.MolFromSmiles(data['smiles']))
-            except:
+            inchi = _smiles_inchi(data.get('smiles'), memo)
+            if (inchi is None):
                 warnings.warn('no valide inchi found.')
                 return ('*')
     else:
         raise Exception('no valide valide inpute data')
-    return _is_mol(inchi)
+    return _is_mol(inchi, memo)
 
 
 def _sirius_score_calcule(score, d):
@@ -430,6 +796,10 @@ def _find_matches(spec1_mz, spec2_mz, tolerance, shift):
     """
     Find matching peaks between two mass spectra within a specified tolerance.
 
+    The window of each peak of the first spectrum is found with `numpy.searchsorted` on the shifted m/z
+    values of the second spectrum, which must be sorted. See BatchScoring._find_matches_batch for many
+    spectrum pairs at once.
+
     Args:
         spec1_mz (numpy.ndarray): Array of m/z values from the first spectrum.
         spec2_mz (numpy.ndarray): Array of m/z values from the second spectrum.
@@ -440,21 +810,14 @@ def _find_matches(spec1_mz, spec2_mz, tolerance, shift):
         list: A list of tuples, where each tuple contains the indices of matching peaks 
               from the first and second spectra.
     """
-    lowest_idx = 0
-    matches = []
-    for peak1_idx in range(spec1_mz.shape[0]):
-        mz = spec1_mz[peak1_idx]
-        low_bound = mz - tolerance
-        high_bound = mz + tolerance
-        for peak2_idx in range(lowest_idx, spec2_mz.shape[0]):
-            mz2 = spec2_mz[peak2_idx] + shift
-            if mz2 > high_bound:
-                break
-            if mz2 < low_bound:
-                lowest_idx = peak2_idx
-            else:
-                matches.append((peak1_idx, peak2_idx))
-    return matches
+    spec1_mz = np.asarray(spec1_mz, dtype=np.float64)
+    spec2_mz = np.asarray(spec2_mz, dtype=np.float64) + shift
+    start = np.searchsorted(spec2_mz, spec1_mz - tolerance, side='left')
+    stop = np.searchsorted(spec2_mz, spec1_mz + tolerance, side='right')
+    counts = stop - start
+    peak1 = np.repeat(np.arange(len(spec1_mz)), counts)
+    peak2 = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + start[peak1]
+    return list(zip(peak1.tolist(), peak2.tolist()))
 
 
 def _mass_selection_by_tolerance(sp, query_mass, query, tolerance):
@@ -463,52 +826,104 @@ def _mass_selection_by_tolerance(sp, query_mass, query, tolerance):
 
     Args:
         sp (object): An object containing metadata, particularly 'precursor_mz'.
-        query_mass (list or numpy.ndarray): Array of mass values to be matched against the precursor mass.
-        query (list): List of query objects corresponding to the masses.
+        query_mass (PrecursorIndex, list or numpy.ndarray): Index of the mass values to be matched against the precursor mass.
+            Build the PrecursorIndex once per library; a list or array is indexed on every call.
+        query (list or SpectralLibrary): List of query objects corresponding to the masses.
         tolerance (float): The maximum allowable difference between the query mass and the precursor mass for a match.
 
     Returns:
-        list: A list of selected query objects that match the specified mass within the tolerance.
+        list or SpectralLibrary: The selected query objects that match the specified mass within the tolerance.
+            A SpectralLibrary query gives a SpectralLibrary subset, so that no Spectrum is built before scoring.
     """
+    if (not isinstance(query_mass, PrecursorIndex)):
+        query_mass = PrecursorIndex(query_mass)
     m = sp.metadata['precursor_mz']
-    idx = np.argwhere(np.abs(np.array(query_mass)-m) <= tolerance).flatten()
+    idx = query_mass.select(m, tolerance)
+    if (hasattr(query, 'take')):
+        return (query.take(idx))
     selected = [query[i] for i in idx]
     return selected
 
 
-def _get_match(sp, query, tolerance, mz_power, intensity_power, shift):
+def _get_match(sp, query, tolerance, mz_power, intensity_power, shift, backend='modified_cosine', top_k=None):
     """
     Retrieve the best match from a spectrum based on a given query and scoring method.
 
+    Candidates are scored in vectorized rounds (see BatchScoring), with the same result as matchms
+    ModifiedCosineGreedy, in decreasing order of an upper bound of their score; candidates whose bound
+    cannot reach the best score are never scored. Among equal best scores the last candidate is kept,
+    as with the reversed sort of matchms `scores_by_query`. The other similarity backends (see
+    SimilarityBackends) score all candidates. With top_k, the k best candidates are kept in a bounded heap.
+
+    Malformed spectra (missing precursor m/z, non-finite or negative peaks) are not scored: malformed
+    candidates are left out and a malformed query gets no match. They are counted in MATCH_STATS
+    (see report_match_stats) instead of raising.
+
     Args:
         sp (object): The spectrum object containing mass peaks and metadata.
-        query (list): A list of query objects to match against the spectrum.
+        query (list or SpectralLibrary): The query objects to match against the spectrum.
         tolerance (float): The allowable mass difference for matching peaks.
-        mz_power (float): Power applied to mass values for scoring (not directly used here).
+        mz_power (float): Power applied to mass values for scoring.
         intensity_power (float): Power applied to intensity values for scoring.
-        shift (float): Value to shift the mass values during matching.
+        shift (float): Unused, the precursor mass shift of each candidate is always used.
+        backend (str, optional): Name of the similarity backend. Defaults to 'modified_cosine'.
+        top_k (int, optional): Number of ranked candidates to return as well. Defaults to None.
 
     Returns:
-        list: A list containing the best matching query object and its score.
+        list: A list containing the best matching query object and its (score, matched peaks) tuple, followed
+        with top_k by the list of the (query object, (score, matched peaks)) of the k best candidates, best first.
     """
-    score = ModifiedCosineGreedy(tolerance=tolerance,
-                           intensity_power=intensity_power)
+    rsp, res = '#', 0
+    no_match = [rsp, res] if top_k is None else [rsp, res, []]
     if (len(query) == 0):
-        rsp, res = '#', 0
+        return no_match
+    MATCH_STATS['queries'] += 1
+    MATCH_STATS['candidates'] += len(query)
+    invalid = _invalid_spectra(_as_csr(query))
+    if (_invalid_spectra(_as_csr([sp]))[0]):
+        MATCH_STATS['failed_queries'] += 1
+        return no_match
+    if (invalid.any()):
+        MATCH_STATS['failed_queries'] += 1
+        MATCH_STATS['invalid_candidates'] += int(invalid.sum())
+        idx = np.flatnonzero(~invalid)
+        if (hasattr(query, 'take')):
+            query = query.take(idx)
+        else:
+            query = [query[i] for i in idx]
+        if (len(query) == 0):
+            return no_match
+    k = 1 if top_k is None else top_k
+    if (backend == 'modified_cosine'):
+        top, _ = _top_candidates(sp, query, tolerance, mz_power, intensity_power, k)
     else:
-        try:
-            SCORES = calculate_scores(query, [sp], score)
-            rsp, res = SCORES.scores_by_query(
-                sp, 'ModifiedCosineGreedy_score', sort=True)[0]
-        except:
-            rsp, res = '#', 0
-            for i in query:
-                match_mz = _find_matches(
-                    sp.peaks.mz, i.peaks.mz, tolerance, shift)
-                if (len(match_mz) != 0):
-                    res_score = score.pair(i, sp)[0]  # pair() returns (score, matches)
-                    print(i)
-                    if (res_score > res):
-                        res = res_score
-                        rsp = i
-    return [rsp, res]
+        score, matches = score_candidates(backend, sp, query, tolerance, mz_power, intensity_power)
+        top = _top_scores(score, matches, k)
+    if (len(top) != 0):
+        rsp, res = query[top[0][0]], top[0][1:]
+    if (top_k is None):
+        return [rsp, res]
+    return [rsp, res, [(query[j], (score, matches)) for j, score, matches in top]]
+
+
+def report_match_stats(reset=True):
+    """
+    Print the counters of malformed spectra met by _get_match.
+
+    Args:
+        reset (bool, optional): Whether to reset the counters afterwards. Defaults to True.
+
+    Returns:
+        dict: A copy of the counters.
+    """
+    stats = dict(MATCH_STATS)
+    if (stats['failed_queries'] != 0):
+        print('==================')
+        print(str(stats['failed_queries']) + ' OF ' + str(stats['queries']) +
+              ' SPECTRA MATCHED WITH MALFORMED SPECTRA (' + str(stats['invalid_candidates']) + ' OF ' +
+              str(stats['candidates']) + ' CANDIDATES LEFT OUT)')
+        print('==================')
+    if (reset):
+        for k in MATCH_STATS:
+            MATCH_STATS[k] = 0
+    return (stats)
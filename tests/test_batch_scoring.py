@@ -0,0 +1,57 @@
+import os
+import itertools
+
+import numpy as np
+import pytest
+from matchms.importing import load_from_mgf
+from matchms.similarity import ModifiedCosineGreedy
+
+from ms2decide.BatchScoring import _as_csr, _modified_cosine_pairs, _modified_cosine_sweep
+
+MGF = os.path.join(os.path.dirname(__file__), '..', 'Test', 'Input files', 'All GNPS.mgf')
+
+
+@pytest.fixture(scope='module')
+def spectra():
+    return (list(load_from_mgf(MGF)))
+
+
+def _pairs(spectra, low, high):
+    """(query, reference) pairs whose precursor m/z differ by low < difference <= high."""
+    precursor = np.array([sp.get('precursor_mz') for sp in spectra])
+    return ([(i, j) for i, j in itertools.permutations(range(len(spectra)), 2)
+             if low < abs(precursor[j] - precursor[i]) <= high])
+
+
+def _matchms(spectra, pairs, tolerance, mz_power, intensity_power):
+    similarity = ModifiedCosineGreedy(tolerance=tolerance, mz_power=mz_power, intensity_power=intensity_power)
+    res = [similarity.pair(spectra[j], spectra[i]) for i, j in pairs]
+    return (np.array([float(r['score']) for r in res]), np.array([int(r['matches']) for r in res]))
+
+
+@pytest.mark.parametrize('tolerance, mz_power, intensity_power', [(0.02, 0.0, 0.5), (0.1, 0.0, 1.0),
+                                                                  (0.5, 1.0, 0.5)])
+def test_modified_cosine_pairs_matches_matchms(spectra, tolerance, mz_power, intensity_power):
+    # precursors within tolerance (scored with CosineGreedy by matchms) and just beyond it
+    pairs = _pairs(spectra, -1.0, tolerance) + _pairs(spectra, tolerance, 20.0)[::7]
+    pair_query, pair_ref = (np.array(p) for p in zip(*pairs))
+    score, matches = _modified_cosine_pairs(_as_csr(spectra), _as_csr(spectra), pair_query, pair_ref, tolerance,
+                                            mz_power, intensity_power)
+    expected_score, expected_matches = _matchms(spectra, pairs, tolerance, mz_power, intensity_power)
+    assert np.array_equal(score, expected_score)
+    assert np.array_equal(matches, expected_matches)
+
+
+def test_modified_cosine_sweep_matches_matchms(spectra):
+    tolerances = (0.5, 0.02, 0.1)
+    pairs = _pairs(spectra, -1.0, max(tolerances))
+    pair_query, pair_ref = (np.array(p) for p in zip(*pairs))
+    score, matches = _modified_cosine_sweep(_as_csr(spectra), _as_csr(spectra), pair_query, pair_ref, tolerances,
+                                            0.0, 1.0)
+    precursor = np.array([sp.get('precursor_mz') for sp in spectra])
+    for t, tolerance in enumerate(tolerances):
+        # outside the precursor window of a tolerance, the sweep scores 0
+        inside = np.abs(precursor[pair_ref] - precursor[pair_query]) <= tolerance
+        expected_score, expected_matches = _matchms(spectra, pairs, tolerance, 0.0, 1.0)
+        assert np.array_equal(score[:, t], np.where(inside, expected_score, 0.0))
+        assert np.array_equal(matches[:, t], np.where(inside, expected_matches, 0))
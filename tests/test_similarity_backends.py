@@ -0,0 +1,33 @@
+import os
+
+import numpy as np
+import pytest
+from matchms.importing import load_from_mgf
+from matchms.similarity import CosineGreedy, CosineHungarian
+
+from ms2decide.SimilarityBackends import score_candidates
+
+MGF = os.path.join(os.path.dirname(__file__), '..', 'Test', 'Input files', 'All GNPS.mgf')
+
+
+@pytest.fixture(scope='module')
+def spectra():
+    return (list(load_from_mgf(MGF)))
+
+
+def _matchms(similarity, sp, candidates):
+    res = [similarity.pair(candidate, sp) for candidate in candidates]
+    return (np.array([float(r['score']) for r in res]), np.array([int(r['matches']) for r in res]))
+
+
+@pytest.mark.parametrize('backend, similarity', [('cosine_greedy', CosineGreedy), ('cosine_hungarian', CosineHungarian)])
+@pytest.mark.parametrize('tolerance, mz_power, intensity_power', [(0.02, 0.0, 0.5), (0.1, 1.0, 1.0)])
+def test_backend_matches_matchms(spectra, backend, similarity, tolerance, mz_power, intensity_power):
+    # most cost matrices of CosineHungarian have rows that can only be assigned to a column without a peak pair
+    reference = similarity(tolerance=tolerance, mz_power=mz_power, intensity_power=intensity_power)
+    for sp in [sp for sp in spectra[::5] if len(sp.peaks) < 1000]:
+        score, matches = score_candidates(backend, sp, spectra, tolerance, mz_power, intensity_power)
+        expected_score, expected_matches = _matchms(reference, sp, spectra)
+        assert np.array_equal(score, expected_score)
+        assert np.array_equal(matches, expected_matches)
+